@@ -16,6 +16,8 @@ from dicomnode.server.output import PipelineOutput, FileOutput, NoOutput
 
 from typing import Dict, Any
 
+from pydicom import Dataset
+
 
 DEFAULT_PATH = "/tmp/"
 OUTPUT_PATH = Path(os.environ.get("AVERAGE_NODE_OUTPUT_PATH", default=DEFAULT_PATH))
@@ -34,13 +36,33 @@ class SeriesInputs(DynamicInput):
   image_grinder = ManyGrinder(NumpyGrinder(), TagGrinder(0x00080031))
   required_tags = blueprint.get_required_tags()
 
+  def __init__(self, *args, **kwargs) -> None:
+    # Images per series and number of series of each length, such that the
+    # readiness is updated with each image rather than recomputed
+    self.series_lengths: Dict[str, int] = {}
+    self.length_counts: Dict[int, int] = {}
+    super().__init__(*args, **kwargs)
+
+  def on_image_added(self, dicom: Dataset) -> None:
+    series = str(dicom[self.separator_tag].value)
+    previous_length = self.series_lengths.get(series, 0)
+    # Distinct images of the series, as a re-sent image replaces the old one
+    length = len(self[series].data)
+    if length == previous_length:
+      return
+    if previous_length in self.length_counts:
+      self.length_counts[previous_length] -= 1
+      if self.length_counts[previous_length] == 0:
+        del self.length_counts[previous_length]
+    self.series_lengths[series] = length
+    self.length_counts[length] = self.length_counts.get(length, 0) + 1
+
+  def is_ready(self) -> bool:
+    # All leafs are the same length
+    return len(self.length_counts) == 1
+
   def validate(self) -> bool:
-    if len(self.data) == 0:
-      return False
-    lengths = set()
-    for leaf in self.data.values():
-      lengths.add(len(leaf))
-    return len(lengths) == 1 # this checks that all leafs are the same length
+    return self.is_ready()
 
 class AveragingPipeline(AbstractPipeline):
   header_blueprint = blueprint
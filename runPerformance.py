@@ -1,22 +1,81 @@
-import argparse
+"""Runs the benchmarks of the DicomNode library, which are the test methods
+prefixed with performance, and writes the results to a JSON file.
+
+If a baseline is given, the results are compared against it and the script
+exits with status 1, if throughput decreased or memory use increased by more
+than the tolerance.
+
+Example:
+  python runPerformance.py --output performance/results.json
+  python runPerformance.py --baseline performance/baseline.json -k send_images
+"""
 
+import argparse
+import json
 import os
 import shutil
+import sys
 from pathlib import Path
 
 from unittest import TextTestRunner, TestSuite, TestLoader
 
+TESTING_TEMPORARY_DIRECTORY = "/tmp/pipeline_performance"
+os.environ['DICOMNODE_TESTING_TEMPORARY_DIRECTORY'] = TESTING_TEMPORARY_DIRECTORY
+# DICOMNODE_TESTING_TEMPORARY_DIRECTORY must be set before importing
+from tests.helpers import BENCHMARK_RESULTS, compare_benchmarks, testing_logs
+
+
 if __name__ == "__main__":
-  parser = argparse.ArgumentParser(description="Testing tool for DicomNode library")
+  parser = argparse.ArgumentParser(description="Benchmarking tool for DicomNode library")
   parser.add_argument("--verbose", type=int, default=1)
-  parser.add_argument("-p", "--performance", action='store_true')
+  parser.add_argument("-k", "--filter", action='append', default=None,
+                      help="Only run benchmarks matching this substring, may be repeated")
+  parser.add_argument("-o", "--output", type=Path, default=Path("performance/results.json"),
+                      help="Path of the JSON results")
+  parser.add_argument("-b", "--baseline", type=Path, default=None,
+                      help="JSON results of a previous run to compare against")
+  parser.add_argument("-t", "--tolerance", type=float, default=0.1,
+                      help="Allowed relative regression before failing")
 
   args = parser.parse_args()
+  testing_logs()
 
+  output_path: Path = args.output.absolute()
+  baseline_path = None if args.baseline is None else args.baseline.absolute()
 
-  runner = TextTestRunner()
+  runner = TextTestRunner(verbosity=args.verbose)
   loader = TestLoader()
   loader.testMethodPrefix = "performance"
-  suite: TestSuite = loader.discover("src")
+  if args.filter is not None:
+    loader.testNamePatterns = [f"*{pattern}*" for pattern in args.filter]
+  suite: TestSuite = loader.discover("tests")
+
+  cwd = os.getcwd()
+  tmpDirPath = Path(TESTING_TEMPORARY_DIRECTORY)
+  if tmpDirPath.exists():
+    shutil.rmtree(TESTING_TEMPORARY_DIRECTORY) #pragma: no cover
+  os.mkdir(TESTING_TEMPORARY_DIRECTORY, mode=0o777)
+  os.chdir(TESTING_TEMPORARY_DIRECTORY)
+  test_result = runner.run(suite)
+  os.chdir(cwd)
+  shutil.rmtree(TESTING_TEMPORARY_DIRECTORY)
+
+  results = {name: result.to_json() for name, result in sorted(BENCHMARK_RESULTS.items())}
+  output_path.parent.mkdir(parents=True, exist_ok=True)
+  with open(output_path, 'w') as output_file:
+    json.dump(results, output_file, indent=2)
+  print(f"Wrote {len(results)} benchmark results to {output_path}")
+
+  exit_code = 0 if test_result.wasSuccessful() else 1
+  if baseline_path is not None:
+    with open(baseline_path, 'r') as baseline_file:
+      baseline = json.load(baseline_file)
+    regressions = compare_benchmarks(results, baseline, args.tolerance)
+    for regression in regressions:
+      print(f"REGRESSION {regression}")
+    if regressions:
+      exit_code = 1
+    else:
+      print(f"No regressions compared to {baseline_path}")
 
-  runner.run(suite)
+  sys.exit(exit_code)
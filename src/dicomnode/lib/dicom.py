@@ -1,18 +1,128 @@
 """Library methods for manipulation of pydicom.dataset objects
 """
-from typing import Any, List, Callable, Tuple
+from hashlib import blake2b
+from os import getpid
+from secrets import randbits
+from threading import Lock
+from typing import Any, List, Callable, Optional, Tuple, Union
 
 import numpy
 
-from pydicom import Dataset
-from pydicom.uid import UID, generate_uid, ImplicitVRLittleEndian, ExplicitVRBigEndian, ExplicitVRLittleEndian
+from pydicom import Dataset, Sequence
+from pydicom.filebase import DicomBytesIO
+from pydicom.filewriter import write_dataset
+from pydicom.multival import MultiValue
+from pydicom.uid import UID, ImplicitVRLittleEndian, ExplicitVRBigEndian, ExplicitVRLittleEndian
 
 from dicomnode.constants import DICOMNODE_IMPLEMENTATION_UID, DICOMNODE_IMPLEMENTATION_NAME, DICOMNODE_VERSION
 from dicomnode.lib.exceptions import InvalidDataset
 
 
+class UIDGenerator:
+  """Generates unique UIDs of the form: <prefix><root>.<counter>
+
+  pydicom's generate_uid hashes new entropy for every UID, this draws a random
+  root once per process and then counts, which is much cheaper when building
+  large series or anonymizing archives.
+
+  Args:
+    prefix (str): Prefix of all generated UIDs, must end with a '.'.
+      Defaults to the dicomnode implementation UID.
+    root (Optional[int]): Fixes the root, making the generated UIDs
+      deterministic, which is useful for tests. If None a random root is
+      drawn, and redrawn if the process is forked.
+
+  Example:
+  >>> generator = UIDGenerator(root=1)
+  >>> generator()
+  '1.2.826.0.1.3680043.10.1083.1.1'
+  >>> generator.generate_many(2)
+  ['1.2.826.0.1.3680043.10.1083.1.2', '1.2.826.0.1.3680043.10.1083.1.3']
+  """
+  max_uid_length = 64
+  root_bits = 60 # 2 ** 60 has 19 digits, leaves 16 digits for the counter
+
+  def __init__(self,
+               prefix: str = DICOMNODE_IMPLEMENTATION_UID + '.',
+               root: Optional[int] = None) -> None:
+    if not prefix.endswith('.'):
+      raise ValueError("The prefix of a UID generator must end with a '.'")
+    if root is not None and root < 0:
+      raise ValueError("The root of a UID generator must be non negative")
+    self.prefix = prefix
+    self._fixed_root = root is not None
+    self._lock = Lock()
+    self._seed(root)
+
+  def _seed(self, root: Optional[int] = None) -> None:
+    if root is None:
+      root = randbits(self.root_bits) + 1
+    self._pid = getpid()
+    self._base = f"{self.prefix}{root}."
+    self._counter = 0
+    self._max_counter = 10 ** (self.max_uid_length - len(self._base)) - 1
+    if self._max_counter < 1:
+      raise ValueError("The prefix and root leaves no room for the counter")
+
+  def _next(self) -> UID:
+    # Caller must hold self._lock
+    if not self._fixed_root and self._pid != getpid():
+      self._seed() # A forked process must not reuse the parent's UIDs
+    if self._counter == self._max_counter:
+      if self._fixed_root:
+        raise ValueError("UID generator with a fixed root is exhausted")
+      self._seed()
+    self._counter += 1
+    return UID(f"{self._base}{self._counter}")
+
+  def __call__(self) -> UID:
+    with self._lock:
+      return self._next()
+
+  def generate_many(self, number: int) -> List[UID]:
+    """Generates a batch of UIDs while only acquiring the lock once
+
+    Args:
+        number (int): Number of UIDs to generate
+
+    Returns:
+        List[UID]: The generated UIDs in generation order
+    """
+    with self._lock:
+      return [self._next() for _ in range(number)]
+
+
+_uid_generator = UIDGenerator()
+
 def gen_uid() -> UID:
-  return generate_uid(prefix=DICOMNODE_IMPLEMENTATION_UID + '.')
+  return _uid_generator()
+
+def gen_uids(number: int) -> List[UID]:
+  """Generates many UIDs at once with the UID generator used by gen_uid
+
+  Args:
+      number (int): Number of UIDs to generate
+
+  Returns:
+      List[UID]: The generated UIDs
+  """
+  return _uid_generator.generate_many(number)
+
+def set_uid_generator(generator: UIDGenerator) -> UIDGenerator:
+  """Replaces the UID generator used by gen_uid and gen_uids.
+
+  Useful for producing deterministic UIDs in tests.
+
+  Args:
+      generator (UIDGenerator): The new generator
+
+  Returns:
+      UIDGenerator: The generator that was replaced
+  """
+  global _uid_generator
+  old_generator = _uid_generator
+  _uid_generator = generator
+  return old_generator
 
 def make_meta(dicom: Dataset) -> None:
   """Similar to fix_meta_info method, however UID are generated with dicomnodes prefix instead
@@ -59,6 +169,64 @@ def get_tag(Tag: int) -> Callable[[Dataset], Any]:
   return retFunc
 
 
+_ELEMENT_OVERHEAD = 96
+"Approximate bytes of the python objects wrapping a data element"
+
+def estimate_dataset_size(dataset: Dataset) -> int:
+  """Estimates the number of bytes a dataset occupies in memory.
+
+  The estimate is dominated by bulk values such as PixelData. Raw elements are
+  not decoded, so it's cheap to call on a received dataset.
+
+  Args:
+      dataset (Dataset): The dataset to be measured
+
+  Returns:
+      int: Estimated size in bytes
+  """
+  size = 0
+  for element in dataset.elements():
+    size += _ELEMENT_OVERHEAD
+    value = element.value
+    if isinstance(value, (bytes, bytearray, str)):
+      size += len(value)
+    elif isinstance(value, Sequence):
+      size += sum(estimate_dataset_size(item) for item in value)
+    elif isinstance(value, (list, MultiValue)):
+      size += 8 * len(value)
+  return size
+
+def digest_bytes(data: Union[bytes, bytearray, memoryview]) -> bytes:
+  """Computes the digest identifying the content of an encoded dataset, such
+  as the dataset of a C-STORE request.
+
+  Args:
+      data (Union[bytes, bytearray, memoryview]): The encoded dataset
+
+  Returns:
+      bytes: 16 byte digest
+  """
+  return blake2b(data, digest_size=16).digest()
+
+def dataset_digest(dataset: Dataset) -> bytes:
+  """Computes the digest of the content of a dataset, by encoding it in
+  implicit VR little endian. For a dataset received in that transfer syntax
+  it's the same as digest_bytes of the received bytes, which should be
+  preferred then.
+
+  Args:
+      dataset (Dataset): The dataset in question
+
+  Returns:
+      bytes: 16 byte digest
+  """
+  buffer = DicomBytesIO()
+  # Implicit VR, as it doesn't require ambiguous VRs to be resolved
+  buffer.is_little_endian = True
+  buffer.is_implicit_VR = True
+  write_dataset(buffer, dataset)
+  return digest_bytes(buffer.getvalue())
+
 def extrapolate_image_position_patient(
     slice_thickness:float,
     orientation: int,
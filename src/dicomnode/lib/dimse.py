@@ -3,17 +3,21 @@
 
 __author__ = "Christoffer Vilstrup Jensen"
 
+from collections import OrderedDict
 from dataclasses import dataclass
 from enum import Enum
-
-
-from typing import Iterable, Callable, Optional
+from itertools import chain, islice
+from threading import Event, Lock, Timer
+from time import monotonic
+from typing import Any, Dict, FrozenSet, Iterable, Iterator, Callable, List, Optional, Tuple, Union
 
 
 from pydicom import Dataset
+from pydicom.datadict import dictionary_VR
 from pydicom.uid import UID
 from pynetdicom.ae import ApplicationEntity
-from pynetdicom.sop_class import PatientRootQueryRetrieveInformationModelMove # type: ignore
+from pynetdicom.association import Association
+from pynetdicom.sop_class import PatientRootQueryRetrieveInformationModelFind, PatientRootQueryRetrieveInformationModelMove, StudyRootQueryRetrieveInformationModelFind, Verification # type: ignore
 
 from dicomnode.lib.exceptions import CouldNotCompleteDIMSEMessage, InvalidQueryDataset
 from dicomnode.lib.dicom import make_meta
@@ -42,21 +46,209 @@ class ResponseAddress(Address):
   def __init__(self):
     pass
 
-def send_image(SCU_AE: str, address: Address, dicom_image: Dataset) -> Dataset:
+
+_PoolKey = Tuple[str, int, str, str, FrozenSet[str]]
+
+@dataclass
+class _IdleAssociation:
+  association: Association
+  idle_since: float
+
+
+class AssociationPool:
+  """Pool of established associations, that is reused between DIMSE
+  messages to the same SCP, such that each message doesn't pay for the TCP and
+  A-ASSOCIATE handshake.
+
+  Associations are keyed by the address, the SCU AE title and the requested
+  presentation contexts. Associations which have been idle for longer than
+  idle_timeout are released, and an association is health checked before it's
+  reused.
+
+  Note that pynetdicom aborts associations that have been silent for longer
+  than the network timeout of the AE, 60 seconds by default, so the
+  idle_timeout should be below that.
+
+  Args:
+    idle_timeout (float): Seconds an association may be unused before it's released
+    verify_on_acquire (bool): Sends a C-ECHO as part of the health check
+    max_idle_per_key (int): Maximum number of idle associations kept per key
+
+  Example:
+  >>> pool = AssociationPool()
+  >>> send_images("SCU_AE", address, patient_1_datasets, pool=pool)
+  >>> send_images("SCU_AE", address, patient_2_datasets, pool=pool) # Reuses the association
+  >>> pool.close()
+  """
+
+  def __init__(self,
+               idle_timeout: float = 30.0,
+               verify_on_acquire: bool = False,
+               max_idle_per_key: int = 4) -> None:
+    self.idle_timeout = idle_timeout
+    self.verify_on_acquire = verify_on_acquire
+    self.max_idle_per_key = max_idle_per_key
+    self._lock = Lock()
+    self._idle: Dict[_PoolKey, List[_IdleAssociation]] = {}
+    self._in_use: Dict[int, _PoolKey] = {}
+
+  @staticmethod
+  def _key(SCU_AE: str, address: Address, contexts: Iterable[Union[UID, str]]) -> _PoolKey:
+    return (address.ip, address.port, address.ae_title, SCU_AE,
+            frozenset(str(context) for context in contexts))
+
+  def _is_healthy(self, association: Association) -> bool:
+    if not association.is_established or association.is_aborted or association.is_released:
+      return False
+    if self.verify_on_acquire:
+      response = association.send_c_echo()
+      return 0x00000900 in response and response.Status == 0x0000
+    return True
+
+  def _pop_expired(self, now: float) -> List[Association]:
+    # Caller must hold self._lock
+    expired = []
+    for key, idle_associations in list(self._idle.items()):
+      alive = []
+      for idle in idle_associations:
+        if now - idle.idle_since > self.idle_timeout:
+          expired.append(idle.association)
+        else:
+          alive.append(idle)
+      if alive:
+        self._idle[key] = alive
+      else:
+        del self._idle[key]
+    return expired
+
+  @staticmethod
+  def _release_all(associations: Iterable[Association]) -> None:
+    for association in associations:
+      if association.is_established:
+        association.release()
+
+  def acquire(self,
+              SCU_AE: str,
+              address: Address,
+              contexts: Iterable[Union[UID, str]]) -> Association:
+    """Gets an association to the address, reusing an idle association if
+    a healthy one is available.
+
+    The returned association might not be established, so callers should
+    check association.is_established.
+
+    Args:
+        SCU_AE (str): AE title of the requestor
+        address (Address): Address of the SCP
+        contexts (Iterable[Union[UID, str]]): Abstract syntaxes to request
+
+    Returns:
+        Association: An association, that should be given back with release
+    """
+    contexts = list(contexts)
+    key = self._key(SCU_AE, address, contexts)
+    while True:
+      with self._lock:
+        expired = self._pop_expired(monotonic())
+        idle_associations = self._idle.get(key)
+        idle = idle_associations.pop() if idle_associations else None
+      self._release_all(expired)
+      if idle is None:
+        break
+      if self._is_healthy(idle.association):
+        logger.debug(f"Reusing association to {address.ae_title}")
+        with self._lock:
+          self._in_use[id(idle.association)] = key
+        return idle.association
+      idle.association.abort()
+
+    ae = ApplicationEntity(ae_title=SCU_AE)
+    for context in contexts:
+      ae.add_requested_context(context)
+    if self.verify_on_acquire and Verification not in contexts:
+      ae.add_requested_context(Verification)
+    association = ae.associate(
+      address.ip,
+      address.port,
+      ae_title=address.ae_title
+    )
+    if association.is_established:
+      with self._lock:
+        self._in_use[id(association)] = key
+    return association
+
+  def release(self, association: Association) -> None:
+    """Gives an association back to the pool, such that it can be reused
+
+    Args:
+        association (Association): Association from acquire
+    """
+    with self._lock:
+      key = self._in_use.pop(id(association), None)
+      pooled = key is not None and association.is_established
+      if pooled:
+        idle_associations = self._idle.setdefault(key, [])
+        pooled = len(idle_associations) < self.max_idle_per_key
+        if pooled:
+          idle_associations.append(_IdleAssociation(association, monotonic()))
+    if not pooled and association.is_established:
+      association.release()
+
+  def prune(self) -> None:
+    """Releases all associations that have been idle for longer than idle_timeout"""
+    with self._lock:
+      expired = self._pop_expired(monotonic())
+    self._release_all(expired)
+
+  def close(self) -> None:
+    """Releases all idle associations. The pool can be used afterwards."""
+    with self._lock:
+      idle_associations = [idle.association for idle_list in self._idle.values() for idle in idle_list]
+      self._idle = {}
+    self._release_all(idle_associations)
+
+  def __len__(self) -> int:
+    """Number of idle associations in the pool"""
+    with self._lock:
+      return sum(len(idle_list) for idle_list in self._idle.values())
+
+
+def _open_association(SCU_AE: str,
+                      address: Address,
+                      contexts: Iterable[Union[UID, str]],
+                      pool: Optional[AssociationPool]) -> Association:
+  if pool is not None:
+    return pool.acquire(SCU_AE, address, contexts)
   ae = ApplicationEntity(ae_title=SCU_AE)
-  ae.add_requested_context(dicom_image.SOPClassUID)
-  assoc = ae.associate(
+  for context in contexts:
+    ae.add_requested_context(context)
+  return ae.associate(
     address.ip,
     address.port,
     ae_title=address.ae_title
   )
+
+def _close_association(association: Association, pool: Optional[AssociationPool]) -> None:
+  if pool is not None:
+    pool.release(association)
+  else:
+    association.release()
+
+
+def send_image(SCU_AE: str,
+               address: Address,
+               dicom_image: Dataset,
+               pool: Optional[AssociationPool] = None) -> Dataset:
+  assoc = _open_association(SCU_AE, address, [dicom_image.SOPClassUID], pool)
   if assoc.is_established:
     if hasattr(dicom_image, 'file_meta'):
       make_meta(dicom_image)
     if 0x00020010 not in dicom_image.file_meta:
       make_meta(dicom_image)
-    response = assoc.send_c_store(dicom_image)
-    assoc.release()
+    try:
+      response = assoc.send_c_store(dicom_image)
+    finally:
+      _close_association(assoc, pool)
     return response
   else:
     error_message = f"""Could not connect to the SCP with the following inputs:
@@ -68,40 +260,112 @@ def send_image(SCU_AE: str, address: Address, dicom_image: Dataset) -> Dataset:
     logger.error(error_message)
     raise CouldNotCompleteDIMSEMessage("Could not connect")
 
+def _sop_classes(datasets: Iterable[Dataset]) -> List[UID]:
+  sop_classes: List[UID] = []
+  for dataset in datasets:
+    if dataset.SOPClassUID not in sop_classes:
+      sop_classes.append(dataset.SOPClassUID)
+  return sop_classes
+
 def send_images(SCU_AE: str,
                 address: Address,
                 dicom_images: Iterable[Dataset],
-                error_callback_func: Optional[Callable[[Address, Dataset, Dataset], None]] = None
+                error_callback_func: Optional[Callable[[Address, Dataset, Dataset], None]] = None,
+                pool: Optional[AssociationPool] = None,
+                sop_classes: Optional[Iterable[UID]] = None,
+                peek_size: int = 64,
+                abort: Optional[Event] = None
   ):
-  ae = ApplicationEntity(ae_title=SCU_AE)
-  contexts = set()
-  for image in dicom_images:
-    if image.SOPClassUID.name not in contexts:
-      ae.add_requested_context(image.SOPClassUID)
-      contexts.add(image.SOPClassUID.name)
+  """Sends the datasets to the address over a single association
 
-  assoc = ae.associate(
-    address.ip,
-    address.port,
-    ae_title=address.ae_title
-  )
-  if assoc.is_established:
-    for dataset in dicom_images:
+  The datasets are only iterated once, so generators and lazy datasets can be
+  sent without being exhausted or loaded twice. The presentation contexts are
+  negotiated from sop_classes if given, otherwise from the first peek_size
+  datasets. If a later dataset has an unnegotiated SOP class the association
+  is replaced by one, which includes it.
+
+  Setting the abort event stops the sending before the next C-STORE, and the
+  association is aborted rather than released or given back to the pool.
+
+  Args:
+      SCU_AE (str): AE title of the SCU
+      address (Address): Address of the SCP
+      dicom_images (Iterable[Dataset]): Datasets to be sent
+      error_callback_func (Optional[Callable[[Address, Dataset, Dataset], None]], optional):
+        Called with failed responses, if None a failed C-STORE raises. Defaults to None.
+      pool (Optional[AssociationPool], optional): Pool to reuse associations from. Defaults to None.
+      sop_classes (Optional[Iterable[UID]], optional): The SOP classes of the
+        datasets, if known up front. Defaults to None.
+      peek_size (int, optional): Number of datasets buffered to determine the
+        SOP classes, when sop_classes is None. Defaults to 64.
+      abort (Optional[Event], optional): Event, that stops the sending when
+        set, such as by a timed out dispatch. Defaults to None.
+
+  Raises:
+      CouldNotCompleteDIMSEMessage: If the SCP is unreachable, the sending is
+        aborted or, without an error_callback_func, a C-STORE fails
+
+  Returns:
+      int: 0x0000
+  """
+  images = iter(dicom_images)
+  # A shard of send_images_sharded gives the dataset, it couldn't send, back
+  # to the other shards
+  give_back = images.give_back if isinstance(images, _SharedIterator) else None
+  buffered: List[Dataset] = []
+  if sop_classes is None:
+    buffered = list(islice(images, peek_size))
+    contexts = _sop_classes(buffered)
+  else:
+    contexts = list(sop_classes)
+
+  if len(contexts) == 0:
+    return 0x0000 # There's nothing to send
+
+  assoc = _open_association(SCU_AE, address, contexts, pool)
+  try:
+    for dataset in chain(buffered, images):
+      if not assoc.is_established:
+        if give_back is not None:
+          give_back(dataset)
+        break
+      if abort is not None and abort.is_set():
+        logger.error(f"Sending to {address.ae_title} was aborted")
+        assoc.abort()
+        if pool is not None:
+          pool.release(assoc)
+        raise CouldNotCompleteDIMSEMessage(f"Sending to {address.ae_title} was aborted")
+      if dataset.SOPClassUID not in contexts:
+        logger.debug(f"Renegotiating association to {address.ae_title} for {dataset.SOPClassUID}")
+        contexts.append(dataset.SOPClassUID)
+        _close_association(assoc, pool)
+        assoc = _open_association(SCU_AE, address, contexts, pool)
+        if not assoc.is_established:
+          if give_back is not None:
+            give_back(dataset)
+          break
       if not hasattr(dataset, 'file_meta'):
         make_meta(dataset)
       if 0x00020010 not in dataset.file_meta:
         make_meta(dataset)
       response = assoc.send_c_store(dataset)
+      if 'Status' not in response:
+        # The association was aborted or timed out before the response
+        if give_back is not None:
+          give_back(dataset)
+        break
       if(response.Status != 0x0000):
         if error_callback_func is None:
-          assoc.release()
           error_message = f"Could not send {dataset}\n Received Response: {response}"
           logger.error(error_message)
           raise CouldNotCompleteDIMSEMessage(f"Could not send {dataset}")
         else:
           error_callback_func(address, response, dataset)
-    assoc.release()
-  else:
+  finally:
+    if assoc.is_established:
+      _close_association(assoc, pool)
+
+  if not assoc.is_established and not assoc.is_released:
     error_message = f"""Could not connect to the SCP with the following inputs:
       IP: {address.ip}
       Port: {address.port}
@@ -109,7 +373,7 @@ def send_images(SCU_AE: str,
       SCU AE:{SCU_AE}
     """
     logger.error(error_message)
-    raise CouldNotCompleteDIMSEMessage("Could not connect")
+    raise _AssociationLost("Could not connect")
   return 0x0000
 
 def send_images_thread(
@@ -117,15 +381,159 @@ def send_images_thread(
     address : Address,
     dicom_images: Iterable[Dataset],
     error_callback_func: Optional[Callable[[Address, Dataset, Dataset], None]] = None,
-    daemon: bool = True) -> ThreadWithReturnValue:
-  thread = ThreadWithReturnValue(group= None, target=send_images, args=[SCU_AE, address, dicom_images, error_callback_func], daemon=daemon)
+    daemon: bool = True,
+    pool: Optional[AssociationPool] = None) -> ThreadWithReturnValue:
+  thread = ThreadWithReturnValue(group= None, target=send_images, args=[SCU_AE, address, dicom_images, error_callback_func], kwargs={'pool' : pool}, daemon=daemon)
   thread.start()
   return thread
 
+class _AssociationLost(CouldNotCompleteDIMSEMessage):
+  """The association couldn't be established or was lost, before every
+  dataset was sent"""
+
+class _SharedIterator:
+  """Iterator, that can be consumed by multiple threads, each dataset is
+  given to the thread asking for it first. Datasets given back are handed
+  out again before the remaining datasets"""
+  def __init__(self, iterator: Iterator[Dataset]) -> None:
+    self._iterator = iterator
+    self._given_back: List[Dataset] = []
+    self._exhausted = False
+    self._lock = Lock()
+
+  def __iter__(self) -> '_SharedIterator':
+    return self
+
+  def __next__(self) -> Dataset:
+    with self._lock:
+      if self._given_back:
+        return self._given_back.pop()
+      try:
+        return next(self._iterator)
+      except StopIteration:
+        self._exhausted = True
+        raise
+
+  def give_back(self, dataset: Dataset) -> None:
+    """Returns a dataset, which couldn't be sent, to the other threads"""
+    with self._lock:
+      self._given_back.append(dataset)
+
+  @property
+  def drained(self) -> bool:
+    """If every dataset was taken and none were given back"""
+    with self._lock:
+      return self._exhausted and not self._given_back
+
+def _send_shard(SCU_AE: str,
+                address: Address,
+                shard: Iterable[Dataset],
+                error_callback_func: Optional[Callable[[Address, Dataset, Dataset], None]],
+                pool: Optional[AssociationPool],
+                sop_classes: List[UID],
+                abort: Optional[Event]) -> Optional[Exception]:
+  try:
+    send_images(SCU_AE, address, shard, error_callback_func, pool=pool, sop_classes=sop_classes, abort=abort)
+  except Exception as exception:
+    return exception
+  return None
+
+def send_images_sharded(SCU_AE: str,
+                        address: Address,
+                        dicom_images: Iterable[Dataset],
+                        shards: int = 4,
+                        error_callback_func: Optional[Callable[[Address, Dataset, Dataset], None]] = None,
+                        pool: Optional[AssociationPool] = None,
+                        abort: Optional[Event] = None,
+                        peek_size: int = 64
+  ):
+  """Sends a series over multiple concurrent associations to the same SCP.
+
+  send_images waits for the response of each C-STORE before sending the next,
+  so over a high latency link the throughput is bound by the latency.
+  This sends the datasets over shards concurrent associations, where each
+  association sends the next dataset of the series, once its previous C-STORE
+  completes. The datasets are only iterated once, so a generator is streamed
+  rather than held in memory. The datasets of a shard are sent in order, but
+  there's no ordering between shards. If the association of a shard is lost,
+  the dataset it was sending is sent by one of the other shards.
+
+  Args:
+      SCU_AE (str): AE title of the SCU
+      address (Address): Address of the SCP
+      dicom_images (Iterable[Dataset]): Datasets to be sent
+      shards (int, optional): Number of concurrent associations. Defaults to 4.
+      error_callback_func (Optional[Callable[[Address, Dataset, Dataset], None]], optional):
+        Called with the failing responses, otherwise a failed C-STORE fails the shard. Defaults to None.
+      pool (Optional[AssociationPool], optional): Pool to acquire the
+        associations from. Defaults to None.
+      abort (Optional[Event], optional): Event, that stops every shard when
+        set, see send_images. Defaults to None.
+      peek_size (int, optional): Number of datasets buffered to determine the
+        SOP classes, see send_images. Defaults to 64.
+
+  Raises:
+      ValueError: If shards is less than 1
+      CouldNotCompleteDIMSEMessage: If any of the shards couldn't be send
+
+  Returns:
+      int: 0x0000 similar to send_images
+  """
+  if shards < 1:
+    raise ValueError("A series must be send in at least one shard")
+  images = iter(dicom_images)
+  buffered = list(islice(images, peek_size))
+  if len(buffered) < peek_size:
+    # The entire series is buffered, so there's no need for more associations than datasets
+    shards = min(shards, len(buffered))
+  if shards <= 1:
+    return send_images(SCU_AE, address, chain(buffered, images), error_callback_func,
+                       pool=pool, sop_classes=_sop_classes(buffered), abort=abort)
+
+  sop_classes = _sop_classes(buffered)
+  shared_images = _SharedIterator(chain(buffered, images))
+  threads: List[ThreadWithReturnValue] = []
+  for _ in range(shards):
+    thread = ThreadWithReturnValue(
+      target=_send_shard,
+      args=(SCU_AE, address, shared_images, error_callback_func, pool, sop_classes, abort),
+      daemon=True
+    )
+    thread.start()
+    threads.append(thread)
+
+  failed_shards = [exception for exception in (thread.join() for thread in threads) if exception is not None]
+  if failed_shards and shared_images.drained\
+      and all(isinstance(exception, _AssociationLost) for exception in failed_shards):
+    # The datasets of the lost associations were sent by the other shards
+    logger.warning(f"{len(failed_shards)} of {len(threads)} shards to {address.ae_title} lost their association")
+    return 0x0000
+  if failed_shards:
+    logger.error(f"{len(failed_shards)} of {len(threads)} shards to {address.ae_title} failed")
+    raise CouldNotCompleteDIMSEMessage(f"Could not send {len(failed_shards)} shards")
+  return 0x0000
+
+def _validate_query_dataset(dataset: Dataset, query_level: QueryLevels, message: str) -> None:
+  if "QueryRetrieveLevel" not in dataset:
+    dataset.QueryRetrieveLevel = query_level.value
+
+  if query_level == QueryLevels.PATIENT and 'PatientID' not in dataset:
+    logger.error(f"Attempted to send a {message} at Patient level without a PatientID tag")
+    raise InvalidQueryDataset
+
+  if query_level == QueryLevels.STUDY and 'StudyInstanceUID' not in dataset:
+    logger.error(f"Attempted to send a {message} at Study level without a StudyInstanceUID tag")
+    raise InvalidQueryDataset
+
+  if query_level == QueryLevels.SERIES and 'SeriesInstanceUID' not in dataset:
+    logger.error(f"Attempted to send a {message} at Series level without a SeriesInstanceUID tag")
+    raise InvalidQueryDataset
+
 def send_move(SCU_AE: str,
               address : Address,
               dataset : Dataset,
-              query_level: QueryLevels = QueryLevels.PATIENT
+              query_level: QueryLevels = QueryLevels.PATIENT,
+              pool: Optional[AssociationPool] = None
   ) -> None:
   """This function sends a C-move to the address, as the SCU_AE to the SCU_AE
 
@@ -136,48 +544,32 @@ def send_move(SCU_AE: str,
 
   Kwargs:
     query_level (QueryLevel, optional):
+    pool (AssociationPool, optional): Pool to reuse associations from
 
   Raises:
     InvalidQueryDataset:
   """
-  if "QueryRetrieveLevel" not in dataset:
-    dataset.QueryRetrieveLevel = query_level
-
-  if query_level == QueryLevels.PATIENT and 'PatientID' not in dataset:
-    logger.error("Attempted to send a move at Patient level without a PatientID tag")
-    raise InvalidQueryDataset
-
-  if query_level == QueryLevels.STUDY and 'StudyInstanceUID' not in dataset:
-    logger.error("Attempted to send a move at Study level without a StudyInstanceUID tag")
-    raise InvalidQueryDataset
-
-  if query_level == QueryLevels.SERIES and 'SeriesInstanceUID' not in dataset:
-    logger.error("Attempted to send a move at Series level without a SeriesInstanceUID tag")
-    raise InvalidQueryDataset
+  _validate_query_dataset(dataset, query_level, "move")
 
   query_request_context = PatientRootQueryRetrieveInformationModelMove
-  ae = ApplicationEntity(SCU_AE)
-  ae.add_requested_context(query_request_context)
-  assoc = ae.associate(
-    address.ip,
-    address.port,
-    ae_title=address.ae_title
-  )
+  assoc = _open_association(SCU_AE, address, [query_request_context], pool)
 
   successful_send = True
   if assoc.is_established:
     logger.debug("Sending C move")
-    response = assoc.send_c_move(dataset, SCU_AE, query_request_context)
-    for (status, identifier) in response:
-      if status:
-        logger.debug(f"status: {status}")
-        logger.debug(f"identifier: {identifier}")
-      else:
-        logger.error("Failed to complete C-Move")
-        logger.error(f"status: {status}")
-        logger.error(f"identifier: {identifier}")
-        successful_send = False
-    assoc.release()
+    try:
+      response = assoc.send_c_move(dataset, SCU_AE, query_request_context)
+      for (status, identifier) in response:
+        if status:
+          logger.debug(f"status: {status}")
+          logger.debug(f"identifier: {identifier}")
+        else:
+          logger.error("Failed to complete C-Move")
+          logger.error(f"status: {status}")
+          logger.error(f"identifier: {identifier}")
+          successful_send = False
+    finally:
+      _close_association(assoc, pool)
   else:
     error_message = f"""Could not connect to the SCP with the following inputs:
       IP: {address.ip}
@@ -196,7 +588,8 @@ def send_move_thread(SCU_AE: str,
                      address : Address,
                      dataset : Dataset,
                      query_level: QueryLevels= QueryLevels.PATIENT,
-                     daemon: bool = True
+                     daemon: bool = True,
+                     pool: Optional[AssociationPool] = None
   ) -> ThreadWithReturnValue:
   """Creates a thread, that sends a C-Move to the target.
 
@@ -208,10 +601,331 @@ def send_move_thread(SCU_AE: str,
       address (Address): _description_
       dataset (Dataset): _description_
       query_level (QueryLevels, optional): _description_. Defaults to QueryLevels.PATIENT.
+      pool (AssociationPool, optional): Pool to reuse associations from. Defaults to None.
 
   Returns:
       Thread: _description_
   """
-  thread = ThreadWithReturnValue(target=send_move, daemon=daemon, args=(SCU_AE, address, dataset), kwargs={'query_level' : query_level})
+  thread = ThreadWithReturnValue(target=send_move, daemon=daemon, args=(SCU_AE, address, dataset), kwargs={'query_level' : query_level, 'pool' : pool})
   thread.start()
   return thread
+
+_QueryKey = Tuple[str, int, str, str, str, Tuple[Tuple[int, str], ...]]
+
+def _query_key(SCU_AE: str, address: Address, dataset: Dataset, query_level: QueryLevels) -> _QueryKey:
+  query = tuple((int(element.tag), str(element.value)) for element in dataset
+                if element.tag != 0x00080052) # QueryRetrieveLevel is given by query_level
+  return (address.ip, address.port, address.ae_title, SCU_AE, query_level.value, query)
+
+class PendingMove:
+  """Handle to a C-MOVE requested through a MoveCoordinator, shared by all
+  requests which were coalesced into the move."""
+
+  def __init__(self) -> None:
+    self._event = Event()
+    self.success: Optional[bool] = None
+    "If the move succeeded, None while it's in flight"
+    self.finished_at: Optional[float] = None
+
+  def _finish(self, success: bool) -> None:
+    self.success = success
+    self.finished_at = monotonic()
+    self._event.set()
+
+  def done(self) -> bool:
+    return self._event.is_set()
+
+  def wait(self, timeout: Optional[float] = None) -> Optional[bool]:
+    """Blocks until the move is done or the timeout runs out
+
+    Returns:
+        Optional[bool]: If the move succeeded, None if it's still in flight
+    """
+    self._event.wait(timeout)
+    return self.success
+
+
+class MoveCoordinator:
+  """Deduplicates C-MOVEs, such that the same studies are not retrieved more
+  than once from a PACS.
+
+  Requests for the same query to the same address are coalesced: Requests
+  made within window seconds of the first request or while the move is in
+  flight share a single move, and after a successful move the query is
+  considered retrieved for ttl seconds. Failed moves are not cached.
+
+  Args:
+    window (float): Seconds a move is delayed, to collect duplicate requests.
+      Defaults to 0.0
+    ttl (float): Seconds a successful move is cached. Defaults to 300.0
+    pool (Optional[AssociationPool]): Pool to reuse associations from.
+      Defaults to None.
+
+  Example:
+  >>> coordinator = MoveCoordinator(ttl=3600)
+  >>> coordinator.request("SCU_AE", pacs_address, query).wait()
+  True
+  >>> coordinator.request("SCU_AE", pacs_address, query).wait() # No C-MOVE is send
+  True
+  """
+
+  def __init__(self,
+               window: float = 0.0,
+               ttl: float = 300.0,
+               pool: Optional[AssociationPool] = None) -> None:
+    self.window = window
+    self.ttl = ttl
+    self.pool = pool
+    self._lock = Lock()
+    self._moves: Dict[_QueryKey, PendingMove] = {}
+
+  def _is_alive(self, move: PendingMove, now: float) -> bool:
+    if not move.done():
+      return True
+    return bool(move.success) and move.finished_at is not None and now - move.finished_at < self.ttl
+
+  def request(self,
+              SCU_AE: str,
+              address: Address,
+              dataset: Dataset,
+              query_level: QueryLevels = QueryLevels.PATIENT) -> PendingMove:
+    """Requests a C-MOVE, unless an identical move is pending, in flight or
+    was completed within the ttl.
+
+    Args:
+        SCU_AE (str): AE title of the SCU and the destination of the move
+        address (Address): Address of the SCP
+        dataset (Dataset): The query identifier
+        query_level (QueryLevels, optional): Level of the query. Defaults to QueryLevels.PATIENT.
+
+    Returns:
+        PendingMove: The move, that will retrieve the query
+    """
+    key = _query_key(SCU_AE, address, dataset, query_level)
+    with self._lock:
+      now = monotonic()
+      for stale_key in [k for k, move in self._moves.items() if not self._is_alive(move, now)]:
+        del self._moves[stale_key]
+      move = self._moves.get(key)
+      if move is not None:
+        logger.debug(f"Coalesced C-MOVE to {address.ae_title} with a previous request")
+        return move
+      move = PendingMove()
+      self._moves[key] = move
+
+    thread = Timer(self.window, self._execute, args=(move, SCU_AE, address, dataset, query_level))
+    thread.daemon = True
+    thread.start()
+    return move
+
+  def _execute(self,
+               move: PendingMove,
+               SCU_AE: str,
+               address: Address,
+               dataset: Dataset,
+               query_level: QueryLevels) -> None:
+    try:
+      send_move(SCU_AE, address, dataset, query_level=query_level, pool=self.pool)
+    except Exception as exception:
+      logger.error(f"Coordinated C-MOVE to {address.ae_title} failed: {exception.__class__.__name__}")
+      move._finish(False)
+    else:
+      move._finish(True)
+
+  def forget(self, tag: int, value: Any) -> int:
+    """Forgets the completed moves, whose query contains the value at tag,
+    such that they'll be retrieved again. For instance the moves of a patient,
+    which have been processed, as the patient might be send again.
+
+    Args:
+        tag (int): Tag of the query, such as PatientID 0x00100020
+        value (Any): Value of the tag
+
+    Returns:
+        int: Number of moves forgotten
+    """
+    element = (int(tag), str(value))
+    with self._lock:
+      forgotten = [key for key, move in self._moves.items() if move.done() and element in key[5]]
+      for key in forgotten:
+        del self._moves[key]
+    return len(forgotten)
+
+  def clear(self) -> None:
+    """Forgets all completed moves, such that they'll be retrieved again"""
+    with self._lock:
+      self._moves = {key: move for key, move in self._moves.items() if not move.done()}
+
+  def __len__(self) -> int:
+    """Number of tracked moves, both in flight and cached"""
+    with self._lock:
+      return len(self._moves)
+
+
+class FindCache:
+  """Cache of C-FIND results, such that repeated lookups doesn't query the
+  PACS again.
+
+  Results are keyed by the address, the SCU AE, the query level and the query
+  identifier, and expire after ttl seconds. The cached datasets are shared
+  between lookups, so they should not be modified.
+
+  Args:
+    ttl (float): Seconds a result is cached. Defaults to 300.0
+    max_entries (int): Max number of cached results, the least recently used
+      result is evicted first. Defaults to 1024
+
+  Example:
+  >>> cache = FindCache(ttl=600)
+  >>> send_find("SCU_AE", pacs_address, query, QueryLevels.STUDY, cache=cache)
+  >>> send_find("SCU_AE", pacs_address, query, QueryLevels.STUDY, cache=cache) # No C-FIND is send
+  """
+
+  def __init__(self, ttl: float = 300.0, max_entries: int = 1024) -> None:
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self._lock = Lock()
+    self._results: OrderedDict[_QueryKey, Tuple[float, List[Dataset]]] = OrderedDict()
+
+  def get(self, key: _QueryKey) -> Optional[List[Dataset]]:
+    with self._lock:
+      entry = self._results.get(key)
+      if entry is None:
+        return None
+      cached_at, results = entry
+      if monotonic() - cached_at >= self.ttl:
+        del self._results[key]
+        return None
+      self._results.move_to_end(key)
+      return list(results)
+
+  def put(self, key: _QueryKey, results: List[Dataset]) -> None:
+    with self._lock:
+      self._results[key] = (monotonic(), list(results))
+      self._results.move_to_end(key)
+      while len(self._results) > self.max_entries:
+        self._results.popitem(last=False)
+
+  def clear(self) -> None:
+    with self._lock:
+      self._results.clear()
+
+  def __len__(self) -> int:
+    with self._lock:
+      return len(self._results)
+
+
+_FIND_MODELS = {
+  QueryLevels.PATIENT : PatientRootQueryRetrieveInformationModelFind,
+  QueryLevels.STUDY : StudyRootQueryRetrieveInformationModelFind,
+  QueryLevels.SERIES : StudyRootQueryRetrieveInformationModelFind,
+}
+
+_UNIQUE_KEYS = {
+  QueryLevels.PATIENT : 'PatientID',
+  QueryLevels.STUDY : 'StudyInstanceUID',
+  QueryLevels.SERIES : 'SeriesInstanceUID',
+}
+
+def _prepare_find_dataset(dataset: Dataset, query_level: QueryLevels) -> None:
+  if "QueryRetrieveLevel" not in dataset:
+    dataset.QueryRetrieveLevel = query_level.value
+
+  if query_level == QueryLevels.SERIES and not dataset.get('StudyInstanceUID'):
+    logger.error("Attempted to send a find at Series level without a StudyInstanceUID tag")
+    raise InvalidQueryDataset
+
+  # The unique key of the level should always be returned
+  unique_key = _UNIQUE_KEYS[query_level]
+  if unique_key not in dataset:
+    setattr(dataset, unique_key, '')
+
+def add_return_keys(dataset: Dataset, tags: Iterable[int]) -> Dataset:
+  """Adds empty elements to a query dataset, such that the matches contain
+  the values of the tags.
+
+  Args:
+      dataset (Dataset): The query dataset, which is modified
+      tags (Iterable[int]): Tags to be returned
+
+  Returns:
+      Dataset: The query dataset
+  """
+  for tag in tags:
+    if tag not in dataset:
+      dataset.add_new(tag, dictionary_VR(tag), None)
+  return dataset
+
+def send_find(SCU_AE: str,
+              address: Address,
+              dataset: Dataset,
+              query_level: QueryLevels = QueryLevels.PATIENT,
+              pool: Optional[AssociationPool] = None,
+              cache: Optional[FindCache] = None
+  ) -> List[Dataset]:
+  """Sends a C-FIND to the address and collects the matches
+
+  Patient level queries use the Patient Root information model, study and
+  series level queries use the Study Root information model. The unique key
+  of the query level is added as a return key, if it's missing. Use
+  add_return_keys to request additional attributes of the matches.
+
+  Args:
+      SCU_AE (str): AE title of the SCU
+      address (Address): Address of the SCP
+      dataset (Dataset): The query identifier
+      query_level (QueryLevels, optional): Level of the query. Defaults to QueryLevels.PATIENT.
+      pool (Optional[AssociationPool], optional): Pool to reuse associations from. Defaults to None.
+      cache (Optional[FindCache], optional): Cache of previous results. Defaults to None.
+
+  Raises:
+      InvalidQueryDataset: If a series level query is missing a StudyInstanceUID
+      CouldNotCompleteDIMSEMessage: If the SCP is unreachable or the C-FIND fails
+
+  Returns:
+      List[Dataset]: The identifiers of the matches
+
+  Example:
+  >>> query = Dataset()
+  >>> query.PatientID = "1234567890"
+  >>> studies = send_find("SCU_AE", pacs_address, query, QueryLevels.STUDY)
+  >>> [study.StudyInstanceUID for study in studies]
+  ['1.2.3.4', '1.2.3.5']
+  """
+  _prepare_find_dataset(dataset, query_level)
+
+  key = _query_key(SCU_AE, address, dataset, query_level)
+  if cache is not None:
+    cached_matches = cache.get(key)
+    if cached_matches is not None:
+      logger.debug(f"C-FIND to {address.ae_title} answered from cache")
+      return cached_matches
+
+  query_request_context = _FIND_MODELS[query_level]
+  assoc = _open_association(SCU_AE, address, [query_request_context], pool)
+  if not assoc.is_established:
+    error_message = f"""Could not connect to the SCP with the following inputs:
+      IP: {address.ip}
+      Port: {address.port}
+      SCP AE: {address.ae_title}
+      SCU AE: {SCU_AE}
+    """
+    logger.error(error_message)
+    raise CouldNotCompleteDIMSEMessage("Could not connect")
+
+  matches: List[Dataset] = []
+  try:
+    for (status, identifier) in assoc.send_c_find(dataset, query_request_context):
+      if not status:
+        raise CouldNotCompleteDIMSEMessage("Connection lost during C-FIND")
+      if status.Status in (0xFF00, 0xFF01): # Pending
+        matches.append(identifier)
+      elif status.Status != 0x0000:
+        logger.error(f"Failed to complete C-FIND with status: {hex(status.Status)}")
+        raise CouldNotCompleteDIMSEMessage("C-FIND failed")
+  finally:
+    _close_association(assoc, pool)
+
+  if cache is not None:
+    cache.put(key, matches)
+  return matches
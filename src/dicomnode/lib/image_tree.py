@@ -34,17 +34,24 @@ class IdentityMapping():
     * SeriesInstanceUID
     * StudyInstanceUID
     * PatientID (Not that's relevant)
+
+  Args:
+    prefix_size (int): Minimum number of digits in anonymized patient numbers
+    uid_generator (Callable[[], UID]): Function producing the mapped UIDs,
+      pass a UIDGenerator with a fixed root for deterministic mappings.
+      Defaults to gen_uid
   """
   #This class is here instead of lib.anonymization to
   #prevent circular imports, for typings sake.
   #  Note to the Note: It might be possible to resolve it with a type hint
   #  'dicomnode.lib.studyTree.DicomTree'
-  def __init__(self, prefix_size = 4) -> None:
+  def __init__(self, prefix_size = 4, uid_generator: Callable[[], UID] = gen_uid) -> None:
     self.StudyUIDMapping : Dict[str, UID] = {}
     self.SeriesUIDMapping : Dict[str, UID] = {}
     self.SOP_UIDMapping : Dict[str, UID] = {}
     self.PatientMapping : Dict[str, str] = {}
     self.prefix_size = prefix_size
+    self.uid_generator = uid_generator
 
   def __contains__(self, key: str) -> bool:
     return key in self.StudyUIDMapping \
@@ -56,7 +63,7 @@ class IdentityMapping():
     if uid in mapping:
       return mapping[uid]
     else:
-      mapping[uid] = gen_uid() # Well Here we include some clever prefix
+      mapping[uid] = self.uid_generator()
       return mapping[uid]
 
   def add_StudyUID(self, StudyInstanceUID : UID) -> UID:
@@ -203,7 +210,7 @@ class ImageTreeInterface(ABC):
         dataset = load_dicom(path)
         mem = virtual_memory()
         if mem.available < 100*1024*1024: # This should be moved into a constants file
-          print("Limited Memory available") #pragma: no cover
+          logger.warning("Limited Memory available") #pragma: no cover
         self.add_image(dataset)
       except InvalidDicomError as E:
         logger.error(f"Attempting to load a none dicom file at: {path}")
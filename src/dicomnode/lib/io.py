@@ -4,6 +4,7 @@ __author__ = "Christoffer Vilstrup Jensen"
 
 # Python Standard Library
 from argparse import Namespace
+from datetime import datetime
 from pathlib import Path
 import os
 from typing import Dict, Optional, Tuple, Type, Union
@@ -139,6 +140,9 @@ def load_private_tags_from_args(
 class TemporaryWorkingDirectory():
   """Creating a temporary directory for work to be done in
 
+  Note that the working directory is shared by all threads, so this is not
+  thread safe, consider JobDirectory instead.
+
   Args:
     path_to_new_dir (Path | str) - path to the directory to be created
 
@@ -168,3 +172,57 @@ class TemporaryWorkingDirectory():
   def __exit__(self, exc_type: Type[Exception], exc_val: Exception, exc_tb):
     os.chdir(self.__cwd)
     shutil.rmtree(self.temp_directory_path)
+
+
+class JobDirectory():
+  """Creates a scratch directory for a job, without changing the current
+  working directory, which is shared by all threads of the process.
+  Use the path attribute rather than relative paths.
+
+  The directory is removed upon exit. If the job failed, that is the block
+  raised or mark_failed was called, and retain_on_failure is set, it's kept
+  and renamed to <name>_failed_<timestamp> for inspection, freeing the path
+  for the next job.
+
+  Args:
+    base_directory (Path | str) - directory where the job directory is
+      created, consider a tmpfs mount such as /dev/shm for I/O heavy jobs.
+    name (str) - name of the job directory
+    retain_on_failure (bool) - Keep the directory of failed jobs. Defaults to
+      False
+
+  Example:
+  >>>with JobDirectory("/tmp/jobs", "1502799995") as job_directory:
+  >>>  job_directory.path
+  /tmp/jobs/1502799995
+  >>>os.getcwd()
+  current/working/directory
+  """
+
+  def __init__(self,
+               base_directory: Union[Path,str],
+               name: str,
+               retain_on_failure: bool = False) -> None:
+    self.path = Path(base_directory) / name
+    self.retain_on_failure = retain_on_failure
+    self.failed = False
+    self.retained_path: Optional[Path] = None
+    "Path of the retained directory of a failed job"
+
+  def mark_failed(self) -> None:
+    """Marks the job as failed, for jobs that handles their own exceptions"""
+    self.failed = True
+
+  def __enter__(self):
+    self.path.mkdir(parents=True, exist_ok=True)
+    return self
+
+  def __exit__(self, exc_type: Optional[Type[BaseException]], exc_val, exc_tb):
+    if exc_type is not None:
+      self.failed = True
+    if self.failed and self.retain_on_failure:
+      timestamp = datetime.now().strftime("%Y%m%d%H%M%S%f")
+      self.retained_path = self.path.with_name(f"{self.path.name}_failed_{timestamp}")
+      os.replace(self.path, self.retained_path)
+    else:
+      shutil.rmtree(self.path, ignore_errors=True)
@@ -9,7 +9,7 @@ __author__ = "Christoffer Vilstrup Jensen"
 # Python Standard Library
 from pathlib import Path
 import operator
-from typing import Callable
+from typing import Callable, Optional
 
 # Thrid Party Operator
 from pydicom import Dataset
@@ -21,14 +21,27 @@ class LazyDataset(Dataset): # It's not need to set this as a dataset, since we o
   _wrapped = None
   _is_init = False
 
-  def __init__(self, path):
+  def __init__(self, path: Optional[Path] = None, loader: Optional[Callable[[], Dataset]] = None):
+    """Creates a dataset loaded on first use, either from path or by loader,
+    for datasets not stored as files, see dicomnode.lib.storage"""
     # Assign using __dict__ to avoid the setattr method.
     self.__dict__['_path'] = path
+    self.__dict__['_loader'] = loader
 
   def _setup(self):
-    self._wrapped = load_dicom(self._path)
+    if self._loader is not None:
+      self._wrapped = self._loader()
+    else:
+      self._wrapped = load_dicom(self._path)
     self._is_init = True
 
+  def __reduce_ex__(self, protocol):
+    # Pickles the loaded dataset, as the loader might be a closure and the
+    # stored dataset might be removed before the pickle is loaded
+    if not self._is_init:
+      self._setup()
+    return self._wrapped.__reduce_ex__(protocol) # type: ignore
+
   def new_method_proxy(func): # type: ignore # Dont call this method...
     """
       Util function to help us route functions
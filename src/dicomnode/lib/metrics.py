@@ -0,0 +1,363 @@
+"""Instrumentation of dicomnode.
+
+The library reports counters, gauges and latencies to a global metrics sink,
+much like the logger. By default the sink is a NullSink, which discards
+everything. Use set_metrics with an InMemoryMetrics to collect the metrics,
+and a MetricsServer to expose them to Prometheus.
+
+Reported metrics:
+  * `dicomnode_images_received_total` - Counter of C-STOREs handled
+  * `dicomnode_bytes_received_total` - Counter of bytes received by C-STOREs
+  * `dicomnode_stage_seconds{stage}` - Histogram of latencies of the stages:
+    c_store, filter, add_image, validate, header, process and dispatch
+  * `dicomnode_grind_seconds{input}` - Histogram of grinding latencies per input
+  * `dicomnode_output_seconds{destination}` - Histogram of DIMSE send latencies
+  * `dicomnode_tree_images`, `dicomnode_tree_patients`, `dicomnode_tree_bytes`
+    - Gauges of the size of the PipelineTree
+  * `dicomnode_spilled_patients_total` - Counter of patients spilled to disk
+    to stay within the memory budget
+  * `dicomnode_duplicate_images_total` - Counter of received images skipped,
+    as an identical image was in the PipelineTree already
+  * `dicomnode_queue_depth` - Gauge of the process queue of queued pipelines
+  * `dicomnode_coalesced_releases_total` - Counter of releases coalesced into
+    a pending processing job, see completion_quiet_period
+  * `dicomnode_folded_triggers_total` - Counter of processing triggers folded
+    into a rerun, as the patient was already being processed
+
+Rates such as images/s are derived from the counters, for instance with
+Prometheus' rate function.
+"""
+
+__author__ = "Christoffer Vilstrup Jensen"
+
+# Python Standard Library
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import perf_counter
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Dicomnode packages
+from dicomnode.lib.logging import get_logger
+
+logger = get_logger()
+
+Labels = Optional[Dict[str, str]]
+_MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+DEFAULT_BUCKETS: Tuple[float, ...] = (
+  0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0
+)
+"Upper bounds in seconds of the latency histograms"
+
+class MetricsSink(ABC):
+  """Base class for destinations of metrics.
+
+  Subclass it to forward metrics to another monitoring system.
+  """
+
+  @abstractmethod
+  def increment(self, name: str, amount: float = 1.0, labels: Labels = None) -> None:
+    """Increases the counter name by amount"""
+    raise NotImplementedError # pragma: no cover
+
+  @abstractmethod
+  def set_gauge(self, name: str, value: float, labels: Labels = None) -> None:
+    """Sets the gauge name to value"""
+    raise NotImplementedError # pragma: no cover
+
+  @abstractmethod
+  def observe(self, name: str, value: float, labels: Labels = None) -> None:
+    """Records value in the histogram name"""
+    raise NotImplementedError # pragma: no cover
+
+  @contextmanager
+  def time(self, name: str, labels: Labels = None) -> Iterator[None]:
+    """Context manager, that observes the seconds spent inside it in the
+    histogram name. Time is observed even if an exception is raised.
+
+    Example:
+    >>> with get_metrics().time("dicomnode_stage_seconds", {"stage" : "process"}):
+    ...   result = process(input_container)
+    """
+    start = perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(name, perf_counter() - start, labels)
+
+
+class NullSink(MetricsSink):
+  """Sink that discards all metrics"""
+
+  def increment(self, name: str, amount: float = 1.0, labels: Labels = None) -> None:
+    pass
+
+  def set_gauge(self, name: str, value: float, labels: Labels = None) -> None:
+    pass
+
+  def observe(self, name: str, value: float, labels: Labels = None) -> None:
+    pass
+
+  @contextmanager
+  def time(self, name: str, labels: Labels = None) -> Iterator[None]:
+    yield
+
+
+class _Histogram:
+  def __init__(self, buckets: Tuple[float, ...]) -> None:
+    self.buckets = buckets
+    self.counts = [0 for _ in range(len(buckets) + 1)] # Last one is +Inf
+    self.count = 0
+    self.sum = 0.0
+
+  def observe(self, value: float) -> None:
+    self.counts[bisect_left(self.buckets, value)] += 1
+    self.count += 1
+    self.sum += value
+
+
+def _escape(value: str) -> str:
+  return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...], extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+  all_labels = labels + extra
+  if not all_labels:
+    return ""
+  formatted = ",".join(f'{key}="{_escape(value)}"' for key, value in all_labels)
+  return "{" + formatted + "}"
+
+def _format_float(value: float) -> str:
+  if value == float('inf'):
+    return "+Inf"
+  return repr(float(value))
+
+
+@dataclass
+class MetricsSnapshot:
+  """Copy of the metrics of an InMemoryMetrics, see InMemoryMetrics.snapshot"""
+  buckets: Tuple[float, ...]
+  counters: Dict[_MetricKey, float]
+  gauges: Dict[_MetricKey, float]
+  histograms: Dict[_MetricKey, Tuple[List[int], int, float]]
+  "Bucket counts, number of observations and their sum"
+
+
+class InMemoryMetrics(MetricsSink):
+  """Thread safe sink, that keeps the metrics in memory and can render them in
+  the Prometheus text format.
+
+  Args:
+    buckets (Tuple[float, ...]): Upper bounds of histogram buckets.
+      Defaults to DEFAULT_BUCKETS.
+  """
+
+  def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+    self.buckets = tuple(sorted(buckets))
+    self._lock = Lock()
+    self._counters: Dict[_MetricKey, float] = {}
+    self._gauges: Dict[_MetricKey, float] = {}
+    self._histograms: Dict[_MetricKey, _Histogram] = {}
+
+  @staticmethod
+  def _key(name: str, labels: Labels) -> _MetricKey:
+    if labels is None:
+      return (name, ())
+    return (name, tuple(sorted(labels.items())))
+
+  def increment(self, name: str, amount: float = 1.0, labels: Labels = None) -> None:
+    key = self._key(name, labels)
+    with self._lock:
+      self._counters[key] = self._counters.get(key, 0.0) + amount
+
+  def set_gauge(self, name: str, value: float, labels: Labels = None) -> None:
+    key = self._key(name, labels)
+    with self._lock:
+      self._gauges[key] = value
+
+  def observe(self, name: str, value: float, labels: Labels = None) -> None:
+    key = self._key(name, labels)
+    with self._lock:
+      histogram = self._histograms.get(key)
+      if histogram is None:
+        histogram = _Histogram(self.buckets)
+        self._histograms[key] = histogram
+      histogram.observe(value)
+
+  def counter(self, name: str, labels: Labels = None) -> float:
+    """Current value of a counter, 0.0 if it's never been incremented"""
+    with self._lock:
+      return self._counters.get(self._key(name, labels), 0.0)
+
+  def gauge(self, name: str, labels: Labels = None) -> Optional[float]:
+    """Current value of a gauge, None if it's never been set"""
+    with self._lock:
+      return self._gauges.get(self._key(name, labels))
+
+  def histogram(self, name: str, labels: Labels = None) -> Tuple[int, float]:
+    """Number of observations and their sum in a histogram"""
+    with self._lock:
+      histogram = self._histograms.get(self._key(name, labels))
+      if histogram is None:
+        return 0, 0.0
+      return histogram.count, histogram.sum
+
+  def snapshot(self) -> MetricsSnapshot:
+    """Copies the current metrics into plain picklable data, such that they
+    can be send to another process and merged there.
+
+    Returns:
+        MetricsSnapshot: Buckets, counters, gauges and histograms
+    """
+    with self._lock:
+      return MetricsSnapshot(
+        self.buckets,
+        dict(self._counters),
+        dict(self._gauges),
+        {key : (list(histogram.counts), histogram.count, histogram.sum)
+         for key, histogram in self._histograms.items()}
+      )
+
+  def merge(self, snapshot: MetricsSnapshot) -> None:
+    """Adds the metrics of a snapshot to these metrics. Counters and
+    histograms are added, gauges are summed, as the snapshots are expected to
+    be from disjoint parts of a node, such as the shards of a ShardedPipeline.
+
+    Args:
+        snapshot (MetricsSnapshot): Metrics to be added
+
+    Raises:
+        ValueError: If the histogram buckets differ
+    """
+    if snapshot.buckets != self.buckets:
+      raise ValueError("Cannot merge metrics with different histogram buckets")
+    with self._lock:
+      for key, value in snapshot.counters.items():
+        self._counters[key] = self._counters.get(key, 0.0) + value
+      for key, value in snapshot.gauges.items():
+        self._gauges[key] = self._gauges.get(key, 0.0) + value
+      for key, (counts, count, total) in snapshot.histograms.items():
+        histogram = self._histograms.get(key)
+        if histogram is None:
+          histogram = _Histogram(self.buckets)
+          self._histograms[key] = histogram
+        histogram.counts = [mine + theirs for mine, theirs in zip(histogram.counts, counts)]
+        histogram.count += count
+        histogram.sum += total
+
+  def render(self) -> str:
+    """Renders all metrics in the Prometheus text exposition format
+
+    Returns:
+        str: The metrics, one sample per line
+    """
+    lines: List[str] = []
+    with self._lock:
+      for metric_type, metrics in (("counter", self._counters), ("gauge", self._gauges)):
+        typed = set()
+        for (name, labels), value in sorted(metrics.items()):
+          if name not in typed:
+            lines.append(f"# TYPE {name} {metric_type}")
+            typed.add(name)
+          lines.append(f"{name}{_format_labels(labels)} {_format_float(value)}")
+
+      typed = set()
+      for (name, labels), histogram in sorted(self._histograms.items(), key=lambda item: item[0]):
+        if name not in typed:
+          lines.append(f"# TYPE {name} histogram")
+          typed.add(name)
+        cumulative = 0
+        for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+          cumulative += count
+          lines.append(f"{name}_bucket{_format_labels(labels, (('le', _format_float(bound)),))} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {_format_float(histogram.sum)}")
+        lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+  """HTTP server exposing an InMemoryMetrics at /metrics in the Prometheus
+  text format.
+
+  Args:
+    metrics (InMemoryMetrics): The metrics to expose
+    ip (str): IP to bind to. Defaults to "localhost"
+    port (int): Port to bind to, 0 picks a free port. Defaults to 0
+
+  Example:
+  >>> server = MetricsServer(metrics, port=9100)
+  >>> server.start()
+  >>> # curl localhost:9100/metrics
+  >>> server.stop()
+  """
+
+  def __init__(self, metrics: InMemoryMetrics, ip: str = "localhost", port: int = 0) -> None:
+    self.metrics = metrics
+    self.ip = ip
+    self._requested_port = port
+    self._server: Optional[ThreadingHTTPServer] = None
+    self._thread: Optional[Thread] = None
+
+  @property
+  def port(self) -> int:
+    """Port the server is listening on"""
+    if self._server is None:
+      return self._requested_port
+    return self._server.server_address[1]
+
+  def start(self) -> None:
+    metrics = self.metrics
+
+    class Handler(BaseHTTPRequestHandler):
+      def do_GET(self):
+        if self.path.split('?')[0] != "/metrics":
+          self.send_error(404)
+          return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, format, *args):
+        pass # Scrapes should not flood the log
+
+    self._server = ThreadingHTTPServer((self.ip, self._requested_port), Handler)
+    self._server.daemon_threads = True
+    self._thread = Thread(target=self._server.serve_forever, name="MetricsServer", daemon=True)
+    self._thread.start()
+    logger.info(f"Serving metrics at http://{self.ip}:{self.port}/metrics")
+
+  def stop(self) -> None:
+    if self._server is not None:
+      self._server.shutdown()
+      self._server.server_close()
+      self._server = None
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+
+
+__metrics: MetricsSink = NullSink()
+
+def get_metrics() -> MetricsSink:
+  """Gets the global metrics sink"""
+  return __metrics
+
+def set_metrics(sink: MetricsSink) -> MetricsSink:
+  """Replaces the global metrics sink
+
+  Args:
+      sink (MetricsSink): The new sink
+
+  Returns:
+      MetricsSink: The sink that was replaced
+  """
+  global __metrics
+  old_sink = __metrics
+  __metrics = sink
+  return old_sink
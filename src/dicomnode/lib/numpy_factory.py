@@ -4,7 +4,7 @@ numpy arrays
 """
 
 # Python Standard Library
-from typing import Dict, List, Union, Tuple, Any, Optional, Callable, Iterator
+from typing import Dict, Iterable, List, Union, Tuple, Any, Optional, Callable, Iterator
 
 # Third party packages
 import numpy
@@ -145,39 +145,81 @@ class NumpyFactory(DicomFactory):
     if target_datatype is None:
       raise IncorrectlyConfigured("There's no target Datatype") # pragma: no cover this might happen, if people are stupid
 
-    encode = image.dtype != target_datatype
     list_dicom = []
     if len(image.shape) == 3:
       logger.debug(f"Building dicom series of images {image.shape[0]} of dimension: {image.shape[2]}x{image.shape[1]} ")
       for i, slice in enumerate(image):
-        instance_environment = InstanceEnvironment(
-          instance_number= i + 1,
-          factory=self,
-          image=slice,
-          total_images = image.shape[0],
-        )
-
-        # Encoding is done per slice basis
-        if encode:
-          scaled_slice, slope, intercept = self.scale_image(slice)
-          instance_environment.scaled_image = scaled_slice
-          instance_environment.slope = slope
-          instance_environment.intercept = intercept
-
-        dataset = Dataset()
-        for element in header:
-          if isinstance(element, DataElement):
-            dataset.add(element)
-          elif isinstance(element, InstanceVirtualElement):
-            data_element = element.produce(instance_environment)
-            if data_element is not None:
-              dataset.add(data_element)
-        make_meta(dataset)
-        list_dicom.append(dataset)
+        list_dicom.append(self._build_instance(header, slice, i + 1, image.shape[0]))
     else:
       raise IncorrectlyConfigured("3 dimensional images are only supported") # pragma: no cover
     return list_dicom
 
+  def build_from_slabs(self,
+                       header: SeriesHeader,
+                       slabs: Iterable[ndarray],
+                       total_images: Optional[int] = None) -> Iterator[Dataset]:
+    """Constructs a dicom series from slabs of consecutive slices, such as
+    the images of the slabs of a SlabGrinder. The datasets are built as
+    they're consumed, so neither the image nor the series is held in memory
+    at once.
+
+    The returned iterator can only be consumed once, so the output cannot be
+    persisted in an outbox or send to more than one destination, which a
+    DicomOutput refuses with IncorrectlyConfigured.
+
+    Args:
+        header (SeriesHeader): Header of the series
+        slabs (Iterable[ndarray]): Slabs with the shape (slices, rows, columns)
+        total_images (Optional[int]): Number of slices in the series, if
+          known. Defaults to None.
+
+    Raises:
+        IncorrectlyConfigured: If a slab is not 3 dimensional
+
+    Yields:
+        Dataset: The datasets of the series in order
+    """
+    if self._unsigned_array_encoding.get(self.bits_allocated, None) is None:
+      raise IncorrectlyConfigured("There's no target Datatype") # pragma: no cover
+
+    instance_number = 1
+    for slab in slabs:
+      if len(slab.shape) != 3:
+        raise IncorrectlyConfigured("3 dimensional slabs are only supported")
+      for slice in slab:
+        yield self._build_instance(header, slice, instance_number, total_images)
+        instance_number += 1
+
+  def _build_instance(self,
+                      header: SeriesHeader,
+                      slice: ndarray,
+                      instance_number: int,
+                      total_images: Optional[int]) -> Dataset:
+    instance_environment = InstanceEnvironment(
+      instance_number=instance_number,
+      factory=self,
+      image=slice,
+      total_images=total_images,
+    )
+
+    # Encoding is done per slice basis
+    if slice.dtype != self._unsigned_array_encoding.get(self.bits_allocated, None):
+      scaled_slice, slope, intercept = self.scale_image(slice)
+      instance_environment.scaled_image = scaled_slice
+      instance_environment.slope = slope
+      instance_environment.intercept = intercept
+
+    dataset = Dataset()
+    for element in header:
+      if isinstance(element, DataElement):
+        dataset.add(element)
+      elif isinstance(element, InstanceVirtualElement):
+        data_element = element.produce(instance_environment)
+        if data_element is not None:
+          dataset.add(data_element)
+    make_meta(dataset)
+    return dataset
+
 def _get_image(instance_environment: InstanceEnvironment) -> ndarray:
   if instance_environment.scaled_image is not None:
     image = instance_environment.scaled_image
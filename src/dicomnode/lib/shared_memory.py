@@ -0,0 +1,134 @@
+"""Numpy arrays in shared memory, which can be handed to other processes
+without copying them.
+
+A SharedArray is a handle of an array in a shared memory block. Pickling the
+handle, for instance when submitting it to a ProcessPoolExecutor, only sends
+the name, shape and dtype of the block, and the receiving process maps the
+same memory with SharedArray.attach.
+
+The process creating the array owns the block. It's reference counted in the
+owning process, and the block is unlinked when the last reference is
+released.
+"""
+
+__author__ = "Christoffer Vilstrup Jensen"
+
+# Python Standard Library
+from multiprocessing.shared_memory import SharedMemory
+import os
+from threading import Lock
+from typing import Any, Dict, Optional, Tuple
+
+# Third party Packages
+import numpy
+
+# Dicomnode packages
+from dicomnode.lib.logging import get_logger
+
+logger = get_logger()
+
+class SharedArray:
+  """Handle of a numpy array in shared memory, see SharedArray.from_array.
+
+  Args:
+      name (str): Name of the shared memory block
+      shape (Tuple[int, ...]): Shape of the array
+      dtype (str): dtype of the array
+      owner_pid (int): pid of the process owning the block
+
+  Example:
+  >>> shared = SharedArray.from_array(volume)
+  >>> future = executor.submit(segment, shared) # Sends the name, not the data
+  >>> mask = future.result()
+  >>> shared.release()
+  """
+  def __init__(self, name: str, shape: Tuple[int, ...], dtype: str, owner_pid: int) -> None:
+    self.name = name
+    self.shape = shape
+    self.dtype = dtype
+    self.owner_pid = owner_pid
+    self._lock = Lock()
+    self._references = 0
+    self._shared_memory: Optional[SharedMemory] = None
+    self._array: Optional[numpy.ndarray] = None
+
+  @classmethod
+  def from_array(cls, array: numpy.ndarray) -> 'SharedArray':
+    """Copies an array into a new shared memory block, holding one reference
+
+    Args:
+        array (numpy.ndarray): The array to be shared
+
+    Returns:
+        SharedArray: Handle of the shared copy
+    """
+    shared_memory = SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared_array = cls(shared_memory.name, array.shape, array.dtype.str, os.getpid())
+    shared_array._shared_memory = shared_memory
+    shared_array._references = 1
+    shared_array.attach()[...] = array
+    return shared_array
+
+  @property
+  def nbytes(self) -> int:
+    return int(numpy.prod(self.shape, dtype=numpy.int64)) * numpy.dtype(self.dtype).itemsize
+
+  def attach(self) -> numpy.ndarray:
+    """Gets the array, mapping the block into this process if needed. Writes
+    to the array are seen by every process.
+
+    Raises:
+        FileNotFoundError: If the block have been released by the owner
+
+    Returns:
+        numpy.ndarray: Array backed by the shared memory
+    """
+    with self._lock:
+      if self._array is None:
+        if self._shared_memory is None:
+          self._shared_memory = SharedMemory(name=self.name)
+        self._array = numpy.ndarray(self.shape, dtype=self.dtype, buffer=self._shared_memory.buf)
+      return self._array
+
+  def acquire(self) -> 'SharedArray':
+    """Adds a reference to the block, which must be released again. Only the
+    owning process counts references."""
+    with self._lock:
+      self._references += 1
+    return self
+
+  def release(self) -> None:
+    """Releases a reference. In the owning process the block is unlinked once
+    the last reference is released, other processes unmap the block."""
+    with self._lock:
+      if self.owner_pid == os.getpid():
+        self._references -= 1
+        if 0 < self._references:
+          return
+      self._close()
+      if self.owner_pid == os.getpid() and self._shared_memory is not None:
+        self._shared_memory.unlink()
+      self._shared_memory = None
+
+  def _close(self) -> None:
+    self._array = None
+    if self._shared_memory is not None:
+      try:
+        self._shared_memory.close()
+      except BufferError:
+        # Views of the array are alive, the mapping is freed with them
+        logger.debug(f"Views of shared array {self.name} outlive its release")
+
+  def __getstate__(self) -> Dict[str, Any]:
+    return {
+      "name" : self.name,
+      "shape" : self.shape,
+      "dtype" : self.dtype,
+      "owner_pid" : self.owner_pid,
+    }
+
+  def __setstate__(self, state: Dict[str, Any]) -> None:
+    self.__init__(state["name"], state["shape"], state["dtype"], state["owner_pid"]) # type: ignore
+
+  def __repr__(self) -> str:
+    return f"SharedArray({self.name}, shape={self.shape}, dtype={self.dtype})"
@@ -0,0 +1,342 @@
+"""Storage backends for the datasets received by a node.
+
+A DatasetStore holds the datasets of a patient under '/' separated keys, such
+as `input/image_1.dcm`. Inputs get a scoped view of the patient's store, see
+DatasetStore.scope, so they only see their own datasets.
+
+Backends:
+  * FileStore - A file per dataset, with the key as relative path. This is
+    the default and the layout used by earlier versions.
+  * SegmentStore - A single append-only segment file per patient, avoiding
+    the inode and directory overhead of many small files.
+  * MemoryStore - Keeps the datasets in memory, for deployments without
+    persistence and for testing.
+"""
+
+__author__ = "Christoffer Vilstrup Jensen"
+
+# Python Standard Library
+from abc import ABC, abstractmethod
+from io import BytesIO
+import os
+from pathlib import Path
+import shutil
+import struct
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+# Third party Packages
+from pydicom import Dataset, dcmread
+
+# Dicomnode packages
+from dicomnode.lib.io import load_dicom, save_dicom
+from dicomnode.lib.lazy_dataset import LazyDataset
+from dicomnode.lib.logging import get_logger
+
+logger = get_logger()
+
+def _join(prefix: str, key: str) -> str:
+  if prefix == "":
+    return key
+  if key == "":
+    return prefix
+  return f"{prefix}/{key}"
+
+def _serialize(dataset: Dataset) -> bytes:
+  buffer = BytesIO()
+  dataset.save_as(buffer, write_like_original=False)
+  return buffer.getvalue()
+
+
+class DatasetStore(ABC):
+  """Interface of the storage of the datasets of a patient."""
+
+  persistent: bool = True
+  """If the datasets survive a restart, and putting a dataset in the store
+  frees the memory it uses"""
+
+  @property
+  def directory(self) -> Optional[Path]:
+    """Directory with the datasets as files, None if the store doesn't
+    store the datasets as individual files"""
+    return None
+
+  @abstractmethod
+  def put(self, key: str, dataset: Dataset) -> None:
+    """Stores a dataset. If the key is already stored, nothing happens.
+
+    Args:
+        key (str): Key of the dataset
+        dataset (Dataset): The dataset, must have file meta information
+    """
+    raise NotImplementedError # pragma: no cover
+
+  @abstractmethod
+  def get(self, key: str) -> Dataset:
+    """Loads a dataset
+
+    Raises:
+        KeyError: If the key is not stored
+    """
+    raise NotImplementedError # pragma: no cover
+
+  @abstractmethod
+  def __contains__(self, key: str) -> bool:
+    raise NotImplementedError # pragma: no cover
+
+  @abstractmethod
+  def keys(self, prefix: str = "") -> List[str]:
+    """Lists the stored keys under a prefix
+
+    Args:
+        prefix (str, optional): Only keys under this prefix are listed.
+          Defaults to "", which is every key.
+
+    Returns:
+        List[str]: Sorted keys relative to prefix
+    """
+    raise NotImplementedError # pragma: no cover
+
+  @abstractmethod
+  def remove(self, key: str) -> None:
+    """Removes a dataset, if it's stored"""
+    raise NotImplementedError # pragma: no cover
+
+  @abstractmethod
+  def clear(self) -> None:
+    """Removes every dataset in the store"""
+    raise NotImplementedError # pragma: no cover
+
+  def lazy(self, key: str) -> LazyDataset:
+    """Gets a LazyDataset, which loads the stored dataset on first use"""
+    return LazyDataset(loader=lambda: self.get(key))
+
+  def scope(self, prefix: str) -> 'DatasetStore':
+    """Gets a view of the store, where keys are relative to prefix"""
+    return ScopedStore(self, prefix)
+
+
+class ScopedStore(DatasetStore):
+  """View of the keys under a prefix of another store"""
+  def __init__(self, store: DatasetStore, prefix: str) -> None:
+    self.store = store
+    self.prefix = prefix
+    self.persistent = store.persistent
+
+  def put(self, key: str, dataset: Dataset) -> None:
+    self.store.put(_join(self.prefix, key), dataset)
+
+  def get(self, key: str) -> Dataset:
+    return self.store.get(_join(self.prefix, key))
+
+  def __contains__(self, key: str) -> bool:
+    return _join(self.prefix, key) in self.store
+
+  def keys(self, prefix: str = "") -> List[str]:
+    return self.store.keys(_join(self.prefix, prefix))
+
+  def remove(self, key: str) -> None:
+    self.store.remove(_join(self.prefix, key))
+
+  def clear(self) -> None:
+    for key in self.keys():
+      self.remove(key)
+
+  def lazy(self, key: str) -> LazyDataset:
+    return self.store.lazy(_join(self.prefix, key))
+
+  def scope(self, prefix: str) -> DatasetStore:
+    return self.store.scope(_join(self.prefix, prefix))
+
+
+class FileStore(DatasetStore):
+  """Stores each dataset as a file, with the key as path relative to the
+  directory.
+
+  Args:
+      directory (Path): Directory of the datasets, created if missing
+  """
+  def __init__(self, directory: Path) -> None:
+    self._directory = Path(directory)
+    self._directory.mkdir(parents=True, exist_ok=True)
+
+  @property
+  def directory(self) -> Optional[Path]:
+    return self._directory
+
+  def put(self, key: str, dataset: Dataset) -> None:
+    path = self._directory / key
+    if not path.exists():
+      save_dicom(path, dataset)
+
+  def get(self, key: str) -> Dataset:
+    path = self._directory / key
+    if not path.is_file():
+      raise KeyError(key)
+    return load_dicom(path)
+
+  def __contains__(self, key: str) -> bool:
+    return (self._directory / key).is_file()
+
+  def keys(self, prefix: str = "") -> List[str]:
+    root = self._directory / prefix
+    if not root.is_dir():
+      return []
+    return sorted(path.relative_to(root).as_posix() for path in root.rglob("*") if path.is_file())
+
+  def remove(self, key: str) -> None:
+    (self._directory / key).unlink(missing_ok=True)
+
+  def clear(self) -> None:
+    if not self._directory.exists():
+      return
+    for path in self._directory.iterdir():
+      if path.is_dir():
+        shutil.rmtree(path)
+      else:
+        path.unlink()
+
+  def lazy(self, key: str) -> LazyDataset:
+    return LazyDataset(self._directory / key)
+
+  def scope(self, prefix: str) -> DatasetStore:
+    return FileStore(self._directory / prefix)
+
+
+class SegmentStore(DatasetStore):
+  """Stores the datasets in a single append-only segment file.
+
+  Each record in the segment is a header followed by the key and the encoded
+  dataset. The index of the records is held in memory and is rebuilt by
+  reading the headers, when an existing segment is opened. Removed datasets
+  are marked by a tombstone record, and their space is reclaimed when the
+  store is cleared, which is expected when a patient is processed or expires.
+
+  Args:
+      directory (Path): Directory of the segment file, created if missing
+  """
+  segment_name = "segment.dat"
+
+  _DATASET = 0
+  _TOMBSTONE = 1
+  _header = struct.Struct("<BHQ") # kind, key length, data length
+
+  def __init__(self, directory: Path) -> None:
+    self.path = Path(directory) / self.segment_name
+    self._lock = Lock()
+    self._index: Dict[str, Tuple[int, int]] = {} # key -> (offset, length)
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    if self.path.exists():
+      self._load_index()
+
+  def _load_index(self) -> None:
+    size = self.path.stat().st_size
+    offset = 0
+    with open(self.path, 'rb') as segment:
+      while offset + self._header.size <= size:
+        kind, key_length, data_length = self._header.unpack(segment.read(self._header.size))
+        data_offset = offset + self._header.size + key_length
+        if size < data_offset + data_length:
+          break
+        key = segment.read(key_length).decode()
+        if kind == self._DATASET:
+          self._index[key] = (data_offset, data_length)
+        else:
+          self._index.pop(key, None)
+        offset = data_offset + data_length
+        segment.seek(offset)
+    if offset < size:
+      # A crash while appending leaves a partial record
+      logger.warning(f"Truncating partial record at the end of {self.path}")
+      os.truncate(self.path, offset)
+
+  def _append(self, kind: int, key: str, data: bytes) -> int:
+    encoded_key = key.encode()
+    with open(self.path, 'ab') as segment:
+      offset = segment.tell()
+      segment.write(self._header.pack(kind, len(encoded_key), len(data)))
+      segment.write(encoded_key)
+      segment.write(data)
+    return offset + self._header.size + len(encoded_key)
+
+  def put(self, key: str, dataset: Dataset) -> None:
+    with self._lock:
+      if key in self._index:
+        return
+    data = _serialize(dataset)
+    with self._lock:
+      if key in self._index:
+        return
+      self._index[key] = (self._append(self._DATASET, key, data), len(data))
+
+  def get(self, key: str) -> Dataset:
+    with self._lock:
+      offset, length = self._index[key]
+      with open(self.path, 'rb') as segment:
+        segment.seek(offset)
+        data = segment.read(length)
+    return dcmread(BytesIO(data))
+
+  def __contains__(self, key: str) -> bool:
+    with self._lock:
+      return key in self._index
+
+  def keys(self, prefix: str = "") -> List[str]:
+    with self._lock:
+      if prefix == "":
+        return sorted(self._index)
+      prefix = prefix.rstrip("/") + "/"
+      return sorted(key[len(prefix):] for key in self._index if key.startswith(prefix))
+
+  def remove(self, key: str) -> None:
+    with self._lock:
+      if key in self._index:
+        del self._index[key]
+        self._append(self._TOMBSTONE, key, b"")
+
+  def clear(self) -> None:
+    with self._lock:
+      self._index = {}
+      self.path.unlink(missing_ok=True)
+
+
+class MemoryStore(DatasetStore):
+  """Keeps the datasets in memory. Putting a dataset in the store doesn't free
+  any memory, so patients cannot be spilled to it.
+
+  Args:
+      directory (Optional[Path]): Ignored, accepted such that the stores are
+        interchangeable.
+  """
+  persistent = False
+
+  def __init__(self, directory: Optional[Path] = None) -> None:
+    self._lock = Lock()
+    self._datasets: Dict[str, Dataset] = {}
+
+  def put(self, key: str, dataset: Dataset) -> None:
+    with self._lock:
+      self._datasets.setdefault(key, dataset)
+
+  def get(self, key: str) -> Dataset:
+    with self._lock:
+      return self._datasets[key]
+
+  def __contains__(self, key: str) -> bool:
+    with self._lock:
+      return key in self._datasets
+
+  def keys(self, prefix: str = "") -> List[str]:
+    with self._lock:
+      if prefix == "":
+        return sorted(self._datasets)
+      prefix = prefix.rstrip("/") + "/"
+      return sorted(key[len(prefix):] for key in self._datasets if key.startswith(prefix))
+
+  def remove(self, key: str) -> None:
+    with self._lock:
+      self._datasets.pop(key, None)
+
+  def clear(self) -> None:
+    with self._lock:
+      self._datasets = {}
@@ -0,0 +1,124 @@
+"""Synthetic dicom images with random pixel data, used by the tests and
+benchmarks of dicomnode, and by the loadgen tool to stress test a node.
+"""
+
+__author__ = "Christoffer Vilstrup Jensen"
+
+# Python Standard Library
+from typing import Dict, Iterator, Type
+
+# Third party packages
+import numpy
+from pydicom import Dataset
+from pydicom.uid import UID, SecondaryCaptureImageStorage
+
+# Dicomnode packages
+from dicomnode.lib.dicom import gen_uid, make_meta
+
+unsigned_array_encoding: Dict[int, Type[numpy.unsignedinteger]] = {
+  8 : numpy.uint8,
+  16 : numpy.uint16,
+  32 : numpy.uint32,
+  64 : numpy.uint64,
+}
+
+def generate_numpy_dataset(
+    StudyUID: UID,
+    SeriesUID: UID,
+    Cols: int,
+    Rows: int,
+    bits: int,
+    rescale: bool,
+    PixelRepresentation: int,
+    PatientID: str
+  ) -> Dataset:
+  """Creates a secondary capture image with uniformly random pixel data
+
+  Args:
+      StudyUID (UID): StudyInstanceUID of the image
+      SeriesUID (UID): SeriesInstanceUID of the image
+      Cols (int): Columns of the image
+      Rows (int): Rows of the image
+      bits (int): Bits stored per pixel
+      rescale (bool): If a random RescaleSlope and RescaleIntercept is added
+      PixelRepresentation (int): PixelRepresentation of the image
+      PatientID (str): PatientID of the image
+
+  Raises:
+      ValueError: If no unsigned integer type can hold the bits
+
+  Returns:
+      Dataset: The image with file meta information
+  """
+  ds = Dataset()
+  ds.SOPClassUID = SecondaryCaptureImageStorage
+  ds.PatientID = PatientID
+  ds.SOPInstanceUID = gen_uid()
+  ds.StudyInstanceUID = StudyUID
+  ds.SeriesInstanceUID = SeriesUID
+
+  ds.PhotometricInterpretation = "MONOCHROME2"
+  ds.SamplesPerPixel = 1
+  ds.Rows = Rows
+  ds.Columns = Cols
+  ds.PixelRepresentation = PixelRepresentation
+
+  make_meta(ds)
+
+  if bits % 8 == 0:
+    ds.BitsAllocated = bits
+  else:
+    ds.BitsAllocated = bits + (8 - (bits % 8))
+  ds.BitsStored = bits
+  ds.HighBit = bits - 1
+
+  dType = unsigned_array_encoding.get(ds.BitsAllocated)
+
+  if dType is None:
+    raise ValueError
+
+  if rescale:
+    slope = numpy.random.uniform(0, 2 / (2 ** bits - 1))
+    intercept = numpy.random.uniform(0, (2 ** bits - 1))
+    ds.RescaleSlope = slope
+    ds.RescaleIntercept = intercept
+
+  image = numpy.random.randint(0, 2 ** bits - 1, (Cols, Rows), dtype=dType)
+  ds.PixelData = image.tobytes()
+
+  return ds
+
+def generate_numpy_datasets(
+    datasets: int,
+    StudyUID = gen_uid(),
+    SeriesUID = gen_uid(),
+    Cols = 400,
+    Rows = 400,
+    Bits = 16,
+    rescale = True,
+    PixelRepresentation = 0,
+    PatientID: str = "None"
+  ) -> Iterator[Dataset]:
+  """Lazily generates a series of random images, see generate_numpy_dataset
+
+  Args:
+      datasets (int): Number of images in the series
+
+  Yields:
+      Dataset: The images of the series
+  """
+  yielded = 0
+  while yielded < datasets:
+    yielded += 1
+    ds = generate_numpy_dataset(
+      StudyUID,
+      SeriesUID,
+      Cols,
+      Rows,
+      Bits,
+      rescale,
+      PixelRepresentation,
+      PatientID
+    )
+    ds.InstanceNumber = yielded + 1
+    yield ds
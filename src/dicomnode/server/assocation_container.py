@@ -44,6 +44,9 @@ class ReleasedContainer(AssocationContainer):
 class CStoreContainer(AssocationContainer):
   assocation_id : int
   dataset: Dataset
+  assocation_ae_title : str = ""
+  assocation_ip : Optional[str] = None
+  digest : Optional[bytes] = None # Digest of the received bytes of the dataset
 
 ##### Corosponding Factory #####
 class AssociationContainerFactory:
@@ -86,11 +89,17 @@ class AssociationContainerFactory:
       )
 
 
-  def build_assocation_c_store(self, event: Event) -> CStoreContainer:
+  def build_assocation_c_store(self, event: Event, digest: Optional[bytes] = None) -> CStoreContainer:
     dataset = event.dataset
     dataset.file_meta = event.file_meta
 
-    return CStoreContainer(self.__get_event_id(event), dataset)
+    return CStoreContainer(
+      self.__get_event_id(event),
+      dataset,
+      event.assoc.requestor.ae_title,
+      event.assoc.requestor.address,
+      digest,
+    )
 
 
   # I'm internal debate over cutting this function, since there's currently
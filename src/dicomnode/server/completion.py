@@ -0,0 +1,169 @@
+"""Contains the CompletionScheduler, which debounces the processing of patients
+
+  Modalities often send a study as many associations, for instance one per
+  series. Rather than processing a patient at the release of each of them,
+  the scheduler waits until no images have arrived for a quiet period.
+"""
+
+__author__ = "Christoffer Vilstrup Jensen"
+
+# Python3 standard Library
+from threading import Condition, Thread
+from time import monotonic
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Third party Packages
+
+# Dicomnode packages
+from dicomnode.lib.logging import get_logger, log_traceback
+from dicomnode.lib.metrics import get_metrics
+from dicomnode.server.assocation_container import ReleasedContainer
+
+logger = get_logger()
+
+class CompletionScheduler:
+  """Schedules processing of patients, once they have been quiet for a while.
+
+  A patient is scheduled, when an association with images of the patient is
+  released. If the patient is scheduled again before it's due, the releases
+  are coalesced into a single job, due a quiet period after the last release.
+  When new images arrives for a patient, its job is cancelled, since the
+  association carrying them will schedule the patient upon release.
+
+  Args:
+    quiet_period (float): Seconds after the release, before a patient is
+      processed.
+    complete (Callable[[str, ReleasedContainer], None]): Function processing
+      a patient, called with the patient id and the container of the latest
+      release.
+
+  Example:
+  >>> scheduler = CompletionScheduler(5.0, node._process_completed_patient)
+  >>> scheduler.start()
+  >>> scheduler.schedule("1502799995", released_container)
+  """
+  def __init__(self,
+               quiet_period: float,
+               complete: Callable[[str, ReleasedContainer], None]) -> None:
+    self.quiet_period = quiet_period
+    self.complete = complete
+
+    self._condition = Condition()
+    self._pending: Dict[str, Tuple[float, ReleasedContainer]] = {}
+    self._running = False
+    self._thread: Optional[Thread] = None
+
+  def __len__(self) -> int:
+    """Number of patients waiting to be processed"""
+    with self._condition:
+      return len(self._pending)
+
+  def __contains__(self, patient_id: str) -> bool:
+    with self._condition:
+      return patient_id in self._pending
+
+  def schedule(self,
+               patient_id: str,
+               released_container: ReleasedContainer,
+               now: Optional[float] = None) -> None:
+    """Schedules a patient to be processed after the quiet period, replacing
+    any pending job of the patient.
+
+    Args:
+        patient_id (str): The patient to be processed
+        released_container (ReleasedContainer): The release that completed the
+          patient
+        now (Optional[float], optional): monotonic time of the release.
+          Defaults to None, which is the current time.
+    """
+    if now is None:
+      now = monotonic()
+    with self._condition:
+      if patient_id in self._pending:
+        get_metrics().increment("dicomnode_coalesced_releases_total")
+        logger.debug(f"Coalesced release of {patient_id} into pending job")
+      self._pending[patient_id] = (now + self.quiet_period, released_container)
+      self._condition.notify()
+
+  def cancel(self, patient_id: str) -> bool:
+    """Cancels the pending job of a patient, if any.
+
+    Args:
+        patient_id (str): The patient, which received new images
+
+    Returns:
+        bool: If a job was cancelled
+    """
+    with self._condition:
+      return self._pending.pop(patient_id, None) is not None
+
+  def next_due(self) -> Optional[float]:
+    """Gets the monotonic time, when the next patient is due
+
+    Returns:
+        Optional[float]: The time, None if no patients are pending
+    """
+    with self._condition:
+      return self._next_due()
+
+  def _next_due(self) -> Optional[float]:
+    if len(self._pending) == 0:
+      return None
+    return min(due for due, _ in self._pending.values())
+
+  def run_due(self, now: Optional[float] = None) -> int:
+    """Processes every patient, which is due.
+
+    Args:
+        now (Optional[float], optional): monotonic time to compare against.
+          Defaults to None, which is the current time.
+
+    Returns:
+        int: Number of patients processed
+    """
+    if now is None:
+      now = monotonic()
+    due: List[Tuple[str, ReleasedContainer]] = []
+    with self._condition:
+      for patient_id, (patient_due, released_container) in list(self._pending.items()):
+        if patient_due <= now:
+          del self._pending[patient_id]
+          due.append((patient_id, released_container))
+
+    for patient_id, released_container in due:
+      try:
+        self.complete(patient_id, released_container)
+      except Exception as exception:
+        log_traceback(logger, exception, f"Processing completed patient {patient_id}")
+    return len(due)
+
+  def _run(self) -> None:
+    while True:
+      with self._condition:
+        while self._running:
+          next_due = self._next_due()
+          if next_due is not None and next_due <= monotonic():
+            break
+          timeout = None if next_due is None else next_due - monotonic()
+          self._condition.wait(timeout)
+        if not self._running:
+          return
+      self.run_due()
+
+  def start(self) -> None:
+    """Starts the background thread processing due patients"""
+    with self._condition:
+      if self._running:
+        return
+      self._running = True
+    self._thread = Thread(target=self._run, name="CompletionScheduler", daemon=True)
+    self._thread.start()
+
+  def stop(self) -> None:
+    """Stops the background thread, pending patients are not processed"""
+    with self._condition:
+      self._running = False
+      self._condition.notify_all()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
@@ -18,15 +18,17 @@ __author__ = "Christoffer Vilstrup Jensen"
 
 # Python Standard Library
 from abc import ABC, abstractmethod
-from typing import Any, Callable, Dict, Iterable, List, Optional, Type, Tuple
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Type, Tuple
 
 # Third party packages
 import numpy
-from pydicom import Dataset
+from pydicom import Dataset, dcmread
 
 # Dicom node package
 from dicomnode.lib.exceptions import InvalidDataset
 from dicomnode.lib.image_tree import DicomTree
+from dicomnode.lib.lazy_dataset import LazyDataset
 from dicomnode.lib.logging import get_logger
 
 logger = get_logger()
@@ -135,11 +137,12 @@ class NumpyGrinder(Grinder):
     64 : numpy.int64,
   }
 
-  def __numpy_monochrome_grinder(self,  datasets: List[Dataset]):
-    pivot = datasets[0]
-    x_dim = pivot.Columns
-    y_dim = pivot.Rows
-    z_dim = len(datasets)
+  def _datatype(self, pivot: Dataset) -> Type[numpy.number]:
+    """Determines the datatype of the image of a monochrome series
+
+    Raises:
+        InvalidDataset: If the encoding of the pixels is not supported
+    """
     rescale = (0x00281052 in pivot and 0x00281053 in pivot)
 
     if 0x7FE00008 in pivot:
@@ -155,14 +158,26 @@ class NumpyGrinder(Grinder):
 
     if dataType is None:
       raise InvalidDataset
+    return dataType
+
+  def _slice_image(self, dataset: Dataset, rescale: bool) -> numpy.ndarray:
+    image = dataset.pixel_array
+    if rescale:
+      image = image.astype(numpy.float64) * dataset.RescaleSlope + dataset.RescaleIntercept
+    return image
+
+  def __numpy_monochrome_grinder(self,  datasets: List[Dataset]):
+    pivot = datasets[0]
+    x_dim = pivot.Columns
+    y_dim = pivot.Rows
+    z_dim = len(datasets)
+    rescale = (0x00281052 in pivot and 0x00281053 in pivot)
+    dataType = self._datatype(pivot)
 
     image_array: numpy.ndarray = numpy.empty((z_dim, y_dim, x_dim), dtype=dataType)
 
     for i, dataset in enumerate(datasets):
-      image = dataset.pixel_array
-      if rescale:
-        image = image.astype(numpy.float64) * dataset.RescaleSlope + dataset.RescaleIntercept
-      image_array[i,:,:] = image
+      image_array[i,:,:] = self._slice_image(dataset, rescale)
 
     return image_array
 
@@ -208,3 +223,118 @@ class NumpyGrinder(Grinder):
       logger.error("Dataset contains a invalid value for Samples Per Pixel")
 
     raise InvalidDataset()
+
+
+@dataclass
+class Slab:
+  """Consecutive slices of a series, see SlabGrinder"""
+  image: numpy.ndarray
+  "Slices of the slab with the shape (slices, rows, columns)"
+
+  start: int
+  "Index of the first slice of the slab in the series"
+
+  total: int
+  "Number of slices in the series"
+
+  image_positions: List[Optional[List[float]]] = field(default_factory=list)
+  "ImagePositionPatient of each slice, None if the slice doesn't have it"
+
+  image_orientation: Optional[List[float]] = None
+  "ImageOrientationPatient of the series"
+
+  pixel_spacing: Optional[List[float]] = None
+  "PixelSpacing of the series"
+
+  slice_thickness: Optional[float] = None
+  "SliceThickness of the series"
+
+
+def _transient(dataset: Dataset) -> Dataset:
+  # An unloaded lazy dataset is read into a copy, which is freed after use
+  if isinstance(dataset, LazyDataset) and not dataset._is_init:
+    return LazyDataset(dataset._path, dataset._loader)
+  return dataset
+
+def _header(dataset: Dataset) -> Dataset:
+  # An unloaded lazy dataset stored as a file is read without its pixels
+  if isinstance(dataset, LazyDataset) and not dataset._is_init and dataset._path is not None:
+    return dcmread(dataset._path, stop_before_pixels=True)
+  return _transient(dataset)
+
+def _float_list(dataset: Dataset, keyword: str) -> Optional[List[float]]:
+  if keyword not in dataset:
+    return None
+  return [float(value) for value in dataset.data_element(keyword).value] # type: ignore
+
+
+class SlabGrinder(NumpyGrinder):
+  """Streams a monochrome series as slabs of slab_size consecutive slices,
+  rather than a volume of the whole series. Together with
+  NumpyFactory.build_from_slabs, a slab wise filter processes a series with
+  memory bounded by the size of a slab.
+
+  Lazy datasets of the input are read per slab and not kept loaded, so the
+  series should be stored lazily, see AbstractPipeline.lazy_storage. The
+  series is sorted by reading the headers of files without their pixels. The
+  slabs are read, as they're consumed, and can only be consumed once.
+
+  Args:
+    slab_size (int): Number of slices per slab, the last slab might be smaller
+
+  Example:
+  >>> slabs = SlabGrinder(64)(datasets)
+  >>> factory.build_from_slabs(header, (slab.image > 0.5 for slab in slabs))
+  """
+  def __init__(self, slab_size: int = 16) -> None:
+    if slab_size < 1:
+      raise ValueError("Slabs must contain at least one slice")
+    self.slab_size = slab_size
+
+  def __call__(self, image_generator: Iterable[Dataset]) -> Iterator[Slab]:
+    """Sorts the series by InstanceNumber, see NumpyGrinder for the required
+    tags
+
+    Args:
+      image_generator (Iterable[Dataset]): The datasets of the series
+
+    Raises:
+      InvalidDataset: If the series is empty or not monochrome
+
+    Returns:
+      Iterator[Slab]: The slabs of the series in order
+    """
+    datasets: List[Dataset] = [dataset for dataset in image_generator]
+    if len(datasets) == 0:
+      raise InvalidDataset("Cannot grind an empty series")
+
+    if 'InstanceNumber' in _header(datasets[0]):
+      instance_numbers = [_header(dataset).InstanceNumber for dataset in datasets]
+      datasets = [dataset for _, dataset in sorted(zip(instance_numbers, datasets), key=lambda pair: pair[0])]
+    else:
+      logger.warning("Instance Number not present in dataset, arbitrary ordering of datasets")
+    pivot = _transient(datasets[0])
+
+    if pivot.SamplesPerPixel != 1:
+      logger.error("Only monochrome series can be ground into slabs")
+      raise InvalidDataset()
+
+    return self.__slabs(datasets, pivot)
+
+  def __slabs(self, datasets: List[Dataset], pivot: Dataset) -> Iterator[Slab]:
+    rescale = (0x00281052 in pivot and 0x00281053 in pivot)
+    dataType = self._datatype(pivot)
+    image_orientation = _float_list(pivot, 'ImageOrientationPatient')
+    pixel_spacing = _float_list(pivot, 'PixelSpacing')
+    slice_thickness = float(pivot.SliceThickness) if 'SliceThickness' in pivot else None
+
+    for start in range(0, len(datasets), self.slab_size):
+      slab_datasets = datasets[start:start + self.slab_size]
+      image: numpy.ndarray = numpy.empty((len(slab_datasets), pivot.Rows, pivot.Columns), dtype=dataType)
+      image_positions: List[Optional[List[float]]] = []
+      for i, dataset in enumerate(slab_datasets):
+        dataset = _transient(dataset)
+        image[i,:,:] = self._slice_image(dataset, rescale)
+        image_positions.append(_float_list(dataset, 'ImagePositionPatient'))
+      yield Slab(image, start, len(datasets), image_positions,
+                 image_orientation, pixel_spacing, slice_thickness)
@@ -8,26 +8,40 @@ __author__ = "Christoffer Vilstrup Jensen"
 
 # Python standard Library
 from abc import abstractmethod, ABC
+from concurrent.futures import Executor
 from dataclasses import dataclass, asdict
+from datetime import timedelta
 from logging import Logger
 from pathlib import Path
-from typing import List, Dict, Tuple, Any, Optional, Type, Iterable, Union
+from threading import Thread
+from typing import Callable, List, Dict, Tuple, Any, Optional, Type, Iterable, Union
 
 # Third party packages
 from pydicom import Dataset
 from pydicom.uid import UID
 
 # Dicomnode packages
-from dicomnode.lib.dimse import Address, send_move_thread
+from dicomnode.lib.dimse import Address, AssociationPool, FindCache, MoveCoordinator, QueryLevels, add_return_keys, send_find, send_move, send_move_thread
 from dicomnode.lib.dicom_factory import DicomFactory, Blueprint
 from dicomnode.lib.exceptions import InvalidDataset, IncorrectlyConfigured, InvalidTreeNode
-from dicomnode.lib.io import load_dicom, save_dicom
 from dicomnode.lib.lazy_dataset import LazyDataset
 from dicomnode.lib.logging import get_logger
+from dicomnode.lib.metrics import get_metrics
+from dicomnode.lib.storage import DatasetStore, FileStore
 from dicomnode.server.grinders import Grinder, IdentityGrinder
 from dicomnode.lib.image_tree import ImageTreeInterface
 from dicomnode.lib.logging import log_traceback
 
+def _spill_tree(tree: ImageTreeInterface,
+                store: DatasetStore,
+                get_key: Callable[[Dataset], str]) -> None:
+  for key, dataset in list(tree.data.items()):
+    if isinstance(dataset, Dataset) and not isinstance(dataset, LazyDataset):
+      dataset_key = get_key(dataset)
+      store.put(dataset_key, dataset)
+      tree[key] = store.lazy(dataset_key)
+
+
 class AbstractInput(ImageTreeInterface, ABC):
   # Private tags should be injected, rather than put into the input
   __private_tags: Dict[int, Tuple[str, str, str, str, str]] = {}
@@ -42,6 +56,12 @@ class AbstractInput(ImageTreeInterface, ABC):
   image_grinder: Grinder = IdentityGrinder()
   "Grinder for converting stored dicom images into a data usable by the processing function"
 
+  expiration_time: Optional[timedelta] = None
+  """Time a patient waits for this input before it expires and is removed by
+  the MaintenanceThread. The shortest expiration of the inputs and the
+  pipeline's study_expiration_days applies. If None only the pipeline's
+  study_expiration_days applies"""
+
   @dataclass
   class Options: # These are options that are injected into all input.
     # Note the reason, why there some options, that are not used by this class
@@ -53,6 +73,19 @@ class AbstractInput(ImageTreeInterface, ABC):
     factory: Optional[DicomFactory] = None
     lazy: bool = False
     "Indicate if the Abstract input should use "
+    association_pool: Optional[AssociationPool] = None
+    "Pool of associations for DIMSE messages send by the input"
+    move_coordinator: Optional[MoveCoordinator] = None
+    "Deduplicates the C-MOVEs send by historic inputs"
+    find_cache: Optional[FindCache] = None
+    "Cache of the C-FINDs send by historic inputs"
+    retrieval_executor: Optional[Executor] = None
+    """Executor of the series retrievals of historic inputs, such that the
+    patients share a bounded number of threads. If None each retrieval runs in
+    its own thread"""
+    store: Optional[DatasetStore] = None
+    """Storage of the datasets of the input. If None and data_directory is
+    set, the datasets are stored as files in the data_directory"""
 
   def __init__(self,
       pivot: Optional[Dataset] = None,
@@ -62,7 +95,15 @@ class AbstractInput(ImageTreeInterface, ABC):
     self.options = options
     "Options for this Abstract input"
 
+    self.store: Optional[DatasetStore] = options.store
+    "Storage of the datasets, None if the input is only held in memory"
+    if self.store is None and options.data_directory is not None:
+      self.store = FileStore(options.data_directory)
     self.path: Optional[Path] = options.data_directory
+    if self.path is None and self.store is not None:
+      self.path = self.store.directory
+    self._ready: Optional[bool] = None
+    "Cached result of validate, None if images were added since"
     if self.options.logger is not None:
       self.logger = self.options.logger
       "Logger for logging"
@@ -72,12 +113,13 @@ class AbstractInput(ImageTreeInterface, ABC):
     if 0x00080018 not in self.required_tags: # Tag for SOPInstance is (0x0008,0018)
       self.required_tags.append(0x00080018)
 
-    if self.path is not None:
-      if not self.path.exists():
-        self.path.mkdir(exist_ok=True)
-      for image_path in self.path.iterdir():
-        dcm = load_dicom(image_path, self.__private_tags)
-        self.add_image(dcm)
+    if self.store is not None:
+      for key in self.store.keys():
+        dataset = self.store.get(key)
+        self.add_image(dataset)
+        # add_image stored the dataset under its current key
+        if key == self._legacy_key(dataset):
+          self.store.remove(key)
 
 
   @abstractmethod
@@ -89,12 +131,37 @@ class AbstractInput(ImageTreeInterface, ABC):
     """
     raise NotImplementedError #pragma: no cover
 
+  def on_image_added(self, dicom: Dataset) -> None:
+    """Called after a dataset was added to the input, including datasets
+    loaded from the data directory upon construction.
+
+    By default it invalidates the cached result of validate, such that
+    is_ready validates the input again. Inputs where validate is expensive
+    should overwrite both this method and is_ready, updating their state with
+    each dataset, rather than recomputing it. Note that state used by this
+    method must be initialized before calling AbstractInput.__init__.
+
+    Args:
+        dicom (Dataset): The added dataset
+    """
+    self._ready = None
+
+  def is_ready(self) -> bool:
+    """Checks if the input have sufficient data, to start processing.
+    Unlike validate, this only validates the input if images were added since
+    the last call.
+
+    Returns:
+        bool: If there's sufficient data to start processing
+    """
+    if self._ready is None:
+      self._ready = self.validate()
+    return self._ready
+
   def _clean_up(self) -> int:
-    """Removes any files, stored by the Input"""
-    if self.path is not None:
-      for dicom in self:
-        p = self.get_path(dicom)
-        p.unlink()
+    """Removes any datasets, stored by the Input"""
+    if self.store is not None:
+      self.store.clear()
     return self.images
 
   def get_data(self) -> Any:
@@ -104,7 +171,19 @@ class AbstractInput(ImageTreeInterface, ABC):
     Returns:
         Any: Data ready for the pipelines process function.
     """
-    return self.image_grinder(self)
+    with get_metrics().time("dicomnode_grind_seconds", {"input" : self.__class__.__name__}):
+      return self.image_grinder(self)
+
+  def spill(self) -> None:
+    """Moves the datasets held in memory to the store, replacing them
+    with LazyDatasets, which are loaded again when the input is grinded.
+
+    Raises:
+        IncorrectlyConfigured: If the input doesn't have a persistent store
+    """
+    if self.store is None or not self.store.persistent:
+      raise IncorrectlyConfigured("Spilling datasets requires persistent storage")
+    _spill_tree(self, self.store, self.get_key)
 
   def get_path(self, dicom: Dataset) -> Path:
     """Gets the path, where a dataset would be saved.
@@ -121,6 +200,17 @@ class AbstractInput(ImageTreeInterface, ABC):
     if self.path is None:
       raise IncorrectlyConfigured
 
+    return self.path / self.get_key(dicom)
+
+  def get_key(self, dicom: Dataset) -> str:
+    """Gets the key, which a dataset is stored under in the store.
+
+    Args:
+        dicom (Dataset): The dataset in question
+
+    Returns:
+        str: The key, with the file storage this is the file name.
+    """
     image_name: str = ""
     if 0x00080060 in dicom: # Modality
       image_name += f"{dicom.Modality}_"
@@ -128,12 +218,33 @@ class AbstractInput(ImageTreeInterface, ABC):
 
     if 0x00200013 in dicom: # Instance Number
       image_name += f"_{dicom.InstanceNumber}"
-    else:
-      image_name += f"_{dicom.SOPInstanceUID.name}"
+    # Instance numbers are only unique within a series
+    image_name += f"_{dicom.SOPInstanceUID.name}"
 
     image_name += ".dcm"
 
-    return self.path / image_name
+    return image_name
+
+  def _legacy_key(self, dicom: Dataset) -> Optional[str]:
+    """Gets the key, which earlier versions stored the dataset under, when
+    it differs from the key of get_key. Earlier versions only added the
+    SOPInstanceUID to the key, if the dataset had no InstanceNumber.
+
+    Args:
+        dicom (Dataset): The dataset in question
+
+    Returns:
+        Optional[str]: The old key, None if it's the same as the current key
+          or if get_key is overwritten.
+    """
+    if type(self).get_key is not AbstractInput.get_key:
+      return None
+    if 0x00200013 not in dicom: # Instance Number
+      return None
+    image_name = ""
+    if 0x00080060 in dicom: # Modality
+      image_name += f"{dicom.Modality}_"
+    return image_name + f"image_{dicom.InstanceNumber}.dcm"
 
   def validate_image(self, dicom: Dataset) -> bool:
     """Checks if an image belongs in the input
@@ -175,50 +286,72 @@ class AbstractInput(ImageTreeInterface, ABC):
     if not self.validate_image(dicom):
       raise InvalidDataset
 
+    # A re-sent image with new content replaces the stored image
+    if self.store is not None and dicom.SOPInstanceUID.name in self:
+      self.store.remove(self.get_key(dicom))
+      legacy_key = self._legacy_key(dicom)
+      if legacy_key is not None:
+        self.store.remove(legacy_key)
+
     # Save the dataset
     if self.options.lazy:
-      if self.path is None:
-        raise IncorrectlyConfigured("Lazy object require file storage")
-      dicom_path = self.get_path(dicom)
-      if not dicom_path.exists():
-        save_dicom(dicom_path, dicom)
-      self[dicom.SOPInstanceUID.name] = LazyDataset(dicom_path)
+      if self.store is None:
+        raise IncorrectlyConfigured("Lazy object require storage")
+      key = self.get_key(dicom)
+      self.store.put(key, dicom)
+      self[dicom.SOPInstanceUID.name] = self.store.lazy(key)
     else:
       self[dicom.SOPInstanceUID.name] = dicom # Tag for SOPInstance is (0x0008,0018)
-      if self.path is not None:
-        dicom_path = self.get_path(dicom)
-        if not dicom_path.exists():
-          save_dicom(dicom_path, dicom)
+      if self.store is not None:
+        self.store.put(self.get_key(dicom), dicom)
     self.images += 1
+    self.on_image_added(dicom)
     return 1
 
 class DynamicLeaf(ImageTreeInterface):
   """Subclass to DynamicInput, each instance is a separate series"""
-  def __init__(self, dcm: Union[Iterable[Dataset], Dataset] = [], lazy = False, path: Optional[Path] = None) -> None:
-    super().__init__(dcm)
+  def __init__(self,
+               dcm: Union[Iterable[Dataset], Dataset] = [],
+               lazy = False,
+               path: Optional[Path] = None,
+               store: Optional[DatasetStore] = None) -> None:
+    if store is None and path is not None:
+      store = FileStore(path)
     self.lazy = lazy
-    self.path = path
+    self.store = store
+    self.path = path if path is not None or store is None else store.directory
+    super().__init__(dcm)
 
   def get_path(self, dicom: Dataset) -> Path:
     if self.path is None:
       raise IncorrectlyConfigured("getting the path needs a base path")
-    return self.path / (dicom.SOPInstanceUID.name + ".dcm")
+    return self.path / self.get_key(dicom)
+
+  def get_key(self, dicom: Dataset) -> str:
+    return dicom.SOPInstanceUID.name + ".dcm"
 
   def add_image(self, dicom: Dataset) -> int:
+    if self.store is not None and dicom.SOPInstanceUID.name in self:
+      self.store.remove(self.get_key(dicom))
     if self.lazy:
-      if self.path is None:
-        raise IncorrectlyConfigured("Lazy datasets require a path")
-      dicom_path = self.get_path(dicom)
-      self[dicom.SOPInstanceUID.name] = LazyDataset(dicom_path)
+      if self.store is None:
+        raise IncorrectlyConfigured("Lazy datasets require storage")
+      key = self.get_key(dicom)
+      self.store.put(key, dicom)
+      self[dicom.SOPInstanceUID.name] = self.store.lazy(key)
     else:
       self[dicom.SOPInstanceUID.name] = dicom # Tag for SOPInstance is (0x0008,0018)
-      if self.path is not None:
-        dicom_path = self.get_path(dicom)
-        if not dicom_path.exists():
-          save_dicom(dicom_path, dicom)
+      if self.store is not None:
+        self.store.put(self.get_key(dicom), dicom)
     self.images += 1
     return 1
 
+  def spill(self) -> None:
+    """Replaces the datasets held in memory with LazyDatasets, see AbstractInput.spill"""
+    if self.store is None or not self.store.persistent:
+      raise IncorrectlyConfigured("Spilling datasets requires persistent storage")
+    _spill_tree(self, self.store, self.get_key)
+
 class DynamicInput(AbstractInput):
   """This input signifies when you are dealing with a variable number of input series.
 
@@ -229,13 +362,20 @@ class DynamicInput(AbstractInput):
 
   def get_data(self) -> Dict[str, Any]:
     returnDict = {}
-    for key, leaf in self.data.items():
-      if not isinstance(leaf, DynamicLeaf):
-        raise InvalidTreeNode # pragma: no cover
-      returnDict[key] = self.image_grinder(leaf)
+    with get_metrics().time("dicomnode_grind_seconds", {"input" : self.__class__.__name__}):
+      for key, leaf in self.data.items():
+        if not isinstance(leaf, DynamicLeaf):
+          raise InvalidTreeNode # pragma: no cover
+        returnDict[key] = self.image_grinder(leaf)
 
     return returnDict
 
+  def spill(self) -> None:
+    for leaf in self.data.values():
+      if not isinstance(leaf, DynamicLeaf):
+        raise InvalidTreeNode # pragma: no cover
+      leaf.spill()
+
   def add_image(self, dataset: Dataset) -> int:
     if not self.validate_image(dataset):
       raise InvalidDataset
@@ -258,15 +398,15 @@ class DynamicInput(AbstractInput):
         raise InvalidTreeNode #pragma: no cover
     else:
       # Don't use the add image functionality of the constructor due to fact that, it's return value is needed
-      if self.path is not None:
-        leaf_path = self.path / key
-        leaf_path.mkdir(parents=True, exist_ok=True)
+      if self.store is not None:
+        leaf_store = self.store.scope(key)
       else:
-        leaf_path = None
-      leaf = self.leaf_class([], self.options.lazy, leaf_path)
+        leaf_store = None
+      leaf = self.leaf_class([], self.options.lazy, store=leaf_store)
       self[key] = leaf
       ret_value = leaf.add_image(dataset)
     self.images += ret_value
+    self.on_image_added(dataset)
     return ret_value
 
 
@@ -274,6 +414,13 @@ class HistoricAbstractInput(AbstractInput):
   address: Optional[Address] = None
   c_move_blueprint: Optional[Blueprint] = None
 
+  series_return_keys: List[int] = [
+    0x00080021, # SeriesDate
+    0x00080060, # Modality
+    0x0008103E, # SeriesDescription
+  ]
+  "Tags returned in the series matches given to the series_filter"
+
   def __init__(self, pivot: Optional[Dataset] = None, options: AbstractInput.Options = AbstractInput.Options()):
     super().__init__(pivot, options)
 
@@ -299,5 +446,66 @@ class HistoricAbstractInput(AbstractInput):
 
     message = self.options.factory.build(pivot,self.c_move_blueprint)
 
-    send_move_thread(self.options.ae_title, self.address, message)
+    if type(self).series_filter is not HistoricAbstractInput.series_filter:
+      if self.options.retrieval_executor is not None:
+        self.options.retrieval_executor.submit(self._retrieve_series, message)
+      else:
+        Thread(target=self._retrieve_series, args=[message], daemon=True).start()
+    elif self.options.move_coordinator is not None:
+      self.options.move_coordinator.request(self.options.ae_title, self.address, message)
+    else:
+      send_move_thread(self.options.ae_title, self.address, message, pool=self.options.association_pool)
+
+  def series_filter(self, series: Dataset) -> bool:
+    """Selects the series of the patient to be moved. If overwritten, the
+    series of the patient are found with C-FINDs and only the series, that
+    this method returns True for, are moved. Otherwise the entire patient is
+    moved with a single C-MOVE.
+
+    Args:
+        series (Dataset): The C-FIND match of the series, with the
+          series_return_keys
+
+    Returns:
+        bool: If the series should be moved
+    """
+    return True
+
+  def _find_series(self, patient_ID: str) -> List[Dataset]:
+    """Finds all the series of a patient, by first finding the studies"""
+    address: Address = self.address # type: ignore
+    ae_title: str = self.options.ae_title # type: ignore
+    study_query = Dataset()
+    study_query.PatientID = patient_ID
+    studies = send_find(ae_title, address, study_query, QueryLevels.STUDY,
+                        pool=self.options.association_pool, cache=self.options.find_cache)
+    series = []
+    for study in studies:
+      series_query = Dataset()
+      series_query.PatientID = patient_ID
+      series_query.StudyInstanceUID = study.StudyInstanceUID
+      add_return_keys(series_query, self.series_return_keys)
+      series.extend(send_find(ae_title, address, series_query, QueryLevels.SERIES,
+                              pool=self.options.association_pool, cache=self.options.find_cache))
+    return series
+
+  def _retrieve_series(self, message: Dataset) -> None:
+    """Moves the series of the patient in message, accepted by the series_filter"""
+    address: Address = self.address # type: ignore
+    ae_title: str = self.options.ae_title # type: ignore
+    try:
+      for series in self._find_series(message.PatientID):
+        if not self.series_filter(series):
+          continue
+        move_message = Dataset()
+        move_message.PatientID = message.PatientID
+        move_message.StudyInstanceUID = series.StudyInstanceUID
+        move_message.SeriesInstanceUID = series.SeriesInstanceUID
+        self.logger.debug(f"Moving series {series.SeriesInstanceUID}")
+        if self.options.move_coordinator is not None:
+          self.options.move_coordinator.request(ae_title, address, move_message, QueryLevels.SERIES)
+        else:
+          send_move(ae_title, address, move_message, QueryLevels.SERIES, pool=self.options.association_pool)
+    except Exception as exception:
+      log_traceback(self.logger, exception, "Retrieving historic series")
 
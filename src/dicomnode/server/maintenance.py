@@ -8,7 +8,7 @@ __author__ = "Christoffer"
 # Python3 standard Library
 from datetime import datetime, timedelta
 from threading import Thread, Event
-from typing import Any, Callable, Iterable, Mapping, Optional
+from typing import Any, Callable, Iterable, Mapping, Optional, Union
 
 # Thrid party Packages
 
@@ -19,32 +19,52 @@ class MaintenanceThread(Thread):
   """This thread ensures that old studies are removed from the input
   pipeline tree.
 
+  Patients are removed continuously as their deadline passes, see
+  PipelineTree.next_expiry, rather than in a daily sweep. Removals are spaced
+  by removal_interval, such that deleting many patients doesn't cause a burst
+  of I/O.
+
   Should be stopped upon server closure.
+
+  Args:
+    pipeline_tree (PipelineTree): The tree to remove expired patients from
+    study_expiration_days (Union[int, float]): Days before a patient expires,
+      Inputs with a shorter expiration_time expire sooner.
+    removal_interval (float): Seconds between removals of expired patients.
+      Defaults to 0.1
+    maximum_sleep (float): Max seconds between checks of the deadlines, which
+      bounds the delay before a patient with a short expiration is removed.
+      Defaults to 60.0
   """
   _seconds_in_a_day = 86400
 
   def __init__(self,
                pipeline_tree: PipelineTree,
-               study_expiration_days: int,
+               study_expiration_days: Union[int, float],
                group: None = None,
                name: Optional[str] = None,
                args: Iterable[Any] = ...,
                kwargs: Optional[Mapping[str, Any]] = None,
                *,
-               daemon: Optional[bool]= None) -> None:
+               daemon: Optional[bool]= None,
+               removal_interval: float = 0.1,
+               maximum_sleep: float = 60.0) -> None:
     super().__init__(group, None, name, args, kwargs, daemon=daemon)
     self.pipeline_tree = pipeline_tree
     self.study_expiration_days = study_expiration_days
+    self.removal_interval = removal_interval
+    self.maximum_sleep = maximum_sleep
     self.__running = True
-    self.waiting_event = None
+    self.waiting_event = Event()
+
+    self.pipeline_tree.set_study_expiration(timedelta(days=study_expiration_days))
 
 
   def run(self):
     while self.__running:
-      self.waiting_event = Event()
-      waiting = self.waiting_event.wait(
+      stopped = self.waiting_event.wait(
         self.calculate_seconds_to_next_maintenance())
-      if waiting:
+      if stopped:
         break
       else:
         self.maintenance()
@@ -53,27 +73,37 @@ class MaintenanceThread(Thread):
   def stop(self):
     """Wakes the thread and kills it"""
     self.__running = False
-    if self.waiting_event is not None:
-      self.waiting_event.set()
+    self.waiting_event.set()
 
 
   def calculate_seconds_to_next_maintenance(self, now=None) -> float:
-    """Calculates the time in seconds to the next scheduled clean up"""
+    """Calculates the time in seconds until the next patient expires, at most
+    maximum_sleep"""
     if now is None:
       now = datetime.now()
 
-    tomorrow = now + timedelta(days=1)
-    clean_up_datetime = datetime(tomorrow.year, tomorrow.month, tomorrow.day, 0,0,0,0, tzinfo=now.tzinfo)
-    time_delta = clean_up_datetime - now
-    return time_delta.days * self._seconds_in_a_day + float(time_delta.seconds) # I guess you could add micro seconds here but WHO CARES
+    next_expiry = self.pipeline_tree.next_expiry()
+    if next_expiry is None:
+      return self.maximum_sleep
+    seconds = (next_expiry - now).total_seconds()
+    return min(max(seconds, 0.0), self.maximum_sleep)
 
 
-  def maintenance(self, now = None) -> None:
-    """Removes old studies in the pipeline tree to ensure GDPR compliance
+  def maintenance(self, now = None) -> int:
+    """Removes expired patients in the pipeline tree to ensure GDPR compliance
+
+    Returns:
+        int: Number of removed patients
     """
     if now is None:
       now = datetime.now()
     # Note this might cause some bug, where a patient is being processed, and at the same time removed
     # This is considered so unlikely, that it's a bug I accept in the code
-    expiry_datetime = now - timedelta(days=self.study_expiration_days)
-    self.pipeline_tree.remove_expired_studies(expiry_datetime)
+    removed = 0
+    while self.__running:
+      if self.pipeline_tree.remove_next_expired(now) is None:
+        break
+      removed += 1
+      if 0 < self.removal_interval and self.waiting_event.wait(self.removal_interval):
+        break # Stopped
+    return removed
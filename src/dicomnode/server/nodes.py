@@ -13,15 +13,15 @@
 __author__ = "Christoffer Vilstrup Jensen"
 
 # Standard lib
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 import logging
 from logging import getLogger
-from os import chdir, getcwd
 from pathlib import Path
 from queue import Queue, Empty
 import shutil
 from sys import stdout
-from threading import Thread
+from threading import Lock, Thread
 from typing import Any, Dict, List, NoReturn, Optional, Set, TextIO, Type, Union
 
 # Third part packages
@@ -29,17 +29,23 @@ from pynetdicom import evt
 from pynetdicom.ae import ApplicationEntity as AE
 from pynetdicom.presentation import AllStoragePresentationContexts, PresentationContext, VerificationPresentationContexts
 from pydicom import Dataset
+from pydicom.uid import ImplicitVRLittleEndian
 
 # Dicomnode packages
 from dicomnode.lib.dicom_factory import Blueprint, DicomFactory, FillingStrategy
-from dicomnode.lib.dimse import Address
+from dicomnode.lib.dicom import dataset_digest, digest_bytes
+from dicomnode.lib.dimse import Address, AssociationPool, FindCache, MoveCoordinator
 from dicomnode.lib.exceptions import InvalidDataset, IncorrectlyConfigured
-from dicomnode.lib.io import TemporaryWorkingDirectory
+from dicomnode.lib.io import JobDirectory
 from dicomnode.lib.logging import log_traceback, set_logger
+from dicomnode.lib.metrics import InMemoryMetrics, MetricsServer, MetricsSink, get_metrics, set_metrics
+from dicomnode.lib.storage import DatasetStore, FileStore
 from dicomnode.server.assocation_container import AcceptedContainer, AssociationContainerFactory, AssociationTypes, CStoreContainer, ReleasedContainer
+from dicomnode.server.completion import CompletionScheduler
 from dicomnode.server.input import AbstractInput
 from dicomnode.server.pipeline_tree import PipelineTree, InputContainer, PatientNode
 from dicomnode.server.maintenance import MaintenanceThread
+from dicomnode.server.outbox import Outbox
 from dicomnode.server.output import PipelineOutput, NoOutput
 
 class AbstractPipeline():
@@ -54,16 +60,49 @@ class AbstractPipeline():
   # Directory for file Processing
   processing_directory: Optional[Path] = None
   """Base directory that the processing will take place in.
-  The specific directory that will run is: `processing_directory/patient_ID`
+  Each job gets the scratch directory `processing_directory/patient_ID`,
+  available as InputContainer.working_directory. The current working
+  directory is not changed, as it's shared by concurrent jobs. Consider a
+  tmpfs mount such as /dev/shm for I/O heavy processing.
   """
 
+  retain_failed_jobs: bool = False
+  """Keep the scratch directory of jobs, where processing or dispatching
+  failed, renamed to `patient_ID_failed_<timestamp>`, for inspection."""
+
+  shared_memory_threshold: Optional[int] = None
+  """If set, numpy arrays of at least this many bytes returned by the grinders
+  are placed in shared memory. InputContainer.get_shared gives a handle, which
+  is passed to worker processes by name rather than pickling the array. The
+  blocks are freed when the job finishes. If None arrays are not shared."""
+
+  process_on_ready: bool = False
+  """If True a patient is processed as soon as a C-STORE makes its inputs
+  ready, rather than when the association is released. The processing runs
+  in the thread handling the C-STORE, delaying the response to it. A
+  ShardedPipeline processes it in the job thread of the shard instead."""
+
+  completion_quiet_period: Optional[float] = None
+  """If set, patients are processed this many seconds after the release of
+  the association, that completed them, rather than at the release. Releases
+  within the period are coalesced into one processing job, and images
+  arriving for the patient cancel it until their association is released.
+  Useful for modalities sending a study as many associations.
+  If None patients are processed at the release"""
+
 
   # Maintenance Configuration
   maintenance_thread: Type[MaintenanceThread] = MaintenanceThread
   """Class of MaintenanceThread to be created when the server opens"""
 
-  study_expiration_days: int = 14
-  """The amount of days a study will hang in memory, before being clean up by the MaintenanceThread"""
+  study_expiration_days: Union[int, float] = 14
+  """The amount of days a study will hang in memory, before being clean up by
+  the MaintenanceThread. Can be fractional, and inputs can expire sooner, see
+  AbstractInput.expiration_time"""
+
+  expiry_removal_interval: float = 0.1
+  """Seconds between the removals of expired patients by the MaintenanceThread,
+  spreading out the deletion of their files"""
 
 
   # Input configuration
@@ -83,6 +122,34 @@ class AbstractPipeline():
   lazy_storage: bool = False
   "Indicates if the abstract inputs should use Lazy datasets or not"
 
+  storage_type: Type[DatasetStore] = FileStore
+  """Storage of the received datasets of each patient in the data_directory.
+  FileStore saves each dataset as a file, SegmentStore appends them to a single
+  file per patient and MemoryStore keeps them in memory, see
+  dicomnode.lib.storage"""
+
+  memory_budget: Optional[int] = None
+  """Max estimated bytes of received datasets held in memory. If exceeded, the
+  least recently updated patients are spilled to the data_directory as lazy
+  datasets. Without a data_directory or with a MemoryStore, C-STOREs are refused with status 0xA700
+  until processed patients free memory. If None memory use is unlimited"""
+
+  lazy_grinding: bool = False
+  """If True inputs are ground on first access from the InputContainer in
+  process, rather than before process is called. Inputs that process doesn't
+  use are never ground. The inputs see the images of the patient at the time
+  they're accessed. Note that maintenance doesn't wait for process, so if a
+  patient expires while it's processed, the stored datasets of an input may be
+  removed before the input is ground, failing the processing. The
+  study_expiration_days should be well above the processing time."""
+
+  release_ground_inputs: bool = False
+  """If True the received datasets of an input held in memory are released,
+  once the input have been ground, leaving lazy datasets in the data_directory.
+  Inputs are only released if their ground data doesn't contain the datasets,
+  such as the numpy array of a NumpyGrinder. Requires a data_directory with a
+  persistent storage_type."""
+
   pipeline_tree_type: Type[PipelineTree] = PipelineTree
   "Class of PipelineTree that the node will create as main data storage"
 
@@ -142,6 +209,59 @@ class AbstractPipeline():
   default_response_port: int = 104
   "Default Port used for unspecified Dicomnodes"
 
+  association_pool: Optional[AssociationPool] = None
+  """Pool of associations shared by HistoricAbstractInputs and outputs, pass it
+  to DicomOutput to reuse associations across patients.
+  If None every DIMSE message opens a new association"""
+
+  move_coordinator: Optional[MoveCoordinator] = None
+  """Coordinator of the C-MOVEs send by HistoricAbstractInputs. Identical moves
+  are coalesced and successful moves are cached, such that the same prior
+  studies are retrieved once. If None every new patient sends its own C-MOVEs"""
+
+  find_cache: Optional[FindCache] = None
+  """Cache of the C-FINDs send by HistoricAbstractInputs with a series_filter,
+  such that repeated lookups doesn't query the PACS again"""
+
+  historic_retrieval_workers: int = 4
+  """Max number of threads finding and moving the series of
+  HistoricAbstractInputs with a series_filter, shared by all patients"""
+
+  # Export Configuration
+  outbox_directory: Optional[Path] = None
+  """If it's a Path, outputs are persisted in this directory before being
+  dispatched, and outputs, which could not be dispatched, are retried in the
+  background. The input data of the patient is released once the output is
+  persisted. Outputs must be picklable.
+  If None an output, which fails to dispatch, is dropped."""
+
+  outbox_type: Type[Outbox] = Outbox
+  "Class of Outbox to be created, if outbox_directory is set"
+
+  outbox_retry_delay: float = 1.0
+  "Seconds before the first retry of an output, doubles for each failed retry"
+
+  outbox_max_retry_delay: float = 600.0
+  "Max seconds between retries of an output"
+
+  outbox_max_attempts: Optional[int] = None
+  """Attempts before an output is moved to the failed sub directory of
+  outbox_directory. If None an output is retried until it succeeds"""
+
+  # Metrics Configuration
+  metrics_sink: Optional[MetricsSink] = None
+  """Sink that the node and the library reports metrics to, see
+  dicomnode.lib.metrics. If None the global sink is left unchanged, which
+  discards metrics unless it has been set."""
+
+  metrics_port: Optional[int] = None
+  """If set, the metrics are served in the Prometheus text format at
+  http://metrics_ip:metrics_port/metrics. Requires metrics_sink to be None or
+  an InMemoryMetrics. If None no metrics endpoint is opened."""
+
+  metrics_ip: str = "localhost"
+  "IP of the metrics endpoint"
+
   #Logging Configuration
   number_of_backups: int = 8
   "Number of backups before the os starts deleting old logs"
@@ -194,6 +314,18 @@ class AbstractPipeline():
     if self.disable_pynetdicom_logger:
       getLogger("pynetdicom").setLevel(logging.INFO + 1)
 
+    # Metrics
+    if self.metrics_port is not None and self.metrics_sink is None:
+      self.metrics_sink = InMemoryMetrics()
+    if self.metrics_sink is not None:
+      set_metrics(self.metrics_sink)
+
+    self._metrics_server: Optional[MetricsServer] = None
+    if self.metrics_port is not None:
+      if not isinstance(self.metrics_sink, InMemoryMetrics):
+        raise IncorrectlyConfigured("A metrics endpoint requires the metrics_sink to be an InMemoryMetrics")
+      self._metrics_server = MetricsServer(self.metrics_sink, self.metrics_ip, self.metrics_port)
+
     # Load any previous state
     if self.data_directory is not None:
       if not isinstance(self.data_directory, Path):
@@ -205,6 +337,11 @@ class AbstractPipeline():
       if not self.data_directory.exists():
         self.data_directory.mkdir(parents=True)
 
+    self._retrieval_executor = ThreadPoolExecutor(
+      max_workers=self.historic_retrieval_workers,
+      thread_name_prefix="historic_retrieval"
+    )
+
     pipeline_tree_options = self.pipeline_tree_type.Options(
       ae_title=self.ae_title,
       data_directory=self.data_directory,
@@ -215,6 +352,14 @@ class AbstractPipeline():
       input_container_type=self.input_container_type,
       patient_container=self.patient_container_type,
       parent_input=self.parent_input,
+      association_pool=self.association_pool,
+      move_coordinator=self.move_coordinator,
+      find_cache=self.find_cache,
+      retrieval_executor=self._retrieval_executor,
+      memory_budget=self.memory_budget,
+      storage_type=self.storage_type,
+      lazy_grinding=self.lazy_grinding,
+      release_ground_inputs=self.release_ground_inputs,
     )
 
     self.data_state: PipelineTree = self.pipeline_tree_type(
@@ -224,10 +369,30 @@ class AbstractPipeline():
     )
 
     self._maintenance_thread = self.maintenance_thread(
-      self.data_state, self.study_expiration_days, daemon=True)
+      self.data_state, self.study_expiration_days, daemon=True,
+      removal_interval=self.expiry_removal_interval)
 
     self._association_container_factory = self.association_container_factory()
 
+    self._completion_scheduler: Optional[CompletionScheduler] = None
+    if self.completion_quiet_period is not None:
+      self._completion_scheduler = CompletionScheduler(
+        self.completion_quiet_period, self._process_completed_patient)
+
+    self._in_flight: Dict[str, Optional[ReleasedContainer]] = {}
+    "Patients being processed, mapped to the trigger of their rerun if any"
+    self._in_flight_lock = Lock()
+
+    self._outbox: Optional[Outbox] = None
+    if self.outbox_directory is not None:
+      self._outbox = self.outbox_type(
+        self.outbox_directory,
+        self._dispatch,
+        base_delay=self.outbox_retry_delay,
+        max_delay=self.outbox_max_retry_delay,
+        max_attempts=self.outbox_max_attempts
+      )
+
     # Server validations and creation.
     self.ae = AE(ae_title = self.ae_title)
     # You need VerificationPresentationContexts for ECHOSCU
@@ -256,26 +421,74 @@ class AbstractPipeline():
     - handle_c_store_message - extracts information from event
     - control_c_store_function - main function responsible for calling correct functions
   """
+  def _c_store_digest(self, event: evt.Event) -> Optional[bytes]:
+    """Computes the digest of the dataset of a C-STORE, which is the same as
+    dataset_digest of the dataset, such that images added by add_image and
+    by C-STORE are recognized as duplicates of each other."""
+    data_set = getattr(event.request, "DataSet", None)
+    if data_set is None:
+      return None
+    if event.context.transfer_syntax == ImplicitVRLittleEndian:
+      # The received bytes are the encoding digested by dataset_digest, so
+      # the image isn't decoded
+      return digest_bytes(data_set.getbuffer())
+    return dataset_digest(event.dataset)
+
   def _handle_c_store(self, event: evt.Event) -> int:
-    c_store_container = self._association_container_factory.build_assocation_c_store(event)
-    status = self._consume_c_store_container(c_store_container)
+    metrics = get_metrics()
+    data_set = getattr(event.request, "DataSet", None)
+    with metrics.time("dicomnode_stage_seconds", {"stage" : "c_store"}):
+      digest = self._c_store_digest(event)
+      sop_instance_uid = getattr(event.request, "AffectedSOPInstanceUID", None)
+      # Re-sent images are skipped before they're decoded
+      duplicate_patient: Optional[str] = None
+      if digest is not None and sop_instance_uid is not None:
+        duplicate_patient = self.data_state.find_duplicate(str(sop_instance_uid), digest)
+      if duplicate_patient is not None:
+        # The patient is still processed on release, as an earlier attempt
+        # might have failed and the images are re-sent to retry it
+        self.updated_patients[event.assoc.native_id].add(duplicate_patient)
+        status = 0x0000
+      else:
+        c_store_container = self._association_container_factory.build_assocation_c_store(event, digest)
+        status = self._consume_c_store_container(c_store_container)
+    metrics.increment("dicomnode_images_received_total")
+    if data_set is not None:
+      metrics.increment("dicomnode_bytes_received_total", data_set.getbuffer().nbytes)
     self.logger.debug(f"Handled C STORE with status {hex(status)}")
     return status
 
   def _consume_c_store_container(self, c_store_container: CStoreContainer) -> int:
     try:
-      if not self.filter(c_store_container.dataset):
+      with get_metrics().time("dicomnode_stage_seconds", {"stage" : "filter"}):
+        accepted = self.filter(c_store_container.dataset)
+      if not accepted:
         self.logger.warning("Dataset discarded")
         return 0xB006 # Element discarded
     except Exception as exception:
       log_traceback(self.logger, exception, "User flter")
       return 0xA801
 
+    if self.data_state.exceeds_memory_budget():
+      self.logger.warning("Memory budget exceeded, refusing dataset")
+      return 0xA700 # Refused: Out of resources
+
     if self.patient_identifier_tag in c_store_container.dataset:
       patientID = deepcopy(c_store_container.dataset[self.patient_identifier_tag].value)
       try:
-        self.data_state.add_image(c_store_container.dataset)
-        self.updated_patients[c_store_container.assocation_id].add(patientID)
+        self.data_state.add_image(c_store_container.dataset, c_store_container.digest)
+        if self._completion_scheduler is not None:
+          self._completion_scheduler.cancel(patientID)
+        if self.process_on_ready and self.data_state.validate_patient_ID(patientID):
+          self.logger.debug(f"Patient {patientID} became ready")
+          self.updated_patients[c_store_container.assocation_id].discard(patientID)
+          self._process_ready_patient(patientID, ReleasedContainer(
+            c_store_container.assocation_id,
+            {AssociationTypes.StoreAssociation},
+            c_store_container.assocation_ae_title,
+            c_store_container.assocation_ip))
+        else:
+          self.updated_patients[c_store_container.assocation_id].add(patientID)
       except InvalidDataset:
         self.logger.info(f"Received dataset is not accepted by any inputs")
         return 0xB006
@@ -346,17 +559,91 @@ class AbstractPipeline():
     for patient_ID in self.updated_patients[released_container.assocation_id]:
       if self.data_state.validate_patient_ID(patient_ID):
         self.logger.debug(f"Sufficient data for patient {patient_ID}")
-        # Sadly my python Foo is not strong enough make a pretty solution here
-        if self.processing_directory is not None:
-          with TemporaryWorkingDirectory(self.processing_directory / str(patient_ID)) as twd:
-            self._pipeline_processing(patient_ID, released_container)
+        if self._completion_scheduler is not None:
+          self._completion_scheduler.schedule(patient_ID, released_container)
         else:
-          self._pipeline_processing(patient_ID, released_container)
+          self._process_patient(patient_ID, released_container)
       else:
         self.logger.debug(f"Insufficient data for patient {patient_ID}")
     del self.updated_patients[released_container.assocation_id] # Removing updated Patients
 
-  def _pipeline_processing(self, patient_ID: str, released_container: ReleasedContainer):
+  def _is_patient_ready(self, patient_ID: str) -> bool:
+    try:
+      return self.data_state.validate_patient_ID(patient_ID)
+    except KeyError:
+      # Processed or expired by another thread
+      return False
+
+  def _process_completed_patient(self, patient_ID: str, released_container: ReleasedContainer) -> None:
+    """Processes a patient, which has been quiet for completion_quiet_period.
+    The patient is validated again, as it might have been removed or
+    processed in the meantime.
+    """
+    if self._is_patient_ready(patient_ID):
+      self._process_patient(patient_ID, released_container)
+    else:
+      self.logger.debug(f"Completed patient {patient_ID} is no longer ready for processing")
+
+  def _process_ready_patient(self, patient_ID: str, released_container: ReleasedContainer) -> None:
+    """Processes a patient, which was made ready by a C-STORE, see
+    process_on_ready. By default the patient is processed in the thread
+    handling the C-STORE."""
+    self._process_patient(patient_ID, released_container)
+
+  def _process_patient(self, patient_ID: str, released_container: ReleasedContainer) -> None:
+    """Processes a validated patient, unless the patient is already being
+    processed.
+
+    At most one job per patient runs at a time. Triggers arriving while the
+    patient is processed are folded into a single rerun, which happens if
+    the patient still have sufficient data once the job finishes, as it might
+    have been processed or removed in the meantime.
+
+    Args:
+      patient_ID (str): Indentifier of the patient to be processed
+      released_container (ReleasedContainer): The association triggering the
+        processing
+    """
+    with self._in_flight_lock:
+      if patient_ID in self._in_flight:
+        self._in_flight[patient_ID] = released_container
+        get_metrics().increment("dicomnode_folded_triggers_total")
+        self.logger.debug(f"Patient {patient_ID} is being processed, folding trigger into a rerun")
+        return
+      self._in_flight[patient_ID] = None
+
+    next_container: Optional[ReleasedContainer] = released_container
+    rerun = False
+    while next_container is not None:
+      try:
+        if not rerun or self._is_patient_ready(patient_ID):
+          if self.processing_directory is not None:
+            with JobDirectory(self.processing_directory, str(patient_ID),
+                              self.retain_failed_jobs) as job_directory:
+              if not self._pipeline_processing(patient_ID, next_container, job_directory.path):
+                job_directory.mark_failed()
+            if job_directory.retained_path is not None:
+              self.logger.warning(f"Kept directory of failed job at {job_directory.retained_path}")
+          else:
+            self._pipeline_processing(patient_ID, next_container)
+        else:
+          self.logger.debug(f"Patient {patient_ID} is no longer ready for processing")
+      except BaseException:
+        with self._in_flight_lock:
+          del self._in_flight[patient_ID]
+        raise
+      with self._in_flight_lock:
+        next_container = self._in_flight[patient_ID]
+        if next_container is None:
+          del self._in_flight[patient_ID]
+        else:
+          self._in_flight[patient_ID] = None
+      rerun = True
+
+  def _pipeline_processing(self,
+                           patient_ID: str,
+                           released_container: ReleasedContainer,
+                           working_directory: Optional[Path] = None) -> bool:
     """Processes a patient through the pipeline and starts exporting it
 
     Args:
@@ -364,20 +651,50 @@ class AbstractPipeline():
       released_container: (ReleasedContainer): data proccessing starts
         after an assocation is released. This is the data from the released
         association.
+      working_directory (Optional[Path]): Scratch directory of the job, see
+        InputContainer.working_directory
+
+    Returns:
+      bool: If the patient was processed and the output dispatched or
+        persisted in the outbox
     """
     self.logger.debug(f"Processing {patient_ID}")
+    patient_input_container: Optional[InputContainer] = None
     try:
-      patient_input_container = self._get_input_container(patient_ID, released_container)
-      result = self.process(patient_input_container)
-    except Exception as exception:
-      log_traceback(self.logger, exception, "processing")
-    else:
-      self.logger.debug(f"Process {patient_ID} Successful, Dispatching output!")
-      if self._dispatch(result):
-        self.logger.debug("Dispatching Successful")
-        self.data_state.remove_patient(patient_ID)
+      try:
+        patient_input_container = self._get_input_container(patient_ID, released_container, working_directory)
+        with get_metrics().time("dicomnode_stage_seconds", {"stage" : "process"}):
+          result = self.process(patient_input_container)
+      except Exception as exception:
+        log_traceback(self.logger, exception, "processing")
+        return False
       else:
-        self.logger.error("Unable to dispatch pipeline output")
+        self.logger.debug(f"Process {patient_ID} Successful, Dispatching output!")
+        if self._outbox is not None:
+          try:
+            dispatched = self._outbox.put(result)
+          except Exception as exception:
+            log_traceback(self.logger, exception, "Persisting output in outbox")
+            return False
+          else:
+            # The output is durable, so the input data is no longer needed
+            self.data_state.remove_patient(patient_ID)
+            if dispatched:
+              self.logger.debug("Dispatching Successful")
+            else:
+              self.logger.warning(f"Unable to dispatch output of {patient_ID}, it will be retried")
+            return True
+        if self._dispatch(result):
+          self.logger.debug("Dispatching Successful")
+          self.data_state.remove_patient(patient_ID)
+          return True
+        else:
+          self.logger.error("Unable to dispatch pipeline output")
+          return False
+    finally:
+      # Shared memory blocks of the job are freed once the job finishes
+      if patient_input_container is not None:
+        patient_input_container.release()
 
   def _dispatch(self, output: PipelineOutput) -> bool:
     """This function is responsible for triggering exporting of data and handling errors.
@@ -389,13 +706,17 @@ class AbstractPipeline():
         bool - If the output was successful in exporting the data.
     """
     try:
-      success = output.send()
+      with get_metrics().time("dicomnode_stage_seconds", {"stage" : "dispatch"}):
+        success = output.send()
     except Exception as exception:
       log_traceback(self.logger, exception, "Output send function")
       success = False
     return success
 
-  def _get_input_container(self, patient_ID: str, released_container: ReleasedContainer) -> InputContainer:
+  def _get_input_container(self,
+                           patient_ID: str,
+                           released_container: ReleasedContainer,
+                           working_directory: Optional[Path] = None) -> InputContainer:
     """This function retrives an input container for processing and
     fills out any information unavailable at object creation.
 
@@ -403,8 +724,12 @@ class AbstractPipeline():
       patient_ID (str): ID of the patient who data is in the input container
       released_container (ReleasedContainer): dataclass with relevant
         information from when event was released.
+      working_directory (Optional[Path]): Scratch directory of the job
     """
     input_container = self.data_state.get_patient_input_container(patient_ID)
+    input_container.working_directory = working_directory
+    if self.shared_memory_threshold is not None:
+      input_container.share_arrays(self.shared_memory_threshold)
 
     if released_container.assocation_ae_title in self.known_endpoints:
       input_container.responding_address = self.known_endpoints[released_container.assocation_ae_title]
@@ -459,11 +784,28 @@ class AbstractPipeline():
     """
     self.logger.info("Closing Server!")
     if self.processing_directory is not None:
-      chdir(self.__cwd)
-      shutil.rmtree(self.processing_directory)
+      if self.retain_failed_jobs and any(self.processing_directory.iterdir()):
+        self.logger.info(f"Keeping {self.processing_directory} with directories of failed jobs")
+      else:
+        shutil.rmtree(self.processing_directory, ignore_errors=True)
 
     self._maintenance_thread.stop()
 
+    if self._completion_scheduler is not None:
+      self._completion_scheduler.stop()
+
+    if self._outbox is not None:
+      self._outbox.stop()
+
+    # Retrievals in progress are completed in the background
+    self._retrieval_executor.shutdown(wait=False, cancel_futures=True)
+
+    if self.association_pool is not None:
+      self.association_pool.close()
+
+    if self._metrics_server is not None:
+      self._metrics_server.stop()
+
     self.ae.shutdown()
 
 
@@ -475,14 +817,7 @@ class AbstractPipeline():
       Keyword Args:
         blocking (bool) : if true, this functions doesn't return.
     """
-    if self.processing_directory is not None:
-      self.__cwd = getcwd()
-      if not self.processing_directory.exists():
-        # Multiple Threads might attempt to create the directory at the same time
-        self.processing_directory.mkdir(exist_ok=True)
-      chdir(self.processing_directory)
-
-    self._maintenance_thread.start()
+    self._open_services()
     self.logger.info(f"Starting Server at port: {self.port} and AE: {self.ae_title}")
     self.ae.start_server(
       (self.ip,self.port),
@@ -490,6 +825,21 @@ class AbstractPipeline():
       evt_handlers=self._evt_handlers)
 
 
+  def _open_services(self) -> None:
+    """Starts everything but the AE, such as the background threads"""
+    if self.processing_directory is not None:
+      # Multiple Threads might attempt to create the directory at the same time
+      self.processing_directory.mkdir(parents=True, exist_ok=True)
+
+    self._maintenance_thread.start()
+    if self._completion_scheduler is not None:
+      self._completion_scheduler.start()
+    if self._outbox is not None:
+      self._outbox.start()
+    if self._metrics_server is not None:
+      self._metrics_server.start()
+
+
   ##### Handler Directories #####
   # Handlers are an extendable way of
 
@@ -517,6 +867,7 @@ class AbstractQueuedPipeline(AbstractPipeline):
     while self.running:
       try:
         released_container = self.process_queue.get(timeout=self.queue_timeout)
+        get_metrics().set_gauge("dicomnode_queue_depth", self.process_queue.qsize())
         try:
           for association_type in released_container.assocation_types:
             handler = self._release_handlers.get(association_type)
@@ -535,6 +886,7 @@ class AbstractQueuedPipeline(AbstractPipeline):
     released_container = self._association_container_factory.build_assocation_released(event)
 
     self.process_queue.put(released_container)
+    get_metrics().set_gauge("dicomnode_queue_depth", self.process_queue.qsize())
 
 
   def __init__(self) -> None:
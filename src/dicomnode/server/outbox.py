@@ -0,0 +1,219 @@
+"""Contains the Outbox, a durable export queue for pipeline outputs.
+
+  Outputs are pickled to disk before being sent, such that an output, which
+  cannot be delivered, is retried in the background rather than recomputed.
+"""
+
+__author__ = "Christoffer Vilstrup Jensen"
+
+# Python3 standard Library
+from heapq import heappop, heappush
+from itertools import count
+import os
+from pathlib import Path
+import pickle
+from threading import Condition, Thread
+from time import monotonic
+from typing import Callable, List, Optional, Tuple, Union
+from uuid import uuid4
+
+# Third party Packages
+
+# Dicomnode packages
+from dicomnode.lib.logging import get_logger, log_traceback
+from dicomnode.server.output import PipelineOutput
+
+logger = get_logger()
+
+class Outbox:
+  """Persistent queue of outputs waiting to be exported.
+
+  An output put in the outbox is written to the directory, then an attempt to
+  send it is made in the calling thread. If the attempt fails, a background
+  thread retries with exponential backoff, until the output is sent or
+  max_attempts is reached, at which point it's moved to the failed
+  sub directory. Outputs found in the directory on creation, such as the ones
+  left over by a crash, are retried when the outbox is started.
+
+  Outputs must be picklable, in particular datasets must be in lists rather
+  than generators. Only the undelivered part of a failed output is retried,
+  see PipelineOutput.undelivered.
+
+  Args:
+    directory (Path | str): Directory where pending outputs are stored
+    dispatch (Callable[[PipelineOutput], bool]): Function that sends an output,
+      returning if it was successful.
+    base_delay (float): Seconds before the first retry, each following retry
+      doubles the delay. Defaults to 1.0
+    max_delay (float): Max seconds between retries. Defaults to 600.0
+    max_attempts (Optional[int]): Number of attempts before an output is
+      given up on, None retries indefinitely. Defaults to None.
+
+  Example:
+  >>> outbox = Outbox(Path("outbox"), lambda output: output.send())
+  >>> outbox.start()
+  >>> outbox.put(output)
+  False # The destination is down, but output is retried in the background
+  """
+  suffix = ".output"
+  failed_directory_name = "failed"
+
+  def __init__(self,
+               directory: Union[Path, str],
+               dispatch: Callable[[PipelineOutput], bool],
+               base_delay: float = 1.0,
+               max_delay: float = 600.0,
+               max_attempts: Optional[int] = None) -> None:
+    self.directory = Path(directory)
+    self.dispatch = dispatch
+    self.base_delay = base_delay
+    self.max_delay = max_delay
+    self.max_attempts = max_attempts
+
+    self.directory.mkdir(parents=True, exist_ok=True)
+
+    self._condition = Condition()
+    self._sequence = count()
+    self._schedule: List[Tuple[float, int, Path, int]] = [] # (due, tiebreak, path, attempts)
+    self._running = False
+    self._thread: Optional[Thread] = None
+
+    now = monotonic()
+    for path in sorted(self.directory.glob(f"*{self.suffix}")):
+      self._schedule_attempt(path, 0, now)
+
+  def __len__(self) -> int:
+    """Number of outputs waiting to be retried"""
+    with self._condition:
+      return len(self._schedule)
+
+  def _schedule_attempt(self, path: Path, attempts: int, due: float) -> None:
+    with self._condition:
+      heappush(self._schedule, (due, next(self._sequence), path, attempts))
+      self._condition.notify()
+
+  def _persist(self, output: PipelineOutput, path: Optional[Path] = None) -> Path:
+    if path is None:
+      path = self.directory / f"{uuid4().hex}{self.suffix}"
+    temporary_path = path.with_suffix(".tmp")
+    try:
+      with open(temporary_path, 'wb') as file:
+        pickle.dump(output, file, protocol=pickle.HIGHEST_PROTOCOL)
+        file.flush()
+        os.fsync(file.fileno())
+    except Exception:
+      temporary_path.unlink(missing_ok=True)
+      raise
+    os.replace(temporary_path, path) # A crash never leaves a half written output
+    return path
+
+  def _attempt(self, path: Path, output: PipelineOutput, attempts: int) -> bool:
+    try:
+      success = self.dispatch(output)
+    except Exception as exception:
+      log_traceback(logger, exception, "Outbox dispatch")
+      success = False
+
+    attempts += 1
+    if success:
+      path.unlink(missing_ok=True)
+      return True
+
+    # Destinations, which succeeded, are not sent to again
+    undelivered = output.undelivered()
+    if undelivered is not output:
+      try:
+        self._persist(undelivered, path)
+      except Exception as exception:
+        log_traceback(logger, exception, f"Persisting the undelivered part of {path.name}")
+
+    if self.max_attempts is not None and self.max_attempts <= attempts:
+      failed_directory = self.directory / self.failed_directory_name
+      failed_directory.mkdir(exist_ok=True)
+      os.replace(path, failed_directory / path.name)
+      logger.error(f"Giving up on {path.name} after {attempts} attempts")
+      return False
+
+    delay = min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+    logger.info(f"Unable to send {path.name}, retrying in {delay} seconds")
+    self._schedule_attempt(path, attempts, monotonic() + delay)
+    return False
+
+  def put(self, output: PipelineOutput) -> bool:
+    """Persists the output and attempts to send it.
+
+    Once this function returns the output is durable, and the data it was
+    computed from can be released.
+
+    Args:
+        output (PipelineOutput): The output to be exported
+
+    Raises:
+        pickle.PicklingError: If the output cannot be serialized
+        OSError: If the output cannot be written to the directory
+
+    Returns:
+        bool: If the output was sent, if False it will be retried.
+    """
+    path = self._persist(output)
+    return self._attempt(path, output, 0)
+
+  def retry_due(self, now: Optional[float] = None) -> int:
+    """Attempts to send every output, which retry is due.
+
+    Args:
+        now (Optional[float], optional): monotonic time to compare against.
+          Defaults to None, which is the current time.
+
+    Returns:
+        int: Number of outputs successfully sent
+    """
+    if now is None:
+      now = monotonic()
+    due = []
+    with self._condition:
+      while len(self._schedule) and self._schedule[0][0] <= now:
+        _, _, path, attempts = heappop(self._schedule)
+        due.append((path, attempts))
+
+    sent = 0
+    for path, attempts in due:
+      try:
+        with open(path, 'rb') as file:
+          output = pickle.load(file)
+      except Exception as exception:
+        log_traceback(logger, exception, f"Loading {path.name} from outbox")
+        continue
+      if self._attempt(path, output, attempts):
+        sent += 1
+    return sent
+
+  def _run(self) -> None:
+    while True:
+      with self._condition:
+        while self._running:
+          if len(self._schedule) and self._schedule[0][0] <= monotonic():
+            break
+          timeout = None if not len(self._schedule) else self._schedule[0][0] - monotonic()
+          self._condition.wait(timeout)
+        if not self._running:
+          return
+      self.retry_due()
+
+  def start(self) -> None:
+    """Starts the background thread retrying failed outputs"""
+    with self._condition:
+      if self._running:
+        return
+      self._running = True
+    self._thread = Thread(target=self._run, name="Outbox", daemon=True)
+    self._thread.start()
+
+  def stop(self) -> None:
+    """Stops the background thread, pending outputs stay on disk"""
+    with self._condition:
+      self._running = False
+      self._condition.notify_all()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
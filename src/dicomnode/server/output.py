@@ -4,22 +4,91 @@ __author__ = "Christoffer Vilstrup Jensen"
 
 # Python Standart Library
 from abc import ABC, abstractmethod
+from collections.abc import Iterator
+from copy import copy
+from dataclasses import dataclass
+from functools import partial
 import logging
 from pathlib import Path
-from typing import Any, Dict, List, Iterable, Tuple, Type, Callable
+from threading import Event
+from time import monotonic
+from typing import Any, Dict, List, Iterable, Optional, Tuple, Type, Callable
 
 # Third Party Packages
 from pydicom import Dataset
 
 # Dicomnode Packages
-from dicomnode.lib.exceptions import CouldNotCompleteDIMSEMessage
-from dicomnode.lib.dimse import Address, send_images
+from dicomnode.lib.exceptions import CouldNotCompleteDIMSEMessage, IncorrectlyConfigured
+from dicomnode.lib.dicom import make_meta
+from dicomnode.lib.dimse import Address, AssociationPool, send_images, send_images_sharded
 from dicomnode.lib.image_tree import DicomTree, ImageTreeInterface
 from dicomnode.lib.io import save_dicom
-from dicomnode.lib.logging import get_logger
+from dicomnode.lib.logging import get_logger, log_traceback
+from dicomnode.lib.metrics import get_metrics
+from dicomnode.lib.utils import ThreadWithReturnValue
 
 logger = get_logger()
 
+@dataclass
+class DispatchResult:
+  """The outcome of sending to a single destination"""
+  destination: Any
+  success: bool
+  timed_out: bool = False
+
+
+def _run_job(destination: Any, job: Callable[[], bool]) -> bool:
+  try:
+    return job()
+  except Exception as exception:
+    log_traceback(logger, exception, f"Sending to {destination}")
+    return False
+
+def dispatch_concurrently(jobs: List[Tuple[Any, Callable[[], bool]]],
+                          timeout: Optional[float] = None,
+                          parallel: bool = True) -> List[DispatchResult]:
+  """Runs each send job in its own thread, such that the wall time is that of
+  the slowest destination rather than the sum of all destinations.
+
+  A job that raises counts as a failure. A job still running after timeout
+  seconds counts as a failure and is abandoned, the thread is a daemon
+  and will not block shutdown. The job itself is not stopped, so callers
+  should stop timed out jobs, like DicomOutput aborts their associations.
+
+  Args:
+      jobs (List[Tuple[Any, Callable[[], bool]]]): Pairs of destination and a
+        function sending to it, returning if the send was successful.
+      timeout (Optional[float], optional): Seconds each destination have to
+        complete, measured from the start of the dispatch. Defaults to None.
+      parallel (bool, optional): If False the jobs are run one after another
+        in the calling thread, and timeout is ignored. Defaults to True.
+
+  Returns:
+      List[DispatchResult]: Results in the same order as jobs
+  """
+  if not parallel or (len(jobs) == 1 and timeout is None):
+    return [DispatchResult(destination, bool(_run_job(destination, job)))
+            for destination, job in jobs]
+
+  threads: List[ThreadWithReturnValue] = []
+  for destination, job in jobs:
+    thread = ThreadWithReturnValue(target=_run_job, args=(destination, job), daemon=True)
+    thread.start()
+    threads.append(thread)
+
+  deadline = None if timeout is None else monotonic() + timeout
+  results = []
+  for (destination, _), thread in zip(jobs, threads):
+    remaining = None if deadline is None else max(deadline - monotonic(), 0.0)
+    success = thread.join(remaining)
+    if thread.is_alive():
+      logger.error(f"Sending to {destination} timed out after {timeout} seconds")
+      results.append(DispatchResult(destination, False, timed_out=True))
+    else:
+      results.append(DispatchResult(destination, bool(success)))
+  return results
+
+
 class PipelineOutput(ABC):
   """Base Class for pipeline outputs.
   This class carries the responsibility for sending processed data to the endpoint
@@ -44,6 +113,21 @@ class PipelineOutput(ABC):
     """
     raise NotImplementedError # pragma: no cover
 
+  def cancel(self) -> None:
+    """Stops a send, that is still running, such as one that timed out in a
+    MultiOutput. Outputs, that cannot be stopped, finish their send.
+    """
+
+  def undelivered(self) -> 'PipelineOutput':
+    """Gets the part of the output, which the last send didn't deliver, such
+    that a retry doesn't export to the destinations, that succeeded. Outputs
+    without a result per destination are retried in full.
+
+    Returns:
+      PipelineOutput: The output to be retried
+    """
+    return self
+
   def __iter__(self):
     for destination, payload in self.output:
       yield destination, payload
@@ -52,29 +136,105 @@ class DicomOutput(PipelineOutput):
   """PipelineOutput that export dicom series via the DIMSE message
   protocol
 
+  The destinations are sent to concurrently, the outcome per destination is
+  available in the results attribute after sending. Destinations, that time
+  out, are aborted before their next C-STORE, such that a destination isn't
+  reported as failed while it's still being sent to.
+
   Args:
     output (List[Tuple[Address, Iterable[Dataset]]]) - A list of output
     ae_title (str): - SCU ae title
-
+    pool (Optional[AssociationPool]): - Pool of associations to reuse,
+      such as the association_pool of the pipeline
+    timeout (Optional[float]): - Seconds each destination have to complete
+    parallel (bool): - If False the destinations are sent to one at a time
+    shards (int): - Number of concurrent associations used per destination,
+      see send_images_sharded
+
+  Datasets given as an iterator, such as the stream of
+  NumpyFactory.build_from_slabs, are consumed by sending them, so such a
+  stream can only be sent to a single destination and only once.
+
+  Raises:
+    IncorrectlyConfigured: If an iterator of datasets is given to more than
+      one destination
   """
   output: List[Tuple[Address, Iterable[Dataset]]]
   "Outputs to be send"
 
   def __init__(self,
                output: List[Tuple[Address, Iterable[Dataset]]],
-               ae_title: str) -> None:
+               ae_title: str,
+               pool: Optional[AssociationPool] = None,
+               timeout: Optional[float] = None,
+               parallel: bool = True,
+               shards: int = 1) -> None:
     self.ae = ae_title
+    self.pool = pool
+    self.timeout = timeout
+    self.parallel = parallel
+    self.shards = shards
+    self.results: List[DispatchResult] = []
+    self._aborts: List[Event] = []
+    self._streamed = False
+    streams = [id(datasets) for _, datasets in output if isinstance(datasets, Iterator)]
+    if len(streams) != len(set(streams)):
+      raise IncorrectlyConfigured("A stream of datasets can only be sent to a single destination")
     super().__init__(output)
 
+  def _send_to(self, address: Address, datasets: Iterable[Dataset], abort: Event) -> bool:
+    try:
+      with get_metrics().time("dicomnode_output_seconds", {"destination" : address.ae_title}):
+        if self.shards > 1:
+          send_images_sharded(self.ae, address, datasets, self.shards, pool=self.pool, abort=abort)
+        else:
+          send_images(self.ae, address, datasets, pool=self.pool, abort=abort)
+    except CouldNotCompleteDIMSEMessage:
+      logger.error(f"Could not send to images to {address.ae_title}")
+      return False
+    return True
+
+  def __getstate__(self) -> Dict[str, Any]:
+    # Pools hold open associations, which cannot be pickled, such as by an Outbox
+    state = self.__dict__.copy()
+    state['pool'] = None
+    state['_aborts'] = []
+    return state
+
   def send(self) -> bool:
-    success = True
-    for address, datasets in self:
-      try:
-        send_images(self.ae, address, datasets)
-      except CouldNotCompleteDIMSEMessage:
-        logger.error(f"Could not send to images to {address.ae_title}")
-        success = False
-    return success
+    if any(isinstance(datasets, Iterator) for _, datasets in self):
+      if self._streamed:
+        raise IncorrectlyConfigured("The streams of datasets have been consumed by an earlier send")
+      self._streamed = True
+    if 1 < len(self.output):
+      # Destinations may share datasets, so their meta headers are made before
+      # they're sent concurrently, as make_meta modifies the dataset
+      for _, datasets in self:
+        if not isinstance(datasets, Iterator):
+          for dataset in datasets:
+            if not hasattr(dataset, 'file_meta') or 0x00020010 not in dataset.file_meta:
+              make_meta(dataset)
+    self._aborts = [Event() for _ in self.output]
+    jobs = [(address, partial(self._send_to, address, datasets, abort))
+            for (address, datasets), abort in zip(self, self._aborts)]
+    self.results = dispatch_concurrently(jobs, self.timeout, self.parallel)
+    for result, abort in zip(self.results, self._aborts):
+      if result.timed_out:
+        abort.set()
+    return all(result.success for result in self.results)
+
+  def cancel(self) -> None:
+    for abort in self._aborts:
+      abort.set()
+
+  def undelivered(self) -> 'DicomOutput':
+    if len(self.results) != len(self.output):
+      return self
+    undelivered = copy(self)
+    undelivered.output = [entry for entry, result in zip(self.output, self.results)
+                          if not result.success]
+    undelivered.results = []
+    return undelivered
 
 class NoOutput(PipelineOutput):
   output = []
@@ -144,15 +304,37 @@ class MultiOutput(PipelineOutput):
     ])
   >>>multi_output.send()
   True
+
+  The outputs are sent concurrently, the outcome per output is available in
+  the results attribute after sending.
   """
 
-  def __init__(self, outputs: Iterable[PipelineOutput]) -> None:
-    self.outputs = outputs
+  def __init__(self,
+               outputs: Iterable[PipelineOutput],
+               timeout: Optional[float] = None,
+               parallel: bool = True) -> None:
+    self.outputs = list(outputs)
+    self.timeout = timeout
+    self.parallel = parallel
+    self.results: List[DispatchResult] = []
 
   def send(self) -> bool:
-    success = True
-
+    jobs = [(output, output.send) for output in self.outputs]
+    self.results = dispatch_concurrently(jobs, self.timeout, self.parallel)
+    for result in self.results:
+      if result.timed_out:
+        result.destination.cancel()
+    return all(result.success for result in self.results)
+
+  def cancel(self) -> None:
     for output in self.outputs:
-      success &= output.send()
-
-    return success
+      output.cancel()
+
+  def undelivered(self) -> 'MultiOutput':
+    if len(self.results) != len(self.outputs):
+      return self
+    undelivered = copy(self)
+    undelivered.outputs = [output.undelivered() for output, result in zip(self.outputs, self.results)
+                           if not result.success]
+    undelivered.results = []
+    return undelivered
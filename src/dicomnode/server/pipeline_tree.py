@@ -7,41 +7,170 @@
 __author__ = "Christoffer Vilstrup Jensen"
 
 # Python Standard Library
+from concurrent.futures import Executor
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import datetime, timedelta
+from functools import partial
+from heapq import heapify, heappop, heappush
+from itertools import count
 import logging
 from logging import Logger
 from pathlib import Path
 import shutil
-from typing import Any, Callable, Dict, List, Optional, Type, Union, Iterable
+from threading import Lock, RLock
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type, Union, Iterable
 
 # Third Party Python Packages
+import numpy
 from pydicom import Dataset
 
 # Dicomnode Library Packages
+from dicomnode.lib.dicom import dataset_digest, estimate_dataset_size
 from dicomnode.lib.dicom_factory import DicomFactory, SeriesHeader, Blueprint, FillingStrategy
-from dicomnode.lib.dimse import Address
+from dicomnode.lib.dimse import Address, AssociationPool, FindCache, MoveCoordinator
 from dicomnode.lib.exceptions import (InvalidDataset, InvalidRootDataDirectory,
                                       InvalidTreeNode, HeaderConstructionFailure)
 from dicomnode.lib.image_tree import ImageTreeInterface
+from dicomnode.lib.lazy_dataset import LazyDataset
+from dicomnode.lib.metrics import get_metrics
 from dicomnode.lib.logging import log_traceback, get_logger
+from dicomnode.lib.shared_memory import SharedArray
+from dicomnode.lib.storage import DatasetStore, FileStore
 from dicomnode.server.input import AbstractInput, DynamicInput, DynamicLeaf
 
+def _resident_bytes(datasets: Iterable[Dataset]) -> int:
+  # Inputs may share a dataset, so each dataset is only counted once
+  seen = set()
+  nbytes = 0
+  for dataset in datasets:
+    if isinstance(dataset, LazyDataset) or id(dataset) in seen:
+      continue
+    seen.add(id(dataset))
+    nbytes += estimate_dataset_size(dataset)
+  return nbytes
+
+def _released_bytes(datasets: Iterable[Dataset], others: Iterable[Iterable[Dataset]]) -> int:
+  # Datasets, which other inputs hold in memory, are not freed by a release
+  held = {id(dataset) for other in others for dataset in other if not isinstance(dataset, LazyDataset)}
+  return _resident_bytes(dataset for dataset in datasets if id(dataset) not in held)
+
+def _aliases_datasets(data: Any) -> bool:
+  # Grinders like the ListGrinder and DicomTreeGrinder return the datasets
+  # themselves, which are kept alive by the ground data, even if released.
+  if isinstance(data, numpy.ndarray):
+    return data.dtype == object
+  if isinstance(data, (str, bytes, int, float, bool, type(None))):
+    return False
+  if isinstance(data, (list, tuple)):
+    return any(_aliases_datasets(item) for item in data)
+  if isinstance(data, dict):
+    return any(_aliases_datasets(item) for item in data.values())
+  return True
+
+
 class InputContainer:
   """Simple container class for grinded input.
+
+  Inputs given as grinders are ground on first access and the result is
+  memoized, such that inputs that process doesn't use are never ground.
   """
   responding_address: Optional[Address] = None
+  working_directory: Optional[Path] = None
+  "Scratch directory of the processing job, see AbstractPipeline.processing_directory"
 
   def __init__(self,
                data: Dict[str, Any],
                header: Optional[SeriesHeader] = None,
-               paths: Optional[Dict[str, Path]] = None) -> None:
+               paths: Optional[Dict[str, Path]] = None,
+               grinders: Optional[Dict[str, Callable[[], Any]]] = None) -> None:
     self.__data = data
     self.header = header
     self.paths  = paths
+    self.__grinders: Dict[str, Callable[[], Any]] = {} if grinders is None else dict(grinders)
+    "Inputs, which are ground on first access"
+    self.__lock = Lock()
+    self.__share_threshold: Optional[int] = None
 
   def __getitem__(self, key: str):
-    return self.__data[key]
+    if key in self.__grinders:
+      with self.__lock:
+        grinder = self.__grinders.get(key)
+        if grinder is not None:
+          self.__data[key] = self.__share(grinder())
+          del self.__grinders[key]
+    value = self.__data[key]
+    if isinstance(value, SharedArray):
+      return value.attach()
+    return value
+
+  def is_ground(self, key: str) -> bool:
+    """Checks if an input have been ground, inputs are ground on first access
+
+    Args:
+        key (str): Key of the input
+
+    Returns:
+        bool: If the input have been ground
+    """
+    return key in self.__data
+
+  def __share(self, value: Any) -> Any:
+    if self.__share_threshold is not None and isinstance(value, numpy.ndarray) \
+        and self.__share_threshold <= value.nbytes:
+      return SharedArray.from_array(value)
+    return value
+
+  def share_arrays(self, threshold: int = 0) -> int:
+    """Places the numpy arrays of at least threshold bytes in shared memory,
+    see get_shared. Inputs ground later are shared once ground. The blocks
+    are freed by release.
+
+    Args:
+        threshold (int, optional): Minimum size of shared arrays in bytes. Defaults to 0.
+
+    Returns:
+        int: Number of bytes placed in shared memory
+    """
+    nbytes = 0
+    with self.__lock:
+      self.__share_threshold = threshold
+      for key, value in self.__data.items():
+        shared = self.__share(value)
+        if shared is not value:
+          self.__data[key] = shared
+          nbytes += shared.nbytes
+    return nbytes
+
+  def get_shared(self, key: str) -> SharedArray:
+    """Gets the handle of a shared array, which can be sent to another
+    process without copying the array. The handle is only valid until the
+    job finishes, unless acquired.
+
+    Args:
+        key (str): Key of the input
+
+    Raises:
+        ValueError: If the input isn't in shared memory
+
+    Returns:
+        SharedArray: Handle of the array
+    """
+    self[key]
+    value = self.__data[key]
+    if not isinstance(value, SharedArray):
+      raise ValueError(f"{key} is not in shared memory, see share_arrays")
+    return value
+
+  def release(self) -> None:
+    """Releases the shared memory of the container. The shared inputs are
+    removed from the container, so releasing it again does nothing, and
+    inputs ground afterwards are not shared."""
+    with self.__lock:
+      self.__share_threshold = None
+      for key, value in list(self.__data.items()):
+        if isinstance(value, SharedArray):
+          value.release()
+          del self.__data[key]
 
 
 class PatientNode(ImageTreeInterface):
@@ -67,6 +196,14 @@ class PatientNode(ImageTreeInterface):
     filling_strategy: FillingStrategy = FillingStrategy.DISCARD
     InputContainerType: Type[InputContainer] = InputContainer
     pivot_input: Optional[str] = None
+    storage_type: Type[DatasetStore] = FileStore
+    lazy_grinding: bool = False
+    release_ground_inputs: bool = False
+    on_release: Optional[Callable[['PatientNode', int], None]] = None
+    association_pool: Optional[AssociationPool] = None
+    move_coordinator: Optional[MoveCoordinator] = None
+    find_cache: Optional[FindCache] = None
+    retrieval_executor: Optional[Executor] = None
 
 
   def __init__(self,
@@ -77,20 +214,40 @@ class PatientNode(ImageTreeInterface):
     super().__init__()
     self.options = options
     self.creationTime = datetime.now()
+    self.last_updated = self.creationTime
+    "Time an image was last added to the patient"
+    self.lock = RLock()
+    """Lock guarding the inputs of the patient. Hold it while adding images,
+    validating or extracting data, such that these see a consistent state"""
+    self.instance_digests: Dict[str, bytes] = {}
+    """Digests of the images added to the patient by SOPInstanceUID, see
+    PipelineTree.is_duplicate"""
+    self.key: Optional[str] = None
+    "Key of the patient in the PipelineTree, set once it's inserted"
 
     if self.options.container_path is not None:
       if self.options.container_path.is_file():
         raise InvalidRootDataDirectory
       self.options.container_path.mkdir(exist_ok=True)
 
+    self.store: Optional[DatasetStore] = None
+    "Storage of the datasets of the patient, shared by the inputs"
+    if self.options.container_path is not None:
+      self.store = self.options.storage_type(self.options.container_path)
+
     for arg_name, input in args.items():
-      input_path: Optional[Path] = None
-      if self.options.container_path is not None:
-        input_path = self.options.container_path / arg_name
+      input_store: Optional[DatasetStore] = None
+      if self.store is not None:
+        input_store = self.store.scope(arg_name)
+
+      inputOptions = self.__get_Input_Options(input=input, input_store=input_store)
 
-      inputOptions = self.__get_Input_Options(input=input, input_path=input_path)
+      input_instance = input(pivot, options=inputOptions)
+      self.data[arg_name] = input_instance
+      self.images += input_instance.images # Images loaded from the store
 
-      self.data[arg_name] = input(pivot, options=inputOptions)
+    self.nbytes: int = _resident_bytes(self)
+    "Estimated bytes of the datasets of the patient held in memory"
 
     # logger
     if self.options.logger is not None:
@@ -122,6 +279,30 @@ class PatientNode(ImageTreeInterface):
     return return_list
 
 
+  def get_deadline(self, study_expiration: Optional[timedelta]) -> Optional[datetime]:
+    """Calculates when the patient expires, which is after the shortest
+    expiration time of the inputs and study_expiration.
+
+    Args:
+        study_expiration (Optional[timedelta]): Expiration of patients
+          regardless of their inputs
+
+    Returns:
+        Optional[datetime]: The deadline, None if the patient never expires
+    """
+    expirations: List[timedelta] = []
+    if study_expiration is not None:
+      expirations.append(study_expiration)
+    for input in self.data.values():
+      if isinstance(input, AbstractInput):
+        if input.expiration_time is not None:
+          expirations.append(input.expiration_time)
+      else:
+        raise InvalidTreeNode # pragma: no cover
+    if len(expirations) == 0:
+      return None
+    return self.creationTime + min(expirations)
+
   def clean_up(self) -> int:
     """This function cleans up the patient node and owned all inputs
 
@@ -131,33 +312,77 @@ class PatientNode(ImageTreeInterface):
     images_removed = 0
     for input in self.data.values():
       if isinstance(input, AbstractInput):
-        images_removed += input._clean_up()
+        images_removed += input.images
       else:
         raise InvalidTreeNode # pragma: no cover
+    # The inputs share the store, so it's cleared at once
+    if self.store is not None:
+      self.store.clear()
     if self.options.container_path is not None:
       shutil.rmtree(self.options.container_path)
     return images_removed
 
-  def validate_inputs(self):
-    valid = True
+  def validate_inputs(self) -> bool:
+    """Checks if all inputs are ready, see AbstractInput.is_ready. Inputs are
+    only validated again, if images were added to them since last check.
+
+    Returns:
+        bool: If the patient have sufficient data to be processed
+    """
     for input in self.data.values():
       if isinstance(input, AbstractInput):
-        valid &= input.validate()
+        if not input.is_ready():
+          return False
       else:
         raise InvalidTreeNode # pragma: no cover
-    return valid
+    return True
+
+  def grind_input(self, arg_name: str) -> Any:
+    """Grinds an input into the data passed to process. If the option
+    release_ground_inputs is set and the patient have persistent storage, the
+    datasets of the input held in memory are released afterwards, leaving
+    lazy datasets in their place. They're only released if the ground data
+    doesn't hold on to the datasets, such as an numpy array, as the memory
+    would not be freed otherwise.
+
+    Args:
+        arg_name (str): Name of the input
+
+    Raises:
+        InvalidTreeNode: If the input is not an AbstractInput
+
+    Returns:
+        Any: The output of the image grinder of the input
+    """
+    with self.lock:
+      input = self.data[arg_name]
+      if not isinstance(input, AbstractInput):
+        raise InvalidTreeNode # pragma: no cover
+      self.logger.debug(f"Extracting input from {input.__class__.__name__}")
+      data = input.get_data()
+
+      if self.options.release_ground_inputs and self.store is not None\
+          and self.store.persistent and not _aliases_datasets(data):
+        others = [other for other in self.data.values() if other is not input]
+        freed = min(_released_bytes(input, others), self.nbytes)
+        input.spill()
+        self.nbytes -= freed
+        if self.options.on_release is not None:
+          self.options.on_release(self, freed)
+      return data
 
   def extract_input_container(self) -> InputContainer:
     """Retrieved inputs' data in the way it's supposed to be processed in.
+    With the option lazy_grinding, the inputs are ground on first access
+    from the container rather than here.
 
     Raises:
-        InvalidTreeNode: _description_
+        InvalidTreeNode: If an input is not an AbstractInput
+        HeaderConstructionFailure: If the series header couldn't be constructed
 
     Returns:
-        InputContainer: _description_
+        InputContainer: Container of the data of the inputs
     """
-    data_directory: Dict[str, Any] = {}
-
     path_directory: Optional[Dict[str, Path]]
     if self.options.container_path is None:
       path_directory = None
@@ -166,15 +391,12 @@ class PatientNode(ImageTreeInterface):
 
     for arg_name, input in self.data.items():
       if isinstance(input, AbstractInput):
-        self.logger.debug(f"Extracting input from {input.__class__.__name__}")
-        data_directory[arg_name] = input.get_data()
         if path_directory is not None and input.path is not None:
           path_directory[arg_name] = input.path
       else:
         raise InvalidTreeNode # pragma: no cover
 
-    self.logger.debug("Extracted data from all inputs")
-
+    # The header is made before grinding, which might release the pivot datasets
     if self.options.factory is not None and self.options.header_blueprint is not None:
       pivot_list: List[Dataset] = []
 
@@ -193,9 +415,10 @@ class PatientNode(ImageTreeInterface):
           break
 
       try:
-        header = self.options.factory.make_series_header(
-          pivot_list, self.options.header_blueprint, self.options.filling_strategy
-        )
+        with get_metrics().time("dicomnode_stage_seconds", {"stage" : "header"}):
+          header = self.options.factory.make_series_header(
+            pivot_list, self.options.header_blueprint, self.options.filling_strategy
+          )
       except HeaderConstructionFailure as exception:
         log_traceback(self.logger, exception, header_message="Failed to construct header")
         raise exception
@@ -206,11 +429,40 @@ class PatientNode(ImageTreeInterface):
 
       header = None
 
+    if self.options.lazy_grinding:
+      grinders: Dict[str, Callable[[], Any]] = {
+        arg_name : partial(self.grind_input, arg_name) for arg_name in self.data
+      }
+      return self.options.InputContainerType({}, header, path_directory, grinders)
+
+    data_directory: Dict[str, Any] = {}
+    for arg_name in self.data:
+      data_directory[arg_name] = self.grind_input(arg_name)
+    self.logger.debug("Extracted data from all inputs")
+
     input_container = self.options.InputContainerType(data_directory, header, path_directory)
 
     return input_container
 
+  def _resident_instances(self, dicom: Dataset) -> Dict[int, Dataset]:
+    """Gets the datasets held in memory by the inputs, with the
+    SOPInstanceUID of dicom, by their ids"""
+    resident: Dict[int, Dataset] = {}
+    if 0x00080018 not in dicom:
+      return resident
+    key = dicom.SOPInstanceUID.name
+    for input in self.data.values():
+      trees = input.data.values() if isinstance(input, DynamicInput) else [input]
+      for tree in trees:
+        if isinstance(tree, ImageTreeInterface):
+          dataset = tree.data.get(key)
+          if isinstance(dataset, Dataset) and not isinstance(dataset, LazyDataset):
+            resident[id(dataset)] = dataset
+    return resident
+
   def add_image(self, dicom: Dataset) -> int:
+    # A re-sent image replaces the image with the same SOPInstanceUID
+    replaced = self._resident_instances(dicom)
     added = 0
     for input in self.data.values():
       if isinstance(input, AbstractInput):
@@ -223,15 +475,46 @@ class PatientNode(ImageTreeInterface):
     if added == 0:
       raise InvalidDataset()
     self.images += added
+    self.last_updated = datetime.now()
+    if not self.options.lazy:
+      self.nbytes += estimate_dataset_size(dicom)
+    if replaced:
+      kept = self._resident_instances(dicom)
+      self.nbytes -= sum(estimate_dataset_size(dataset) for dataset_id, dataset in replaced.items()
+                         if dataset_id not in kept or dataset is dicom)
     return added
 
-  def __get_Input_Options(self, input: Type[AbstractInput], input_path: Optional[Path]):
+  def spill(self) -> int:
+    """Moves the datasets of the patient held in memory to disk, see
+    AbstractInput.spill
+
+    Raises:
+        IncorrectlyConfigured: If the inputs doesn't have file storage
+
+    Returns:
+        int: Estimated bytes of memory freed
+    """
+    for input in self.data.values():
+      if isinstance(input, AbstractInput):
+        input.spill()
+      else:
+        raise InvalidTreeNode # pragma: no cover
+    freed = self.nbytes
+    self.nbytes = 0
+    return freed
+
+  def __get_Input_Options(self, input: Type[AbstractInput], input_store: Optional[DatasetStore]):
     return input.Options(
         ae_title=self.options.ae_title,
-        data_directory = input_path,
+        data_directory = None if input_store is None else input_store.directory,
+        store=input_store,
         logger=self.options.logger,
         factory = self.options.factory,
-        lazy=self.options.lazy
+        lazy=self.options.lazy,
+        association_pool=self.options.association_pool,
+        move_coordinator=self.options.move_coordinator,
+        find_cache=self.options.find_cache,
+        retrieval_executor=self.options.retrieval_executor
       )
 
 
@@ -280,6 +563,35 @@ class PipelineTree(ImageTreeInterface):
     patient_container: Type[PatientNode] = PatientNode
     "Type of node that's under this tree."
 
+    association_pool: Optional[AssociationPool] = None
+    "Pool of associations shared by the inputs"
+
+    move_coordinator: Optional[MoveCoordinator] = None
+    "Deduplicates C-MOVEs send by historic inputs"
+
+    find_cache: Optional[FindCache] = None
+    "Cache of C-FINDs send by historic inputs"
+
+    retrieval_executor: Optional[Executor] = None
+    "Executor of the series retrievals of historic inputs"
+
+    memory_budget: Optional[int] = None
+    """Max estimated bytes of datasets held in memory. If exceeded, the least
+    recently updated patients are spilled to the data directory.
+    None is unlimited"""
+
+    storage_type: Type[DatasetStore] = FileStore
+    """Storage of the datasets of each patient in the data directory, see
+    dicomnode.lib.storage"""
+
+    lazy_grinding: bool = False
+    """If inputs are ground on first access from the input container, rather
+    than when the container is extracted"""
+
+    release_ground_inputs: bool = False
+    """If the datasets of an input held in memory are released, once the input
+    have been ground. Requires a persistent storage_type"""
+
 
   def __init__(self,
                patient_identifier: int,
@@ -304,6 +616,20 @@ class PipelineTree(ImageTreeInterface):
     self.PipelineArgs: Dict[str, Type[AbstractInput]] = pipelineArgs
     #self.root_data_directory: Optional[Path] = options.data_directory
     self.options = options
+    self.nbytes: int = 0
+    "Estimated bytes of datasets held in memory by the tree"
+    self.study_expiration: Optional[timedelta] = None
+    "Time before a patient expires, see set_study_expiration"
+    self._expiry_lock = Lock()
+    self._expiry_sequence = count()
+    self._expiry_heap: List[Tuple[datetime, int, str, PatientNode]] = []
+    self._lock = RLock()
+    """Lock guarding the patient dict and the counters of the tree. Patients
+    have their own lock, and it's always acquired before this lock"""
+    self._instances: Dict[str, Tuple[bytes, PatientNode, str]] = {}
+    "Index of the images in the tree by SOPInstanceUID, see is_duplicate"
+    self._creation_locks: Dict[str, Lock] = {}
+    "Locks of the patients being created, such that each is only created once"
 
     #Logger Setup
     if self.options.logger is None:
@@ -318,6 +644,9 @@ class PipelineTree(ImageTreeInterface):
     if not self.options.data_directory.exists():
       self.options.data_directory.mkdir()
 
+    if not self.options.storage_type.persistent:
+      return
+
     for patient_directory in self.options.data_directory.iterdir():
       if patient_directory.is_file():
         self.logger.error(f"{patient_directory.name} in root_data_directory is a file not a directory")
@@ -325,26 +654,212 @@ class PipelineTree(ImageTreeInterface):
 
       options = self.__get_PatientContainer_Options(patient_directory)
 
-      self[patient_directory.name] = PatientNode(self.PipelineArgs, None, options)
+      patient_node = PatientNode(self.PipelineArgs, None, options)
+      patient_node.key = patient_directory.name
+      self[patient_directory.name] = patient_node
+      self.images += patient_node.images
+      self.nbytes += patient_node.nbytes
+      self._schedule_expiry(patient_directory.name, patient_node)
 
-  def add_image(self, dicom : Dataset) -> int:
-    key = self.get_patient_id(dicom)
+  def add_image(self, dicom : Dataset, digest: Optional[bytes] = None) -> int:
+    """Adds an image to the patient node of the image, creating the node if
+    needed. Exact duplicates of images in the tree are skipped.
 
-    if key not in self:
-      IDC_path: Optional[Path] = None
-      if self.options.data_directory is not None:
-        IDC_path = self.options.data_directory / key
+    Args:
+        dicom (Dataset): The image to be added
+        digest (Optional[bytes], optional): Digest of the image, see
+          dicomnode.lib.dicom.dataset_digest. Defaults to None, which computes
+          it from the dataset.
+
+    Raises:
+        InvalidDataset: If no input accepts the image
+
+    Returns:
+        int: Number of images added, 0 if the image was a duplicate
+    """
+    with get_metrics().time("dicomnode_stage_seconds", {"stage" : "add_image"}):
+      added = self._add_image(dicom, digest)
+    self.enforce_memory_budget()
+    self._report_size()
+    return added
+
+  def _report_size(self) -> None:
+    metrics = get_metrics()
+    metrics.set_gauge("dicomnode_tree_images", self.images)
+    metrics.set_gauge("dicomnode_tree_patients", len(self.data))
+    metrics.set_gauge("dicomnode_tree_bytes", self.nbytes)
+
+  def exceeds_memory_budget(self) -> bool:
+    """Checks if the datasets held in memory exceeds the memory budget"""
+    return self.options.memory_budget is not None and self.options.memory_budget < self.nbytes
+
+  def get_patient_nodes(self) -> List[Tuple[str, PatientNode]]:
+    """Gets a snapshot of the patients in the tree, which is safe to iterate
+    over while other threads add or remove patients.
+
+    Raises:
+      InvalidTreeNode: If a node is not a PatientNode
+
+    Returns:
+      List[Tuple[str, PatientNode]]: The patient ids and their nodes
+    """
+    with self._lock:
+      items = list(self.data.items())
+    patient_nodes: List[Tuple[str, PatientNode]] = []
+    for patient_id, patient_node in items:
+      if isinstance(patient_node, PatientNode):
+        patient_nodes.append((patient_id, patient_node))
+      else:
+        raise InvalidTreeNode # pragma: no cover
+    return patient_nodes
+
+  def enforce_memory_budget(self) -> int:
+    """Spills the least recently updated patients to disk, until the tree is
+    within its memory budget. Without a data directory or with a storage_type,
+    that is not persistent, nothing can be spilled.
 
-      options = self.__get_PatientContainer_Options(IDC_path)
-      self[key] = PatientNode(self.PipelineArgs, dicom, options)
+    Raises:
+      InvalidTreeNode: If a node is not a PatientNode
+
+    Returns:
+        int: Number of patients spilled
+    """
+    if not self.exceeds_memory_budget() or self.options.data_directory is None \
+        or not self.options.storage_type.persistent:
+      return 0
 
-    patient_node = self[key]
+    patient_nodes = [patient_node for _, patient_node in self.get_patient_nodes()]
+
+    spilled = 0
+    for patient_node in sorted(patient_nodes, key=lambda node: node.last_updated):
+      if not self.exceeds_memory_budget():
+        break
+      with patient_node.lock:
+        if patient_node.nbytes == 0 or not self._contains_node(patient_node):
+          continue
+        freed = patient_node.spill()
+        with self._lock:
+          self.nbytes -= freed
+      spilled += 1
+
+    get_metrics().increment("dicomnode_spilled_patients_total", spilled)
+    self.logger.info(f"Spilled {spilled} patients to disk to stay within the memory budget")
+    return spilled
+
+  def _on_release(self, patient_node: PatientNode, freed: int) -> None:
+    # Called by a patient node releasing ground inputs, holding its lock
+    with self._lock:
+      if self._contains_node(patient_node):
+        self.nbytes -= freed
+
+  def _contains_node(self, patient_node: PatientNode) -> bool:
+    # The caller holds the lock of the node, so it cannot be removed meanwhile
+    if patient_node.key is None:
+      return False
+    with self._lock:
+      return self.data.get(patient_node.key) is patient_node
+
+  def _get_or_create_patient_node(self, key: str, dicom: Dataset) -> PatientNode:
+    with self._lock:
+      patient_node = self.data.get(key)
+      if patient_node is None:
+        creation_lock = self._creation_locks.setdefault(key, Lock())
+
+    if patient_node is None:
+      # Creating a node touches the disk and runs the constructors of the
+      # inputs, so it's done outside of the tree lock. Concurrent associations
+      # wait for the creation of the same patient, such that it's only created
+      # (and historic C-MOVEs are only send) once.
+      with creation_lock:
+        with self._lock:
+          patient_node = self.data.get(key)
+        if patient_node is None:
+          try:
+            IDC_path: Optional[Path] = None
+            if self.options.data_directory is not None:
+              IDC_path = self.options.data_directory / key
+
+            options = self.__get_PatientContainer_Options(IDC_path)
+            created_node = PatientNode(self.PipelineArgs, dicom, options)
+            created_node.key = key
+            with self._lock:
+              # A node created under a lock, that was replaced meanwhile, loses
+              patient_node = self.data.get(key)
+              if patient_node is None:
+                patient_node = created_node
+                self[key] = patient_node
+                self.nbytes += patient_node.nbytes
+                self._schedule_expiry(key, patient_node)
+          finally:
+            with self._lock:
+              self._creation_locks.pop(key, None)
     if isinstance(patient_node, PatientNode):
-      added = patient_node.add_image(dicom)
-      self.images += added
-      return added
-    else:
-      raise InvalidTreeNode # pragma: no cover
+      return patient_node
+    raise InvalidTreeNode # pragma: no cover
+
+  def is_duplicate(self, sop_instance_uid: str, digest: bytes) -> bool:
+    """Checks if an image with identical content is in the tree already, such
+    that a re-sent image can be skipped before it's decoded. Duplicates are
+    counted in the dicomnode_duplicate_images_total metric.
+
+    Args:
+        sop_instance_uid (str): SOPInstanceUID of the image
+        digest (bytes): Digest of the image, see
+          dicomnode.lib.dicom.dataset_digest
+
+    Returns:
+        bool: If the image is a duplicate
+    """
+    return self.find_duplicate(sop_instance_uid, digest) is not None
+
+  def find_duplicate(self, sop_instance_uid: str, digest: bytes) -> Optional[str]:
+    """Finds the patient holding an image with identical content, see
+    is_duplicate.
+
+    Args:
+        sop_instance_uid (str): SOPInstanceUID of the image
+        digest (bytes): Digest of the image, see
+          dicomnode.lib.dicom.dataset_digest
+
+    Returns:
+        Optional[str]: Key of the patient holding the image, None if the
+          image is not a duplicate
+    """
+    with self._lock:
+      instance = self._instances.get(sop_instance_uid)
+    if instance is None or instance[0] != digest:
+      return None
+    get_metrics().increment("dicomnode_duplicate_images_total")
+    self.logger.debug(f"Skipped duplicate of image {sop_instance_uid}")
+    return instance[2]
+
+  def _add_image(self, dicom : Dataset, digest: Optional[bytes]) -> int:
+    key = self.get_patient_id(dicom)
+    sop_instance_uid: Optional[str] = None
+    if 0x00080018 in dicom: # SOPInstanceUID
+      sop_instance_uid = str(dicom.SOPInstanceUID)
+      if digest is None:
+        digest = dataset_digest(dicom)
+
+    while True:
+      patient_node = self._get_or_create_patient_node(key, dicom)
+      with patient_node.lock:
+        # The patient might have been removed, while waiting for its lock.
+        # Then the image belongs in a new node.
+        if self.data.get(key) is not patient_node:
+          continue
+        if sop_instance_uid is not None and digest is not None:
+          if self.is_duplicate(sop_instance_uid, digest):
+            return 0
+        nbytes = patient_node.nbytes
+        added = patient_node.add_image(dicom)
+        with self._lock:
+          self.images += added
+          self.nbytes += patient_node.nbytes - nbytes
+          if sop_instance_uid is not None and digest is not None:
+            patient_node.instance_digests[sop_instance_uid] = digest
+            self._instances[sop_instance_uid] = (digest, patient_node, key)
+        return added
 
 
   def validate_patient_ID(self, patient_id: str) -> bool:
@@ -357,12 +872,13 @@ class PipelineTree(ImageTreeInterface):
       InvalidTreeNode: If value at patient id is not a PatientNode
 
     Returns:
-      Optional[InputContainer]: If there's insufficient data returns None,
-        Otherwise a InputContainer with the grinded values
+      bool: If the patient have sufficient data to be processed, see
+        PatientNode.validate_inputs
     """
     patient_node = self[patient_id]
     if isinstance(patient_node, PatientNode):
-      return patient_node.validate_inputs()
+      with get_metrics().time("dicomnode_stage_seconds", {"stage" : "validate"}), patient_node.lock:
+        return patient_node.validate_inputs()
     else:
       raise InvalidTreeNode # pragma: no cover
 
@@ -393,7 +909,8 @@ class PipelineTree(ImageTreeInterface):
 
     self.logger.debug(f"Getting Patient node: {patient_id}")
     if isinstance(patient_node, PatientNode):
-      return patient_node.extract_input_container()
+      with patient_node.lock:
+        return patient_node.extract_input_container()
     else:
       #self.logger.debug(f"get_patient_input_container - Pipeline Tree Patient node constraint violated! ")
       raise InvalidTreeNode # pragma: no cover
@@ -407,20 +924,102 @@ class PipelineTree(ImageTreeInterface):
     Raises:
       InvalidTreeNode: If a node is not a PatientNode
     """
-    # Note here that iteration over a dict, require the dict not to change
-    # Hence the need to two loops.
-    # Note that this is a multi threaded application and there is a race condition
-    # if this function runs while another thread is iteration over the data dir.
-    to_be_removed = set()
-    for patient_id, patient_node in self.data.items():
-      if isinstance(patient_node, PatientNode):
-        if patient_node.creationTime < expiry_time:
-          to_be_removed.add(patient_id)
-      else:
-        raise InvalidTreeNode #pragma: no cover
+    for patient_id, patient_node in self.get_patient_nodes():
+      if patient_node.creationTime < expiry_time:
+        self._remove_patient_node(patient_id, patient_node)
+    self._report_size()
+
+
+  def _schedule_expiry(self, patient_id: str, patient_node: PatientNode) -> None:
+    deadline = patient_node.get_deadline(self.study_expiration)
+    if deadline is None:
+      return
+    with self._expiry_lock:
+      heappush(self._expiry_heap, (deadline, next(self._expiry_sequence), patient_id, patient_node))
+      # Entries of removed patients are discarded lazily, unless they pile up
+      if len(self._expiry_heap) > 2 * len(self.data) + 64:
+        self._expiry_heap = [entry for entry in self._expiry_heap if self._is_scheduled(entry)]
+        heapify(self._expiry_heap)
+
+  def _is_scheduled(self, entry: Tuple[datetime, int, str, PatientNode]) -> bool:
+    _, _, patient_id, patient_node = entry
+    return self.data.get(patient_id) is patient_node
+
+  def set_study_expiration(self, study_expiration: Optional[timedelta]) -> None:
+    """Sets the time before a patient expires, and reschedules the patients
+    in the tree. Inputs with a shorter expiration_time expires sooner.
 
-    self.remove_patients(to_be_removed)
+    Args:
+        study_expiration (Optional[timedelta]): The expiration, if None only
+          the expiration of the inputs applies.
+    """
+    self.study_expiration = study_expiration
+    with self._expiry_lock:
+      self._expiry_heap = []
+    for patient_id, patient_node in self.get_patient_nodes():
+      self._schedule_expiry(patient_id, patient_node)
+
+  def next_expiry(self) -> Optional[datetime]:
+    """Gets the deadline of the patient expiring first
+
+    Returns:
+        Optional[datetime]: The deadline or None if no patient can expire
+    """
+    with self._expiry_lock:
+      while len(self._expiry_heap) and not self._is_scheduled(self._expiry_heap[0]):
+        heappop(self._expiry_heap)
+      if len(self._expiry_heap) == 0:
+        return None
+      return self._expiry_heap[0][0]
+
+  def remove_next_expired(self, now: Optional[datetime] = None) -> Optional[str]:
+    """Removes the patient expiring first, if it has expired
 
+    Args:
+        now (Optional[datetime], optional): Time to compare the deadline to.
+          Defaults to None, which is the current time.
+
+    Returns:
+        Optional[str]: The removed patient, None if no patient has expired
+    """
+    if now is None:
+      now = datetime.now()
+    with self._expiry_lock:
+      while len(self._expiry_heap) and not self._is_scheduled(self._expiry_heap[0]):
+        heappop(self._expiry_heap)
+      if len(self._expiry_heap) == 0 or now < self._expiry_heap[0][0]:
+        return None
+      _, _, patient_id, patient_node = heappop(self._expiry_heap)
+    self._remove_patient_node(patient_id, patient_node)
+    self._report_size()
+    self.logger.info(f"Removed expired patient {patient_id}")
+    return patient_id
+
+  def _remove_patient_node(self, patient_id: str, patient_node: PatientNode) -> int:
+    """Removes a patient, if it's still stored under patient_id.
+
+    Returns:
+        int: Number of images removed
+    """
+    with patient_node.lock:
+      if self.data.get(patient_id) is not patient_node:
+        return 0
+      # Cleaning up removes files, so it's done outside of the tree lock, but
+      # before the key is freed, as a new node for the patient would reuse
+      # the directory.
+      removed_images = patient_node.clean_up()
+      if self.options.move_coordinator is not None:
+        # Historic data must be moved again, if the patient returns
+        self.options.move_coordinator.forget(self.patient_identifier_tag, patient_id)
+      with self._lock:
+        del self.data[patient_id]
+        self.nbytes -= patient_node.nbytes
+        self.images -= removed_images
+        for sop_instance_uid in patient_node.instance_digests:
+          instance = self._instances.get(sop_instance_uid)
+          if instance is not None and instance[1] is patient_node:
+            del self._instances[sop_instance_uid]
+    return removed_images
 
   def remove_patient(self, patient_id: str) -> None:
     """Removes a patient from the tree
@@ -431,22 +1030,15 @@ class PipelineTree(ImageTreeInterface):
     Raises:
         InvalidTreeNode: If value at patient id is not a PatientNode
     """
-
-    # This function is a tad weird, since it needs to be thread safe.
-    new_data_dict = {}
+    patient_node = self.data.get(patient_id)
     removed_images = 0
-
-    for patient_id_dict, patient_node in self.data.items():
-      if patient_id_dict == patient_id:
-        if isinstance(patient_node, PatientNode):
-          removed_images = patient_node.clean_up()
-        else:
-          raise InvalidTreeNode # pragma: no cover
+    if patient_node is not None:
+      if isinstance(patient_node, PatientNode):
+        removed_images = self._remove_patient_node(patient_id, patient_node)
       else:
-        new_data_dict[patient_id_dict] = patient_node
+        raise InvalidTreeNode # pragma: no cover
 
-    self.images -= removed_images
-    self.data = new_data_dict
+    self._report_size()
     self.logger.debug(f"Removed {patient_id} and {removed_images} images from Pipeline")
 
 
@@ -459,23 +1051,15 @@ class PipelineTree(ImageTreeInterface):
     Raises:
         InvalidTreeNode: If nodes are not PatientNodes
     """
-    #Due to the fact, that you cannot iterator over a changing directory
-
-    new_data_dict = {}
-    removed_images = 0
-
-    for patient_id, patient_node in self.data.items():
-      if patient_id in patient_ids:
-        if isinstance(patient_node, PatientNode):
-          removed_images += patient_node.clean_up()
-        else:
-          raise InvalidTreeNode # pragma: no cover
+    for patient_id in patient_ids:
+      patient_node = self.data.get(patient_id)
+      if patient_node is None:
+        continue
+      if isinstance(patient_node, PatientNode):
+        self._remove_patient_node(patient_id, patient_node)
       else:
-        new_data_dict[patient_id] = patient_node
-
-    self.images -= removed_images
-    self.data = new_data_dict
-
+        raise InvalidTreeNode # pragma: no cover
+    self._report_size()
 
   def __get_PatientContainer_Options(self, container_path: Optional[Path]) -> PatientNode.Options:
     """Creates the options for the underlying Patient Container
@@ -494,6 +1078,14 @@ class PipelineTree(ImageTreeInterface):
         logger=self.logger,
         lazy=self.options.lazy,
         InputContainerType=self.options.input_container_type,
+        storage_type=self.options.storage_type,
+        lazy_grinding=self.options.lazy_grinding,
+        release_ground_inputs=self.options.release_ground_inputs,
+        on_release=self._on_release,
         header_blueprint=self.options.header_blueprint,
-        filling_strategy=self.options.filling_strategy
+        filling_strategy=self.options.filling_strategy,
+        association_pool=self.options.association_pool,
+        move_coordinator=self.options.move_coordinator,
+        find_cache=self.options.find_cache,
+        retrieval_executor=self.options.retrieval_executor
       )
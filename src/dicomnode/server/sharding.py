@@ -0,0 +1,394 @@
+"""Contains the ShardedPipeline, which spreads the patients of a node over a
+number of worker processes.
+
+  An AbstractPipeline runs in a single process, so receiving, grinding and
+  processing share a single GIL. A ShardedPipeline runs the AE in a front end,
+  which routes each received dataset to one of `shards` worker processes by
+  its patient. Each worker is an instance of the same pipeline class with its
+  own PipelineTree, such that all images of a patient are stored and processed
+  in the same worker.
+"""
+
+__author__ = "Christoffer Vilstrup Jensen"
+
+# Python3 standard Library
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from dataclasses import dataclass
+from functools import partial
+from itertools import count
+import multiprocessing
+from multiprocessing.process import BaseProcess
+from pathlib import Path
+from queue import Queue
+from threading import Lock, Thread
+from time import monotonic
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Type
+from zlib import crc32
+
+# Third party Packages
+from pynetdicom import evt
+
+# Dicomnode packages
+from dicomnode.lib.exceptions import IncorrectlyConfigured
+from dicomnode.lib.logging import log_traceback
+from dicomnode.lib.metrics import DEFAULT_BUCKETS, InMemoryMetrics, MetricsSnapshot
+from dicomnode.server.assocation_container import AcceptedContainer, CStoreContainer, ReleasedContainer
+from dicomnode.server.nodes import AbstractPipeline
+
+def shard_index(patient_id: str, shards: int) -> int:
+  """Maps a patient to a shard. Unlike the builtin hash, it's the same in
+  every process.
+
+  Args:
+      patient_id (str): Value of the patient_identifier_tag
+      shards (int): Number of shards
+
+  Returns:
+      int: The shard of the patient, between 0 and shards - 1
+  """
+  return crc32(patient_id.encode()) % shards
+
+
+@dataclass
+class ShardStatus:
+  """Status of a worker process of a ShardedPipeline"""
+  shard: int
+  pid: Optional[int]
+  alive: bool
+  patients: int = 0
+  "Patients in the PipelineTree of the shard"
+  images: int = 0
+  "Images in the PipelineTree of the shard"
+  in_flight: int = 0
+  "Patients being processed"
+
+
+class ShardedMetrics(InMemoryMetrics):
+  """Metrics of the front end of a ShardedPipeline, which includes the metrics
+  of the shards, when rendered.
+
+  Args:
+    collect (Callable[[], List[MetricsSnapshot]]): Gets the metrics of the shards
+    buckets (Tuple[float, ...]): Upper bounds of histogram buckets.
+      Defaults to DEFAULT_BUCKETS.
+  """
+  def __init__(self,
+               collect: Callable[[], List[MetricsSnapshot]],
+               buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+    super().__init__(buckets)
+    self.collect = collect
+
+  def aggregate(self) -> InMemoryMetrics:
+    """Merges the metrics of the front end and the shards
+
+    Returns:
+        InMemoryMetrics: The metrics of the entire node
+    """
+    aggregate = InMemoryMetrics(self.buckets)
+    aggregate.merge(self.snapshot())
+    for snapshot in self.collect():
+      aggregate.merge(snapshot)
+    return aggregate
+
+  def render(self) -> str:
+    return self.aggregate().render()
+
+
+def _shard_attributes(pipeline_type: Type['ShardedPipeline'], shard: int) -> Dict[str, Any]:
+  attributes: Dict[str, Any] = {
+    "shard" : shard,
+    "metrics_sink" : InMemoryMetrics(),
+    "metrics_port" : None,
+  }
+  # Each shard owns a sub directory, such that shards never share files
+  for name in ["data_directory", "processing_directory", "outbox_directory"]:
+    directory = getattr(pipeline_type, name)
+    if directory is not None:
+      attributes[name] = Path(directory) / f"shard_{shard}"
+  log_output = pipeline_type.log_output
+  if isinstance(log_output, (str, Path)):
+    log_output = Path(log_output)
+    attributes["log_output"] = log_output.with_name(f"{log_output.stem}_shard_{shard}{log_output.suffix}")
+  return attributes
+
+def _run_shard(pipeline_type: Type['ShardedPipeline'],
+               shard: int,
+               requests: 'multiprocessing.Queue[Any]',
+               responses: 'multiprocessing.Queue[Any]') -> None:
+  """Entry point of the worker processes"""
+  shard_type = type(f"{pipeline_type.__name__}Shard{shard}",
+                    (pipeline_type,),
+                    _shard_attributes(pipeline_type, shard))
+  pipeline = shard_type()
+  pipeline._serve_shard(requests, responses)
+
+
+class ShardedPipeline(AbstractPipeline):
+  """Pipeline spreading its patients over `shards` worker processes.
+
+  The front end accepts the associations and routes each dataset to the shard
+  of its patient, see shard_index. Each worker is an instance of the subclass
+  with `shard` set, and the data_directory, processing_directory and
+  outbox_directory are split into a sub directory per shard. Filtering,
+  storing and processing happens in the workers, so these scale with the
+  cores of the machine, while the front end only receives.
+
+  The pipeline class must be importable by the worker processes, i.e.
+  defined at module level, unless shard_start_method is "fork".
+  """
+
+  shards: int = 2
+  "Number of worker processes"
+
+  shard_start_method: str = "spawn"
+  """Start method of the worker processes, see multiprocessing. Forking
+  starts faster, but is unsafe if the process runs threads"""
+
+  shard_timeout: float = 30.0
+  """Seconds the front end waits for a shard to respond. C-STOREs timing out
+  are refused with status 0xA700"""
+
+  shard: Optional[int] = None
+  "Index of the shard in the worker processes, None in the front end"
+
+  def __init__(self) -> None:
+    if self.shard is not None:
+      super().__init__()
+      return
+
+    if self.shards < 1:
+      raise IncorrectlyConfigured("A ShardedPipeline needs at least one shard")
+
+    # The front end only routes datasets, the shards store them
+    self.data_directory = None
+    self.processing_directory = None
+    self.outbox_directory = None
+    if self.metrics_sink is None:
+      self.metrics_sink = ShardedMetrics(self._collect_shard_metrics)
+
+    self._request_ids = count()
+    self._pending: Dict[int, Future] = {}
+    self._pending_lock = Lock()
+    self._association_shards: Dict[int, Tuple[AcceptedContainer, Set[int]]] = {}
+    "Accepted associations and the shards, that have received datasets from them"
+    self._association_lock = Lock()
+
+    super().__init__()
+
+    context = multiprocessing.get_context(self.shard_start_method)
+    self._responses = context.Queue()
+    self._requests = [context.Queue() for _ in range(self.shards)]
+    self._processes: List[BaseProcess] = [
+      context.Process(target=_run_shard,
+                      args=(type(self), shard, self._requests[shard], self._responses),
+                      name=f"{self.ae_title}_shard_{shard}",
+                      daemon=True)
+      for shard in range(self.shards)
+    ]
+    for process in self._processes:
+      process.start()
+    self._response_thread = Thread(target=self._collect_responses,
+                                   name="ShardResponses", daemon=True)
+    self._response_thread.start()
+
+  ##### Front end #####
+  def _request(self, shard: int, kind: str, payload: Any = None) -> Future:
+    future: Future = Future()
+    request_id = next(self._request_ids)
+    with self._pending_lock:
+      self._pending[request_id] = future
+    self._requests[shard].put((kind, request_id, payload))
+    return future
+
+  def _notify(self, shard: int, kind: str, payload: Any = None) -> None:
+    self._requests[shard].put((kind, None, payload))
+
+  def _collect_responses(self) -> None:
+    while True:
+      request_id, result = self._responses.get()
+      if request_id is None:
+        return
+      with self._pending_lock:
+        future = self._pending.pop(request_id, None)
+      if future is not None:
+        future.set_result(result)
+
+  def _wait(self, shard: int, future: Future) -> Any:
+    """Waits for the response of a shard, None if the shard didn't respond
+    within the shard_timeout or died meanwhile"""
+    deadline = monotonic() + self.shard_timeout
+    while True:
+      try:
+        return future.result(max(0.0, min(0.1, deadline - monotonic())))
+      except FutureTimeoutError:
+        if deadline <= monotonic() or not self._processes[shard].is_alive():
+          break
+    # A late response is discarded
+    with self._pending_lock:
+      self._pending = {request_id: pending for request_id, pending in self._pending.items()
+                       if pending is not future}
+    return None
+
+  def _consume_c_store_container(self, c_store_container: CStoreContainer) -> int:
+    if self.shard is not None:
+      return super()._consume_c_store_container(c_store_container)
+
+    if self.patient_identifier_tag not in c_store_container.dataset:
+      self.logger.debug(f"Node: Received dataset, doesn't have patient Identifier tag")
+      return 0xB007
+    patient_id = str(c_store_container.dataset[self.patient_identifier_tag].value)
+    shard = shard_index(patient_id, self.shards)
+    if not self._processes[shard].is_alive():
+      self.logger.error(f"Shard {shard} is not running, refusing dataset")
+      return 0xA700 # Refused: Out of resources
+
+    with self._association_lock:
+      association = self._association_shards.get(c_store_container.assocation_id)
+      if association is not None and shard not in association[1]:
+        association[1].add(shard)
+        self._notify(shard, "accepted", association[0])
+
+    status = self._wait(shard, self._request(shard, "store", c_store_container))
+    if status is None:
+      self.logger.error(f"Shard {shard} didn't handle the C-STORE in time, refusing dataset")
+      return 0xA700 # Refused: Out of resources
+    return status
+
+  def _handle_association_accepted(self, event: evt.Event):
+    if self.shard is not None:
+      return super()._handle_association_accepted(event) # pragma: no cover
+
+    self.logger.debug(f"Association with {event.assoc.requestor.ae_title} - {event.assoc.requestor.address} Accepted")
+    accepted_container = self._association_container_factory.build_assocation_accepted(event)
+    with self._association_lock:
+      self._association_shards[accepted_container.assocation_id] = (accepted_container, set())
+
+  def _handle_association_released(self, event: evt.Event):
+    if self.shard is not None:
+      return super()._handle_association_released(event) # pragma: no cover
+
+    self.logger.info(f"Association with {event.assoc.requestor.ae_title} Released.")
+    released_container = self._association_container_factory.build_assocation_released(event)
+    with self._association_lock:
+      association = self._association_shards.pop(released_container.assocation_id, None)
+    if association is not None:
+      for shard in association[1]:
+        self._notify(shard, "released", released_container)
+
+  def status(self) -> List[ShardStatus]:
+    """Gets the status of each shard
+
+    Returns:
+        List[ShardStatus]: The status of the shards, ordered by shard
+    """
+    requests: List[Tuple[int, BaseProcess, Optional[Future]]] = []
+    for shard, process in enumerate(self._processes):
+      future = self._request(shard, "status") if process.is_alive() else None
+      requests.append((shard, process, future))
+
+    statuses: List[ShardStatus] = []
+    for shard, process, future in requests:
+      status = None if future is None else self._wait(shard, future)
+      if status is None:
+        status = ShardStatus(shard, process.pid, process.is_alive())
+      statuses.append(status)
+    return statuses
+
+  def _collect_shard_metrics(self) -> List[MetricsSnapshot]:
+    futures = [(shard, self._request(shard, "metrics"))
+               for shard, process in enumerate(self._processes) if process.is_alive()]
+    snapshots = [self._wait(shard, future) for shard, future in futures]
+    return [snapshot for snapshot in snapshots if snapshot is not None]
+
+  def close(self) -> None:
+    super().close()
+    if self.shard is not None:
+      return
+
+    for shard in range(self.shards):
+      self._notify(shard, "stop")
+    for process in self._processes:
+      process.join(self.shard_timeout)
+      if process.is_alive():
+        self.logger.error(f"{process.name} didn't stop in time, terminating it") # pragma: no cover
+        process.terminate() # pragma: no cover
+    self._responses.put((None, None))
+    self._response_thread.join()
+
+  ##### Worker #####
+  def _serve_shard(self,
+                   requests: 'multiprocessing.Queue[Any]',
+                   responses: 'multiprocessing.Queue[Any]') -> None:
+    """Handles the requests of the front end, until it's told to stop.
+    Patients are processed by a separate job thread, both when released and
+    when made ready by a C-STORE, such that datasets are stored while
+    patients are processed."""
+    self._open_services()
+    self._jobs: Queue[Optional[Callable[[], None]]] = Queue()
+    job_thread = Thread(target=self._run_jobs, name="ShardJobs", daemon=True)
+    job_thread.start()
+
+    handlers: Dict[str, Callable[[Any], Any]] = {
+      "store" : self._consume_c_store_container,
+      "accepted" : self._consume_accepted_container,
+      "released" : lambda released_container: self._jobs.put(
+        partial(self._consume_released_container, released_container)),
+      "status" : lambda _: self._shard_status(),
+      "metrics" : lambda _: self.metrics_sink.snapshot(), # type: ignore
+    }
+    try:
+      while True:
+        kind, request_id, payload = requests.get()
+        if kind == "stop":
+          break
+        try:
+          result = handlers[kind](payload)
+        except Exception as exception:
+          log_traceback(self.logger, exception, f"Shard {self.shard} handling {kind}")
+          result = None
+        if request_id is not None:
+          responses.put((request_id, result))
+    finally:
+      self._jobs.put(None)
+      job_thread.join()
+      self.close()
+
+  def _consume_accepted_container(self, accepted_container: AcceptedContainer) -> None:
+    for association_type in accepted_container.assocation_types:
+      handler = self._acceptation_handlers.get(association_type)
+      if handler is not None:
+        handler(self, accepted_container)
+
+  def _consume_released_container(self, released_container: ReleasedContainer) -> None:
+    for association_type in released_container.assocation_types:
+      handler = self._release_handlers.get(association_type)
+      if handler is not None:
+        handler(self, released_container)
+
+  def _process_ready_patient(self, patient_ID: str, released_container: ReleasedContainer) -> None:
+    if self.shard is None:
+      return super()._process_ready_patient(patient_ID, released_container) # pragma: no cover
+    # The request loop must not block on processing, see _serve_shard
+    self._jobs.put(partial(self._process_patient, patient_ID, released_container))
+
+  def _run_jobs(self) -> None:
+    while True:
+      job = self._jobs.get()
+      if job is None:
+        return
+      try:
+        job()
+      except Exception as exception:
+        log_traceback(self.logger, exception, f"Shard {self.shard} processing")
+
+  def _shard_status(self) -> ShardStatus:
+    with self._in_flight_lock:
+      in_flight = len(self._in_flight)
+    return ShardStatus(
+      self.shard, # type: ignore
+      multiprocessing.current_process().pid,
+      True,
+      patients=len(self.data_state.data),
+      images=self.data_state.images,
+      in_flight=in_flight,
+    )
@@ -1,3 +1,4 @@
 from . import show
 from . import store
-from . import anonymize
\ No newline at end of file
+from . import anonymize
+from . import loadgen
@@ -0,0 +1,373 @@
+"""Script part of the omnitool used to stress test a running node.
+
+Synthetic series are generated in memory and sent over a number of concurrent
+associations. The report contains the sustained images/s, the latencies of the
+C-STOREs and, if the node is configured to send its output back to the load
+generator, the time from a patient was sent until its output arrived.
+"""
+
+__author__ = "Christoffer Vilstrup Jensen"
+
+# Python standard library
+from argparse import _SubParsersAction, Namespace
+from dataclasses import dataclass, field
+import json
+from math import ceil
+from pathlib import Path
+from queue import Queue
+from threading import Event, Lock
+from time import monotonic, perf_counter, sleep
+from typing import Any, Dict, Iterator, List, Optional
+from uuid import uuid4
+
+# Third party packages
+from pydicom import Dataset
+from pydicom.uid import UID, DeflatedExplicitVRLittleEndian, ExplicitVRLittleEndian,\
+  ImplicitVRLittleEndian, RLELossless, SecondaryCaptureImageStorage
+from pynetdicom import evt
+from pynetdicom.ae import ApplicationEntity
+from pynetdicom.presentation import AllStoragePresentationContexts
+
+# Dicomnode packages
+from dicomnode.lib.dicom import gen_uid
+from dicomnode.lib.dimse import Address
+from dicomnode.lib.synthetic import generate_numpy_datasets
+from dicomnode.lib.utils import ThreadWithReturnValue
+
+COMPRESSIONS: Dict[str, UID] = {
+  "none" : ImplicitVRLittleEndian,
+  "explicit" : ExplicitVRLittleEndian,
+  "deflate" : DeflatedExplicitVRLittleEndian,
+  "rle" : RLELossless,
+}
+"Transfer syntaxes the images can be sent with"
+
+_STOP = None
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+  """Nearest rank percentile of values, None if there are no values"""
+  if not values:
+    return None
+  ordered = sorted(values)
+  rank = min(max(ceil(q / 100 * len(ordered)) - 1, 0), len(ordered) - 1)
+  return ordered[rank]
+
+
+@dataclass
+class LoadReport:
+  """Result of a load generation run"""
+  images_sent: int = 0
+  "Images the node accepted"
+  images_failed: int = 0
+  "Images that failed or were rejected"
+  bytes_sent: int = 0
+  "Bytes of pixel data accepted by the node"
+  seconds: float = 0.0
+  "Wall time from the first C-STORE until the last one completed"
+  associations: int = 1
+  latencies: List[float] = field(default_factory=list)
+  "Seconds of every successful C-STORE"
+  time_to_output: Dict[str, float] = field(default_factory=dict)
+  "Seconds from the last image of a patient was sent until its first output arrived"
+  patients: int = 0
+
+  @property
+  def images_per_second(self) -> float:
+    if self.seconds <= 0:
+      return 0.0
+    return self.images_sent / self.seconds
+
+  @property
+  def patients_without_output(self) -> int:
+    return self.patients - len(self.time_to_output)
+
+  def to_json(self) -> Dict[str, Any]:
+    latencies = {f"p{q}" : percentile(self.latencies, q) for q in (50, 90, 99)}
+    latencies["max"] = max(self.latencies) if self.latencies else None
+    time_to_output = list(self.time_to_output.values())
+    outputs = {f"p{q}" : percentile(time_to_output, q) for q in (50, 90, 99)}
+    outputs["max"] = max(time_to_output) if time_to_output else None
+    return {
+      'images_sent' : self.images_sent,
+      'images_failed' : self.images_failed,
+      'bytes_sent' : self.bytes_sent,
+      'seconds' : self.seconds,
+      'associations' : self.associations,
+      'images_per_second' : self.images_per_second,
+      'latency_seconds' : latencies,
+      'time_to_output_seconds' : outputs,
+      'patients' : self.patients,
+      'patients_without_output' : self.patients_without_output,
+    }
+
+  def render(self) -> str:
+    def milliseconds(value: Optional[float]) -> str:
+      return "-" if value is None else f"{value * 1000:.1f} ms"
+
+    def seconds(value: Optional[float]) -> str:
+      return "-" if value is None else f"{value:.2f} s"
+
+    lines = [
+      f"Sent {self.images_sent} images in {self.seconds:.2f} s over {self.associations} associations, {self.images_failed} failed",
+      f"Sustained throughput: {self.images_per_second:.1f} images/s, {self.bytes_sent / max(self.seconds, 1e-9) / 2**20:.1f} MiB/s of pixel data",
+      "C-STORE latency: " + ", ".join(
+        f"p{q} {milliseconds(percentile(self.latencies, q))}" for q in (50, 90, 99)
+      ) + f", max {milliseconds(max(self.latencies) if self.latencies else None)}",
+    ]
+    if self.time_to_output or self.patients_without_output != self.patients:
+      time_to_output = list(self.time_to_output.values())
+      lines.append("Time to output: " + ", ".join(
+        f"p{q} {seconds(percentile(time_to_output, q))}" for q in (50, 90, 99)
+      ) + f", max {seconds(max(time_to_output) if time_to_output else None)}")
+    if self.patients_without_output:
+      lines.append(f"{self.patients_without_output} of {self.patients} patients got no output")
+    return "\n".join(lines)
+
+
+class LoadGenerator:
+  """Sends synthetic series to a node over concurrent associations and
+  measures how the node copes.
+
+  Every patient gets series_per_patient series of images_per_series images.
+  The images are generated lazily, such that memory use stays bounded for
+  long runs.
+
+  Args:
+    SCU_AE (str): AE title the images are sent from
+    address (Address): Address of the node
+    patients (int): Number of patients to send. Defaults to 1.
+    series_per_patient (int): Series per patient. Defaults to 1.
+    images_per_series (int): Images per series. Defaults to 100.
+    rows (int): Rows of the images. Defaults to 512.
+    columns (int): Columns of the images. Defaults to 512.
+    bits (int): Bits per pixel. Defaults to 16.
+    associations (int): Number of concurrent associations. Defaults to 4.
+    rate (Optional[float]): Target images/s over all associations, None
+      sends as fast as the node accepts. Defaults to None.
+    compression (str): Key of COMPRESSIONS, the transfer syntax the images
+      are sent in. The node must accept it. Defaults to "none".
+    output_port (Optional[int]): If set a storage SCP is started at this
+      port, which should be a destination of the node, to measure the time
+      to output. Outputs are matched to patients by PatientID.
+      Defaults to None.
+    output_ae (str): AE title of the storage SCP. Defaults to "LOADGEN".
+    output_timeout (float): Seconds to wait for outputs after the last image
+      is sent. Defaults to 60.0.
+  """
+
+  def __init__(self,
+               SCU_AE: str,
+               address: Address,
+               patients: int = 1,
+               series_per_patient: int = 1,
+               images_per_series: int = 100,
+               rows: int = 512,
+               columns: int = 512,
+               bits: int = 16,
+               associations: int = 4,
+               rate: Optional[float] = None,
+               compression: str = "none",
+               output_port: Optional[int] = None,
+               output_ae: str = "LOADGEN",
+               output_timeout: float = 60.0) -> None:
+    if associations < 1:
+      raise ValueError("associations must be at least 1")
+    if compression not in COMPRESSIONS:
+      raise ValueError(f"compression must be one of {', '.join(COMPRESSIONS)}")
+    if rate is not None and rate <= 0:
+      raise ValueError("rate must be positive")
+    self.SCU_AE = SCU_AE
+    self.address = address
+    self.patients = patients
+    self.series_per_patient = series_per_patient
+    self.images_per_series = images_per_series
+    self.rows = rows
+    self.columns = columns
+    self.bits = bits
+    self.associations = associations
+    self.rate = rate
+    self.compression = compression
+    self.output_port = output_port
+    self.output_ae = output_ae
+    self.output_timeout = output_timeout
+
+    self.run_id = uuid4().hex[:8]
+    self._lock = Lock()
+    self._outputs: Dict[str, float] = {}
+    self._last_sent: Dict[str, float] = {}
+
+  def patient_id(self, index: int) -> str:
+    return f"LOADGEN_{self.run_id}_{index}"
+
+  def datasets(self) -> Iterator[Dataset]:
+    """The images sent, patient by patient and series by series"""
+    transfer_syntax = COMPRESSIONS[self.compression]
+    for patient_index in range(self.patients):
+      patient_id = self.patient_id(patient_index)
+      study_uid = gen_uid()
+      for _ in range(self.series_per_patient):
+        for dataset in generate_numpy_datasets(self.images_per_series,
+                                               StudyUID=study_uid,
+                                               SeriesUID=gen_uid(),
+                                               Cols=self.columns,
+                                               Rows=self.rows,
+                                               Bits=self.bits,
+                                               PatientID=patient_id):
+          if transfer_syntax.is_compressed:
+            dataset.compress(transfer_syntax)
+          else:
+            dataset.file_meta.TransferSyntaxUID = transfer_syntax
+          yield dataset
+
+  def _produce(self, queue: Queue, stop: Event) -> None:
+    for sequence, dataset in enumerate(self.datasets()):
+      if stop.is_set():
+        break
+      queue.put((sequence, dataset))
+    for _ in range(self.associations):
+      queue.put(_STOP)
+
+  def _send(self, queue: Queue, start: float, stop: Event) -> LoadReport:
+    report = LoadReport()
+    ae = ApplicationEntity(ae_title=self.SCU_AE)
+    ae.add_requested_context(SecondaryCaptureImageStorage, COMPRESSIONS[self.compression])
+    assoc = ae.associate(self.address.ip, self.address.port, ae_title=self.address.ae_title)
+    if not assoc.is_established:
+      stop.set() # A node refusing one association is unlikely to accept the rest
+    try:
+      while (item := queue.get()) is not _STOP:
+        sequence, dataset = item
+        if not assoc.is_established:
+          report.images_failed += 1
+          continue
+        if self.rate is not None:
+          delay = start + sequence / self.rate - perf_counter()
+          if delay > 0:
+            sleep(delay)
+        sent_at = monotonic()
+        with self._lock:
+          self._last_sent[dataset.PatientID] = max(self._last_sent.get(dataset.PatientID, sent_at), sent_at)
+        before = perf_counter()
+        try:
+          response = assoc.send_c_store(dataset)
+        except Exception:
+          report.images_failed += 1
+          continue
+        latency = perf_counter() - before
+        if 'Status' in response and response.Status == 0x0000:
+          report.images_sent += 1
+          report.bytes_sent += len(dataset.PixelData)
+          report.latencies.append(latency)
+        else:
+          report.images_failed += 1
+    finally:
+      if assoc.is_established:
+        assoc.release()
+    return report
+
+  def _handle_output(self, event: evt.Event) -> int:
+    patient_id = str(event.dataset.get('PatientID', ''))
+    with self._lock:
+      if patient_id not in self._outputs:
+        self._outputs[patient_id] = monotonic()
+    return 0x0000
+
+  def _wait_for_outputs(self) -> None:
+    patient_ids = {self.patient_id(index) for index in range(self.patients)}
+    deadline = monotonic() + self.output_timeout
+    while monotonic() < deadline:
+      with self._lock:
+        if patient_ids <= self._outputs.keys():
+          return
+      sleep(0.05)
+
+  def run(self) -> LoadReport:
+    """Sends all images and waits for the outputs
+
+    Returns:
+        LoadReport: The measurements of the run
+    """
+    output_server = None
+    if self.output_port is not None:
+      output_ae = ApplicationEntity(ae_title=self.output_ae)
+      output_ae.supported_contexts = AllStoragePresentationContexts
+      output_server = output_ae.start_server(('0.0.0.0', self.output_port),
+                                             block=False,
+                                             evt_handlers=[(evt.EVT_C_STORE, self._handle_output)])
+    try:
+      queue: Queue = Queue(maxsize=4 * self.associations)
+      stop = Event()
+      producer = ThreadWithReturnValue(target=self._produce, args=(queue, stop), daemon=True)
+      start = perf_counter()
+      senders = [ThreadWithReturnValue(target=self._send, args=(queue, start, stop), daemon=True)
+                 for _ in range(self.associations)]
+      producer.start()
+      for sender in senders:
+        sender.start()
+
+      report = LoadReport(associations=self.associations, patients=self.patients)
+      for sender in senders:
+        partial_report: LoadReport = sender.join()
+        report.images_sent += partial_report.images_sent
+        report.images_failed += partial_report.images_failed
+        report.bytes_sent += partial_report.bytes_sent
+        report.latencies.extend(partial_report.latencies)
+      report.seconds = perf_counter() - start
+      producer.join()
+
+      if output_server is not None:
+        self._wait_for_outputs()
+        with self._lock:
+          for patient_id, received_at in self._outputs.items():
+            if patient_id in self._last_sent:
+              report.time_to_output[patient_id] = received_at - self._last_sent[patient_id]
+    finally:
+      if output_server is not None:
+        output_server.shutdown()
+    return report
+
+
+def get_parser(subparser : _SubParsersAction):
+  _, _, tool_name = __name__.split(".")
+  module_parser = subparser.add_parser(tool_name, help="Stress tests a node with synthetic series")
+  module_parser.add_argument('ip', type=str, help="IP of the node")
+  module_parser.add_argument('port', type=int, help="Port of the node")
+  module_parser.add_argument('SCP_AE', type=str, help="The AE title of the node")
+  module_parser.add_argument('--SCU_AE', type=str, default="LOADGEN", help="The AE title the images are sent from")
+  module_parser.add_argument('--patients', type=int, default=1, help="Number of patients")
+  module_parser.add_argument('--series', type=int, default=1, help="Series per patient")
+  module_parser.add_argument('--images', type=int, default=100, help="Images per series")
+  module_parser.add_argument('--rows', type=int, default=512, help="Rows of each image")
+  module_parser.add_argument('--columns', type=int, default=512, help="Columns of each image")
+  module_parser.add_argument('--bits', type=int, default=16, help="Bits per pixel")
+  module_parser.add_argument('--associations', type=int, default=4, help="Number of concurrent associations")
+  module_parser.add_argument('--rate', type=float, default=None, help="Target images/s, default is as fast as possible")
+  module_parser.add_argument('--compression', choices=list(COMPRESSIONS), default="none", help="Transfer syntax of the images")
+  module_parser.add_argument('--output-port', type=int, default=None, help="Port to receive the output of the node at, to measure time to output")
+  module_parser.add_argument('--output-ae', type=str, default="LOADGEN", help="AE title receiving the output of the node")
+  module_parser.add_argument('--output-timeout', type=float, default=60.0, help="Seconds to wait for outputs")
+  module_parser.add_argument('--json', type=Path, default=None, help="Write the report to this file as JSON")
+
+def entry_func(args : Namespace):
+  load_generator = LoadGenerator(
+    args.SCU_AE,
+    Address(args.ip, args.port, args.SCP_AE),
+    patients=args.patients,
+    series_per_patient=args.series,
+    images_per_series=args.images,
+    rows=args.rows,
+    columns=args.columns,
+    bits=args.bits,
+    associations=args.associations,
+    rate=args.rate,
+    compression=args.compression,
+    output_port=args.output_port,
+    output_ae=args.output_ae,
+    output_timeout=args.output_timeout,
+  )
+  report = load_generator.run()
+  print(report.render())
+  if args.json is not None:
+    with open(args.json, 'w') as json_file:
+      json.dump(report.to_json(), json_file, indent=2)
@@ -1,4 +1,5 @@
 import cProfile
+from dataclasses import dataclass
 import pstats
 from logging import Logger
 from pathlib import Path
@@ -6,6 +7,7 @@ from time import perf_counter
 from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional,\
                     Tuple, Type, Union
 import os
+import tracemalloc
 import numpy
 from pydicom import Dataset
 from pydicom.uid import UID, SecondaryCaptureImageStorage
@@ -22,89 +24,7 @@ except KeyError:
 # Dicomnode
 from dicomnode.lib.logging import set_logger
 from dicomnode.lib.dicom import gen_uid, make_meta
-
-unsigned_array_encoding: Dict[int, Type[numpy.unsignedinteger]] = {
-  8 : numpy.uint8,
-  16 : numpy.uint16,
-  32 : numpy.uint32,
-  64 : numpy.uint64,
-}
-
-def generate_numpy_dataset(
-    StudyUID: UID,
-    SeriesUID: UID,
-    Cols: int,
-    Rows: int,
-    bits: int,
-    rescale: bool,
-    PixelRepresentation: int,
-    PatientID: str
-  ) -> Dataset:
-  ds = Dataset()
-  ds.SOPClassUID = SecondaryCaptureImageStorage
-  ds.PatientID = PatientID
-  ds.SOPInstanceUID = gen_uid()
-  ds.StudyInstanceUID = StudyUID
-  ds.SeriesInstanceUID = SeriesUID
-
-  ds.PhotometricInterpretation = "MONOCHROME2"
-  ds.SamplesPerPixel = 1
-  ds.Rows = Rows
-  ds.Columns = Cols
-  ds.PixelRepresentation = PixelRepresentation
-
-  make_meta(ds)
-
-  if bits % 8 == 0:
-    ds.BitsAllocated = bits
-  else:
-    ds.BitsAllocated = bits + (8 - (bits % 8))
-  ds.BitsStored = bits
-  ds.HighBit = bits - 1
-
-  dType = unsigned_array_encoding.get(ds.BitsAllocated)
-
-  if dType is None:
-    raise ValueError
-
-  if rescale:
-    slope = numpy.random.uniform(0, 2 / (2 ** bits - 1))
-    intercept = numpy.random.uniform(0, (2 ** bits - 1))
-    ds.RescaleSlope = slope
-    ds.RescaleIntercept = intercept
-
-  image = numpy.random.randint(0, 2 ** bits - 1, (Cols, Rows), dtype=dType)
-  ds.PixelData = image.tobytes()
-
-
-  return ds
-
-def generate_numpy_datasets(
-    datasets: int,
-    StudyUID = gen_uid(),
-    SeriesUID = gen_uid(),
-    Cols = 400,
-    Rows = 400,
-    Bits = 16,
-    rescale = True,
-    PixelRepresentation = 0,
-    PatientID: str = "None"
-  ) -> Iterator[Dataset]:
-  yielded = 0
-  while yielded < datasets:
-    yielded += 1
-    ds = generate_numpy_dataset(
-      StudyUID,
-      SeriesUID,
-      Cols,
-      Rows,
-      Bits,
-      rescale,
-      PixelRepresentation,
-      PatientID
-    )
-    ds.InstanceNumber = yielded + 1
-    yield ds
+from dicomnode.lib.synthetic import unsigned_array_encoding, generate_numpy_dataset, generate_numpy_datasets
 
 def generate_id_dataset(
     datasets: int,
@@ -147,6 +67,105 @@ def bench(func: Callable) -> Callable:
   return inner
 
 
+@dataclass
+class BenchmarkResult:
+  name: str
+  seconds: float
+  "Best wall time of the repeats"
+  items: int
+  unit: str
+  peak_memory_bytes: int
+  "Peak memory allocated by python during a run, measured with tracemalloc"
+
+  @property
+  def throughput(self) -> float:
+    return self.items / self.seconds if self.seconds > 0 else float('inf')
+
+  def to_json(self) -> Dict[str, Any]:
+    return {
+      'seconds' : self.seconds,
+      'items' : self.items,
+      'unit' : self.unit,
+      'throughput' : self.throughput,
+      'peak_memory_bytes' : self.peak_memory_bytes,
+    }
+
+BENCHMARK_RESULTS: Dict[str, BenchmarkResult] = {}
+"Results of the benchmarks run by this process, collected by runPerformance.py"
+
+def benchmark(name: str,
+              func: Callable[[], Any],
+              items: int,
+              unit: str = "items",
+              repeats: int = 3,
+              setup: Optional[Callable[[], None]] = None) -> BenchmarkResult:
+  """Measures the throughput and peak memory of a function and records it in
+  BENCHMARK_RESULTS
+
+  The function is run once to warm up, then repeats times where the fastest
+  run is kept, and finally once more under tracemalloc to measure memory.
+
+  Args:
+      name (str): Name of the benchmark, key in the JSON results
+      func (Callable[[], Any]): The code to be benchmarked
+      items (int): Number of items processed by a call of func
+      unit (str, optional): Name of the items. Defaults to "items".
+      repeats (int, optional): Number of timed runs. Defaults to 3.
+      setup (Optional[Callable[[], None]], optional): Called before every run,
+        and not timed. Defaults to None.
+
+  Returns:
+      BenchmarkResult: The result
+  """
+  def run() -> float:
+    if setup is not None:
+      setup()
+    start = perf_counter()
+    func()
+    return perf_counter() - start
+
+  run() # Warm up
+  seconds = min(run() for _ in range(repeats))
+
+  tracemalloc.start()
+  try:
+    run()
+    _, peak_memory = tracemalloc.get_traced_memory()
+  finally:
+    tracemalloc.stop()
+
+  result = BenchmarkResult(name, seconds, items, unit, peak_memory)
+  BENCHMARK_RESULTS[name] = result
+  print(f"{name}: {result.throughput:.1f} {unit}/s, {seconds:.4f}s, peak memory {peak_memory / 2**20:.1f} MiB")
+  return result
+
+def compare_benchmarks(results: Dict[str, Dict[str, Any]],
+                       baseline: Dict[str, Dict[str, Any]],
+                       tolerance: float = 0.1) -> List[str]:
+  """Compares benchmark results against a baseline
+
+  Args:
+      results (Dict[str, Dict[str, Any]]): Results as written by runPerformance.py
+      baseline (Dict[str, Dict[str, Any]]): Results of a previous run
+      tolerance (float, optional): Allowed relative decrease in throughput and
+        increase in memory. Defaults to 0.1.
+
+  Returns:
+      List[str]: Descriptions of the regressions, empty if there's none
+  """
+  regressions = []
+  for name, result in results.items():
+    if name not in baseline:
+      continue
+    base = baseline[name]
+    if result['throughput'] < base['throughput'] * (1 - tolerance):
+      regressions.append(
+        f"{name}: throughput {result['throughput']:.1f} {result['unit']}/s is below the baseline {base['throughput']:.1f} {base['unit']}/s")
+    if result['peak_memory_bytes'] > base['peak_memory_bytes'] * (1 + tolerance):
+      regressions.append(
+        f"{name}: peak memory {result['peak_memory_bytes']} bytes is above the baseline {base['peak_memory_bytes']} bytes")
+  return regressions
+
 def get_test_ae(port: int, destination_port:int, logger: Logger, dataset: Optional[Dataset] = None):
   if dataset is None:
     dataset = Dataset()
@@ -1,9 +1,10 @@
+from os import getpid
 from unittest import TestCase
 
-from pydicom import Dataset
+from pydicom import Dataset, Sequence
 
 from pydicom.uid import ExplicitVRBigEndian, ExplicitVRLittleEndian, ImplicitVRLittleEndian, CTImageStorage
-from dicomnode.lib.dicom import get_tag, make_meta, gen_uid, extrapolate_image_position_patient, extrapolate_image_position_patient_dataset
+from dicomnode.lib.dicom import estimate_dataset_size, get_tag, make_meta, gen_uid, gen_uids, set_uid_generator, UIDGenerator, extrapolate_image_position_patient, extrapolate_image_position_patient_dataset
 from dicomnode.lib.exceptions import InvalidDataset
 
 class DicomTestCase(TestCase):
@@ -287,3 +288,65 @@ class DicomTestCase(TestCase):
     slices = 10
 
     self.assertRaises(InvalidDataset, extrapolate_image_position_patient_dataset, dataset, slices)
+
+  def test_uid_generator_fixed_root_is_deterministic(self):
+    generator_1 = UIDGenerator(root=1)
+    generator_2 = UIDGenerator(root=1)
+    self.assertEqual(generator_1.generate_many(10), generator_2.generate_many(10))
+    self.assertEqual(UIDGenerator(root=1)(), "1.2.826.0.1.3680043.10.1083.1.1")
+
+  def test_uid_generator_unique_and_valid(self):
+    generator = UIDGenerator()
+    uids = generator.generate_many(1000)
+    uids.append(generator())
+    self.assertEqual(len(set(uids)), 1001)
+    for uid in uids:
+      self.assertTrue(uid.is_valid)
+      self.assertLessEqual(len(uid), 64)
+
+  def test_uid_generator_reseeds_on_exhaustion(self):
+    generator = UIDGenerator()
+    generator._counter = generator._max_counter
+    last_base = generator._base
+    uid = generator()
+    self.assertFalse(uid.startswith(last_base))
+    self.assertTrue(uid.is_valid)
+
+  def test_uid_generator_fixed_root_exhaustion(self):
+    generator = UIDGenerator(root=1)
+    generator._counter = generator._max_counter
+    self.assertRaises(ValueError, generator)
+
+  def test_uid_generator_reseeds_in_forked_process(self):
+    generator = UIDGenerator()
+    parent_base = generator._base
+    generator._pid = getpid() + 1 # Pretend the generator was made in another process
+    self.assertFalse(generator().startswith(parent_base))
+
+  def test_uid_generator_invalid_arguments(self):
+    self.assertRaises(ValueError, UIDGenerator, "1.2.3")
+    self.assertRaises(ValueError, UIDGenerator, root=-1)
+    self.assertRaises(ValueError, UIDGenerator, "1." * 32)
+
+  def test_set_uid_generator(self):
+    old_generator = set_uid_generator(UIDGenerator(root=42))
+    try:
+      self.assertEqual(gen_uid(), "1.2.826.0.1.3680043.10.1083.42.1")
+      self.assertEqual(gen_uids(2), ["1.2.826.0.1.3680043.10.1083.42.2",
+                                     "1.2.826.0.1.3680043.10.1083.42.3"])
+    finally:
+      set_uid_generator(old_generator)
+
+  def test_estimate_dataset_size(self):
+    dataset = Dataset()
+    dataset.PatientID = "1502799995"
+    empty_size = estimate_dataset_size(dataset)
+    dataset.PixelData = bytes(10000)
+    pixel_size = estimate_dataset_size(dataset)
+    self.assertGreaterEqual(pixel_size - empty_size, 10000)
+    self.assertLess(pixel_size - empty_size, 10200)
+
+    item = Dataset()
+    item.PixelData = bytes(5000)
+    dataset.ReferencedImageSequence = Sequence([item])
+    self.assertGreaterEqual(estimate_dataset_size(dataset) - pixel_size, 5000)
@@ -6,21 +6,25 @@ __author__ = "Christoffer Vilstrup Jensen"
 import logging
 from pprint import pprint, pformat
 from random import randint
+from threading import Event
+from time import sleep
 from unittest import skip, TestCase
 
 #Third party packages
 from pydicom import Dataset
-from pydicom.uid import SecondaryCaptureImageStorage
-from pynetdicom import debug_logger
+from pydicom.uid import SecondaryCaptureImageStorage, CTImageStorage
+from pynetdicom import debug_logger, evt
+from pynetdicom.ae import ApplicationEntity
+from pynetdicom.presentation import AllStoragePresentationContexts
 
 # Dicomnode packages
 from dicomnode.lib.exceptions import InvalidQueryDataset, CouldNotCompleteDIMSEMessage
 from dicomnode.lib.logging import get_logger, DEBUG
-from dicomnode.lib.dicom import make_meta
-from dicomnode.lib.dimse import send_move, Address, QueryLevels
+from dicomnode.lib.dicom import make_meta, gen_uid
+from dicomnode.lib.dimse import add_return_keys, send_move, send_find, FindCache, send_images, send_images_sharded, Address, AssociationPool, MoveCoordinator, QueryLevels
 
 # Dicomnode tests helpers
-from tests.helpers import get_test_ae
+from tests.helpers import benchmark, generate_numpy_datasets, get_test_ae
 
 logger = get_logger()
 
@@ -72,3 +76,354 @@ class DIMSETestCases(TestCase):
       self.assertRaises(CouldNotCompleteDIMSEMessage,send_move,"Dummy", address, dataset)
 
 
+  def test_send_find(self):
+    endpoint_port = randint(1025,65535)
+    endpoint = get_test_ae(endpoint_port, endpoint_port, logger)
+    address = Address('localhost', endpoint_port, "PYNETDICOM")
+
+    dataset = Dataset()
+    dataset.PatientID = "1506932263"
+    try:
+      matches = send_find(self.TEST_CASE_AE, address, dataset)
+    finally:
+      endpoint.shutdown()
+    self.assertEqual(dataset.QueryRetrieveLevel, "PATIENT")
+    self.assertEqual(len(matches), 1)
+    self.assertEqual(matches[0].PatientID, "1506932263")
+
+  def test_send_find_invalid_queries(self):
+    address = Address('localhost', 4321, "PYNETDICOM")
+    self.assertRaises(InvalidQueryDataset, send_find, "Dummy", address, Dataset(), QueryLevels.SERIES)
+
+  def test_send_find_study_level_with_cache(self):
+    endpoint_port = randint(1025,65535)
+    endpoint = get_test_ae(endpoint_port, endpoint_port, logger)
+    address = Address('localhost', endpoint_port, "PYNETDICOM")
+    cache = FindCache(ttl=60)
+
+    def query():
+      dataset = Dataset()
+      dataset.PatientID = "1506932263"
+      return add_return_keys(dataset, [0x00080060])
+
+    try:
+      matches = send_find(self.TEST_CASE_AE, address, query(), QueryLevels.STUDY, cache=cache)
+      with self.assertLogs(logger, DEBUG) as log_records:
+        cached_matches = send_find(self.TEST_CASE_AE, address, query(), QueryLevels.STUDY, cache=cache)
+    finally:
+      endpoint.shutdown()
+    self.assertIn("DEBUG:dicomnode:C-FIND to PYNETDICOM answered from cache", log_records.output)
+    self.assertEqual(len(matches), 1)
+    self.assertEqual(cached_matches[0].StudyInstanceUID, matches[0].StudyInstanceUID)
+    self.assertEqual(len(cache), 1)
+
+  def test_add_return_keys(self):
+    dataset = add_return_keys(Dataset(), [0x00080060, 0x0020000E])
+    self.assertFalse(dataset.Modality)
+    self.assertIn(0x0020000E, dataset)
+
+  def test_send_find_no_connection(self):
+    address = Address('localhost', 4321, "PYNETDICOM")
+    dataset = Dataset()
+    dataset.PatientID = "FooBar"
+    logging.getLogger("pynetdicom").setLevel(logging.CRITICAL + 1)
+    with self.assertLogs(logger, DEBUG):
+      self.assertRaises(CouldNotCompleteDIMSEMessage, send_find, "Dummy", address, dataset)
+
+
+class AssociationPoolTestCase(TestCase):
+  SCU_AE = "TEST_CASE"
+
+  def setUp(self) -> None:
+    self.endpoint_port = randint(1025,65535)
+    self.endpoint = get_test_ae(self.endpoint_port, self.endpoint_port, logger)
+    self.address = Address('localhost', self.endpoint_port, "PYNETDICOM")
+
+    self.dataset = Dataset()
+    self.dataset.SOPClassUID = SecondaryCaptureImageStorage
+    self.dataset.PatientID = "1235971155"
+    self.dataset.StudyInstanceUID = gen_uid()
+    self.dataset.SeriesInstanceUID = gen_uid()
+    make_meta(self.dataset)
+
+  def tearDown(self) -> None:
+    self.endpoint.shutdown()
+
+  def test_association_is_reused(self):
+    pool = AssociationPool()
+    with self.assertLogs(logger, DEBUG) as log_records:
+      send_images(self.SCU_AE, self.address, [self.dataset], pool=pool)
+      self.assertEqual(len(pool), 1)
+      send_images(self.SCU_AE, self.address, [self.dataset], pool=pool)
+      self.assertEqual(len(pool), 1)
+    self.assertEqual(log_records.output.count("INFO:dicomnode:Received C Store"), 2)
+    self.assertIn("DEBUG:dicomnode:Reusing association to PYNETDICOM", log_records.output)
+    pool.close()
+    self.assertEqual(len(pool), 0)
+
+  def test_associations_are_keyed_by_scu(self):
+    pool = AssociationPool()
+    send_images(self.SCU_AE, self.address, [self.dataset], pool=pool)
+    send_images("OTHER_SCU", self.address, [self.dataset], pool=pool)
+    self.assertEqual(len(pool), 2)
+    pool.close()
+
+  def test_idle_associations_expire(self):
+    pool = AssociationPool(idle_timeout=0.0)
+    send_images(self.SCU_AE, self.address, [self.dataset], pool=pool)
+    sleep(0.01)
+    pool.prune()
+    self.assertEqual(len(pool), 0)
+
+  def test_unhealthy_association_is_not_reused(self):
+    pool = AssociationPool(verify_on_acquire=True)
+    association = pool.acquire(self.SCU_AE, self.address, [SecondaryCaptureImageStorage])
+    self.assertTrue(association.is_established)
+    pool.release(association)
+    association.abort()
+    new_association = pool.acquire(self.SCU_AE, self.address, [SecondaryCaptureImageStorage])
+    self.assertIsNot(association, new_association)
+    self.assertTrue(new_association.is_established)
+    pool.release(new_association)
+    self.assertEqual(len(pool), 1)
+    pool.close()
+
+  def test_max_idle_per_key(self):
+    pool = AssociationPool(max_idle_per_key=1)
+    association_1 = pool.acquire(self.SCU_AE, self.address, [SecondaryCaptureImageStorage])
+    association_2 = pool.acquire(self.SCU_AE, self.address, [SecondaryCaptureImageStorage])
+    pool.release(association_1)
+    pool.release(association_2)
+    self.assertEqual(len(pool), 1)
+    self.assertTrue(association_2.is_released)
+    pool.close()
+
+
+class ShardedSendTestCase(TestCase):
+  SCU_AE = "TEST_CASE"
+
+  def setUp(self) -> None:
+    self.received = []
+    def handle_store(event):
+      self.received.append((event.assoc.native_id, event.dataset.InstanceNumber))
+      return 0x0000
+
+    self.endpoint_port = randint(1025,65535)
+    self.endpoint = ApplicationEntity()
+    self.endpoint.supported_contexts = AllStoragePresentationContexts
+    self.endpoint.start_server(('127.0.0.1', self.endpoint_port),
+                               evt_handlers=[(evt.EVT_C_STORE, handle_store)],
+                               block=False)
+    self.address = Address('localhost', self.endpoint_port, "PYNETDICOM")
+
+    self.datasets = []
+    for instance_number in range(1, 11):
+      dataset = Dataset()
+      dataset.SOPClassUID = SecondaryCaptureImageStorage
+      dataset.PatientID = "1235971155"
+      dataset.InstanceNumber = instance_number
+      make_meta(dataset)
+      self.datasets.append(dataset)
+
+  def tearDown(self) -> None:
+    self.endpoint.shutdown()
+
+  def test_send_sharded(self):
+    self.assertEqual(send_images_sharded(self.SCU_AE, self.address, iter(self.datasets), shards=3), 0x0000)
+    self.assertEqual(sorted(instance for _, instance in self.received), list(range(1,11)))
+    shards = {}
+    for association_id, instance_number in self.received:
+      shards.setdefault(association_id, []).append(instance_number)
+    self.assertLessEqual(len(shards), 3)
+    for shard in shards.values():
+      self.assertEqual(shard, sorted(shard))
+
+  def test_send_sharded_streams_generators(self):
+    ahead = []
+    def datasets():
+      for produced, dataset in enumerate(self.datasets, 1):
+        ahead.append(produced - len(self.received))
+        yield dataset
+
+    send_images_sharded(self.SCU_AE, self.address, datasets(), shards=2, peek_size=2)
+    self.assertEqual(sorted(instance for _, instance in self.received), list(range(1,11)))
+    # At most the peeked datasets and one dataset per shard are held at once
+    self.assertLessEqual(max(ahead), 4)
+
+  def test_send_sharded_fewer_datasets_than_shards(self):
+    send_images_sharded(self.SCU_AE, self.address, self.datasets[:1], shards=3)
+    self.assertEqual(len(self.received), 1)
+
+  def test_send_sharded_lost_association(self):
+    aborted = []
+    def handle_store(event):
+      if event.dataset.InstanceNumber == 5 and not aborted:
+        aborted.append(event.assoc.native_id)
+        event.assoc.abort()
+        return 0xA700
+      self.received.append((event.assoc.native_id, event.dataset.InstanceNumber))
+      return 0x0000
+    self.endpoint.shutdown()
+    self.endpoint.start_server(('127.0.0.1', self.endpoint_port),
+                               evt_handlers=[(evt.EVT_C_STORE, handle_store)],
+                               block=False)
+    logging.getLogger("pynetdicom").setLevel(logging.CRITICAL + 1)
+
+    with self.assertLogs(logger, DEBUG) as log_records:
+      self.assertEqual(send_images_sharded(self.SCU_AE, self.address, iter(self.datasets), shards=3), 0x0000)
+    self.assertIn("WARNING:dicomnode:1 of 3 shards to PYNETDICOM lost their association", log_records.output)
+    # The dataset of the lost association is sent once by another shard
+    self.assertEqual(sorted(instance for _, instance in self.received), list(range(1,11)))
+
+  def test_send_sharded_invalid_shards(self):
+    self.assertRaises(ValueError, send_images_sharded, self.SCU_AE, self.address, self.datasets, 0)
+
+  def test_send_sharded_no_connection(self):
+    address = Address('localhost', 4321, "PYNETDICOM")
+    logging.getLogger("pynetdicom").setLevel(logging.CRITICAL + 1)
+    with self.assertLogs(logger, DEBUG) as log_records:
+      self.assertRaises(CouldNotCompleteDIMSEMessage, send_images_sharded, self.SCU_AE, address, self.datasets, 2)
+    self.assertIn("ERROR:dicomnode:2 of 2 shards to PYNETDICOM failed", log_records.output)
+
+  def test_send_images_generator(self):
+    datasets = (dataset for dataset in self.datasets)
+    self.assertEqual(send_images(self.SCU_AE, self.address, datasets), 0x0000)
+    self.assertEqual([instance for _, instance in self.received], list(range(1,11)))
+
+  def test_send_images_abort(self):
+    abort = Event()
+    def datasets():
+      for index, dataset in enumerate(self.datasets):
+        if index == 3:
+          abort.set()
+        yield dataset
+
+    with self.assertLogs(logger, DEBUG) as log_records:
+      self.assertRaises(CouldNotCompleteDIMSEMessage, send_images, self.SCU_AE,
+                        self.address, datasets(), peek_size=1, abort=abort)
+    self.assertEqual(len(self.received), 3)
+    self.assertIn(f"ERROR:dicomnode:Sending to {self.address.ae_title} was aborted", log_records.output)
+
+  def test_send_images_declared_sop_classes(self):
+    datasets = (dataset for dataset in self.datasets)
+    send_images(self.SCU_AE, self.address, datasets, sop_classes=[SecondaryCaptureImageStorage])
+    self.assertEqual(len(self.received), 10)
+
+  def test_send_images_renegotiates_new_sop_class(self):
+    self.datasets[-1].SOPClassUID = CTImageStorage
+    make_meta(self.datasets[-1])
+    with self.assertLogs(logger, DEBUG) as log_records:
+      send_images(self.SCU_AE, self.address, iter(self.datasets), peek_size=1)
+    self.assertIn(f"DEBUG:dicomnode:Renegotiating association to PYNETDICOM for {CTImageStorage}",
+                  log_records.output)
+    self.assertEqual([instance for _, instance in self.received], list(range(1,11)))
+    self.assertEqual(len(set(association_id for association_id, _ in self.received)), 2)
+
+  def test_send_images_empty(self):
+    self.assertEqual(send_images(self.SCU_AE, self.address, iter([])), 0x0000)
+    self.assertEqual(self.received, [])
+
+  def performance_send_images(self):
+    images = 200
+    datasets = list(generate_numpy_datasets(images, Cols=128, Rows=128, PatientID="send_images"))
+    benchmark("send_images", lambda: send_images(self.SCU_AE, self.address, datasets),
+              images, "images")
+
+  def performance_send_images_sharded(self):
+    images = 200
+    datasets = list(generate_numpy_datasets(images, Cols=128, Rows=128, PatientID="send_images"))
+    benchmark("send_images_sharded", lambda: send_images_sharded(self.SCU_AE, self.address, datasets, shards=4),
+              images, "images")
+
+
+class MoveCoordinatorTestCase(TestCase):
+  SCU_AE = "TEST_CASE"
+
+  def setUp(self) -> None:
+    self.endpoint_port = randint(1025,65535)
+    self.endpoint = get_test_ae(self.endpoint_port, self.endpoint_port, logger)
+    self.address = Address('localhost', self.endpoint_port, "PYNETDICOM")
+
+  def tearDown(self) -> None:
+    self.endpoint.shutdown()
+
+  def query(self, patient_id="1235971155"):
+    dataset = Dataset()
+    dataset.PatientID = patient_id
+    dataset.SOPClassUID = SecondaryCaptureImageStorage
+    return dataset
+
+  def test_coalesces_and_caches_moves(self):
+    coordinator = MoveCoordinator(window=0.2, ttl=60)
+    with self.assertLogs(logger, DEBUG) as log_records:
+      move_1 = coordinator.request(self.SCU_AE, self.address, self.query())
+      move_2 = coordinator.request(self.SCU_AE, self.address, self.query())
+      self.assertIs(move_1, move_2)
+      self.assertTrue(move_1.wait(10))
+      move_3 = coordinator.request(self.SCU_AE, self.address, self.query())
+      self.assertIs(move_1, move_3)
+    self.assertEqual(log_records.output.count("INFO:dicomnode:Received C Move"), 1)
+
+  def test_different_queries_are_not_coalesced(self):
+    coordinator = MoveCoordinator()
+    move_1 = coordinator.request(self.SCU_AE, self.address, self.query("1"))
+    move_2 = coordinator.request(self.SCU_AE, self.address, self.query("2"))
+    self.assertIsNot(move_1, move_2)
+    self.assertTrue(move_1.wait(10))
+    self.assertTrue(move_2.wait(10))
+    self.assertEqual(len(coordinator), 2)
+    coordinator.clear()
+    self.assertEqual(len(coordinator), 0)
+
+  def test_forgotten_moves_are_repeated(self):
+    coordinator = MoveCoordinator(ttl=60)
+    move_1 = coordinator.request(self.SCU_AE, self.address, self.query("1"))
+    move_2 = coordinator.request(self.SCU_AE, self.address, self.query("2"))
+    self.assertTrue(move_1.wait(10))
+    self.assertTrue(move_2.wait(10))
+    self.assertEqual(coordinator.forget(0x00100020, "1"), 1)
+    self.assertEqual(len(coordinator), 1)
+    move_3 = coordinator.request(self.SCU_AE, self.address, self.query("1"))
+    self.assertIsNot(move_1, move_3)
+    move_3.wait(10)
+
+  def test_expired_moves_are_repeated(self):
+    coordinator = MoveCoordinator(ttl=0.0)
+    move_1 = coordinator.request(self.SCU_AE, self.address, self.query())
+    self.assertTrue(move_1.wait(10))
+    move_2 = coordinator.request(self.SCU_AE, self.address, self.query())
+    self.assertIsNot(move_1, move_2)
+    move_2.wait(10)
+
+  def test_failed_moves_are_not_cached(self):
+    address = Address('localhost', 4321, "PYNETDICOM")
+    logging.getLogger("pynetdicom").setLevel(logging.CRITICAL + 1)
+    coordinator = MoveCoordinator()
+    with self.assertLogs(logger, DEBUG) as log_records:
+      move_1 = coordinator.request(self.SCU_AE, address, self.query())
+      self.assertFalse(move_1.wait(10))
+    self.assertIn("ERROR:dicomnode:Coordinated C-MOVE to PYNETDICOM failed: CouldNotCompleteDIMSEMessage",
+                  log_records.output)
+    with self.assertLogs(logger, DEBUG):
+      move_2 = coordinator.request(self.SCU_AE, address, self.query())
+      self.assertIsNot(move_1, move_2)
+      move_2.wait(10)
+
+
+class FindCacheTestCase(TestCase):
+  def test_expiry(self):
+    cache = FindCache(ttl=0.0)
+    cache.put(("key",), [Dataset()]) # type: ignore
+    self.assertIsNone(cache.get(("key",))) # type: ignore
+    self.assertEqual(len(cache), 0)
+
+  def test_evicts_least_recently_used(self):
+    cache = FindCache(max_entries=2)
+    cache.put(("1",), []) # type: ignore
+    cache.put(("2",), []) # type: ignore
+    cache.get(("1",)) # type: ignore
+    cache.put(("3",), []) # type: ignore
+    self.assertIsNotNone(cache.get(("1",))) # type: ignore
+    self.assertIsNone(cache.get(("2",))) # type: ignore
+    cache.clear()
+    self.assertEqual(len(cache), 0)
@@ -1,3 +1,6 @@
+from pathlib import Path
+import shutil
+from tempfile import mkdtemp
 from unittest import TestCase, skipIf
 
 from pydicom import Dataset
@@ -6,12 +9,15 @@ from pydicom.uid import SecondaryCaptureImageStorage
 from dicomnode.lib.exceptions import InvalidDataset
 from dicomnode.lib.image_tree import DicomTree
 from dicomnode.lib.dicom import gen_uid, make_meta
-from dicomnode.server.grinders import IdentityGrinder, ListGrinder, DicomTreeGrinder, ManyGrinder, NumpyGrinder, TagGrinder
+from dicomnode.lib.io import save_dicom
+from dicomnode.lib.lazy_dataset import LazyDataset
+from dicomnode.lib import lazy_dataset
+from dicomnode.server.grinders import IdentityGrinder, ListGrinder, DicomTreeGrinder, ManyGrinder, NumpyGrinder, SlabGrinder, TagGrinder
 
 import numpy
 import logging
 
-from tests.helpers import generate_numpy_datasets
+from tests.helpers import benchmark, generate_numpy_datasets
 
 def get_test_dataset() -> Dataset:
   dataset = Dataset()
@@ -328,3 +334,66 @@ class GrinderTests(TestCase):
     grinder = TagGrinder([0x00100020, 0x00101020,0x00101030], optional=False)
 
     self.assertRaises(InvalidDataset, grinder, [dataset])
+
+  def test_slab_grinder(self):
+    datasets = list(generate_numpy_datasets(5, Rows=4, Cols=3, rescale=True))
+    for i, dataset in enumerate(datasets):
+      dataset.ImagePositionPatient = [0, 0, float(i)]
+      dataset.PixelSpacing = [2.0, 2.0]
+    datasets.reverse() # The slabs are sorted by InstanceNumber
+
+    slabs = list(SlabGrinder(2)(datasets))
+    self.assertEqual([slab.image.shape[0] for slab in slabs], [2, 2, 1])
+    self.assertEqual([slab.start for slab in slabs], [0, 2, 4])
+    self.assertEqual(slabs[0].total, 5)
+    self.assertEqual(slabs[1].image_positions, [[0., 0., 2.], [0., 0., 3.]])
+    self.assertEqual(slabs[0].pixel_spacing, [2., 2.])
+    self.assertIsNone(slabs[0].image_orientation)
+
+    volume = numpy.concatenate([slab.image for slab in slabs])
+    self.assertTrue((volume == NumpyGrinder()(datasets)).all())
+
+  def test_slab_grinder_keeps_lazy_datasets_unloaded(self):
+    directory = Path(mkdtemp())
+    self.addCleanup(shutil.rmtree, directory)
+    datasets = list(generate_numpy_datasets(3, Rows=4, Cols=3, rescale=False))
+    lazy_datasets = []
+    for i, dataset in enumerate(datasets):
+      save_dicom(directory / f"image_{i}.dcm", dataset)
+      lazy_datasets.append(LazyDataset(directory / f"image_{i}.dcm"))
+
+    volume = numpy.concatenate([slab.image for slab in SlabGrinder(2)(lazy_datasets)])
+    self.assertTrue((volume == NumpyGrinder()(datasets)).all())
+    for lazy_dataset in lazy_datasets:
+      self.assertFalse(lazy_dataset._is_init)
+
+  def test_slab_grinder_sorts_by_headers(self):
+    directory = Path(mkdtemp())
+    self.addCleanup(shutil.rmtree, directory)
+    lazy_datasets = []
+    for i, dataset in enumerate(generate_numpy_datasets(3, Rows=4, Cols=3, rescale=False)):
+      save_dicom(directory / f"image_{i}.dcm", dataset)
+      lazy_datasets.append(LazyDataset(directory / f"image_{i}.dcm"))
+    lazy_datasets.reverse()
+
+    loaded = []
+    load_dicom = lazy_dataset.load_dicom
+    def counting_load_dicom(path):
+      loaded.append(path)
+      return load_dicom(path)
+    lazy_dataset.load_dicom = counting_load_dicom
+    self.addCleanup(setattr, lazy_dataset, 'load_dicom', load_dicom)
+
+    slabs = SlabGrinder(2)(lazy_datasets)
+    self.assertEqual(loaded, [directory / "image_0.dcm"]) # Only the pivot is read with pixels
+    self.assertEqual(len(list(slabs)), 2)
+
+  def test_slab_grinder_invalid(self):
+    self.assertRaises(ValueError, SlabGrinder, 0)
+    self.assertRaises(InvalidDataset, SlabGrinder(), [])
+
+  def performance_numpy_grinder(self):
+    images = 100
+    datasets = list(generate_numpy_datasets(images, Cols=256, Rows=256))
+    grinder = NumpyGrinder()
+    benchmark("numpy_grinder", lambda: grinder(datasets), images, "images")
@@ -1,15 +1,18 @@
 
+from copy import deepcopy
 from pathlib import Path
 import shutil
 
 from pydicom import Dataset
 from pydicom.uid import UID, MediaStorageDirectoryStorage, SecondaryCaptureImageStorage
+from typing import List
 from unittest import TestCase, skip
 
-from tests.helpers import generate_numpy_datasets, bench
+from tests.helpers import benchmark, generate_numpy_datasets, bench
 
-from dicomnode.lib.dicom import gen_uid
+from dicomnode.lib.dicom import gen_uid, UIDGenerator
 from dicomnode.lib.io import load_dicom
+from dicomnode.lib.anonymization import anonymize_dicom_tree
 from dicomnode.lib.image_tree import DicomTree, SeriesTree, StudyTree, PatientTree, IdentityMapping, ImageTreeInterface
 
 def get_test_dataset() -> Dataset:
@@ -337,6 +340,15 @@ class lib_imageTree(TestCase):
     self.assertEqual(len(im.PatientMapping), 0)
     self.assertEqual(im.prefix_size, 4)
 
+  def test_IdentityMapping_deterministic_uid_generator(self):
+    im_1 = IdentityMapping(uid_generator=UIDGenerator(root=1))
+    im_2 = IdentityMapping(uid_generator=UIDGenerator(root=1))
+    dt = DicomTree(self.datasets)
+    im_1.fill_from_DicomTree(dt)
+    im_2.fill_from_DicomTree(dt)
+    self.assertEqual(im_1.SOP_UIDMapping, im_2.SOP_UIDMapping)
+    self.assertEqual(im_1.SeriesUIDMapping, im_2.SeriesUIDMapping)
+
   def test_create_IM_with_DT(self):
     im = IdentityMapping()
     dt = DicomTree(self.datasets)
@@ -457,4 +469,33 @@ class lib_imageTree(TestCase):
 
     self.assertEqual(DT.images,studies)
     for ds in DT:
-      self.assertIn(ds.SOPInstanceUID.name, datasets)
\ No newline at end of file
+      self.assertIn(ds.SOPInstanceUID.name, datasets)
+
+  def performance_discover(self):
+    images = 200
+    path = Path("performance_discover")
+    if path.exists():
+      shutil.rmtree(path)
+    DicomTree(list(generate_numpy_datasets(images, Cols=128, Rows=128, PatientID="discover"))).save_tree(path)
+
+    benchmark("dicom_tree_discover", lambda: DicomTree().discover(path), images, "images")
+    shutil.rmtree(path)
+
+  def performance_anonymize(self):
+    images = 200
+    datasets = list(generate_numpy_datasets(images, Cols=128, Rows=128, PatientID="anonymize"))
+    trees: List[DicomTree] = []
+    mappings: List[IdentityMapping] = []
+    def setup():
+      trees.clear()
+      mappings.clear()
+      tree = DicomTree(deepcopy(datasets))
+      mapping = IdentityMapping()
+      mapping.fill_from_DicomTree(tree)
+      trees.append(tree)
+      mappings.append(mapping)
+
+    def anonymize():
+      trees[0].map(anonymize_dicom_tree(mappings[0]), mappings[0])
+
+    benchmark("dicom_tree_anonymize", anonymize, images, "images", setup=setup)
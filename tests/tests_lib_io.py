@@ -1,5 +1,9 @@
 
 from asyncore import write
+import os
+from pathlib import Path
+import shutil
+from tempfile import mkdtemp
 from unittest import TestCase
 from pydicom import Dataset, DataElement, Sequence
 from dicomnode.lib import io
@@ -71,3 +75,39 @@ class lib_io_test_case(TestCase):
     ds.Modality = DataElement(0x00080060, 'CS', 'OT')
     io.apply_private_tags(ds, self.test_private_tag_dict)
     self.assertEqual(ds.Modality, DataElement(0x00080060, 'CS', 'OT'))
+
+class JobDirectoryTestCase(TestCase):
+  def setUp(self) -> None:
+    self.base = Path(mkdtemp())
+
+  def tearDown(self) -> None:
+    shutil.rmtree(self.base, ignore_errors=True)
+
+  def test_job_directory_is_removed(self):
+    cwd = os.getcwd()
+    with io.JobDirectory(self.base, "1502799995") as job_directory:
+      self.assertEqual(job_directory.path, self.base / "1502799995")
+      self.assertTrue(job_directory.path.is_dir())
+      self.assertEqual(os.getcwd(), cwd)
+    self.assertFalse(job_directory.path.exists())
+    self.assertIsNone(job_directory.retained_path)
+
+  def test_failed_job_directory_is_retained(self):
+    with io.JobDirectory(self.base, "1502799995", retain_on_failure=True) as job_directory:
+      (job_directory.path / "log.txt").write_text("failed")
+      job_directory.mark_failed()
+    self.assertFalse(job_directory.path.exists())
+    if job_directory.retained_path is None:
+      raise AssertionError
+    self.assertTrue(job_directory.retained_path.name.startswith("1502799995_failed_"))
+    self.assertEqual((job_directory.retained_path / "log.txt").read_text(), "failed")
+
+  def test_raising_job_directory(self):
+    with self.assertRaises(ValueError):
+      with io.JobDirectory(self.base, "retained", retain_on_failure=True) as retained:
+        raise ValueError
+    with self.assertRaises(ValueError):
+      with io.JobDirectory(self.base, "removed") as removed:
+        raise ValueError
+    self.assertIsNotNone(retained.retained_path)
+    self.assertEqual([path.name for path in self.base.iterdir()], [retained.retained_path.name]) # type: ignore
@@ -0,0 +1,102 @@
+"""Tests for dicomnode.lib.metrics"""
+
+__author__ = "Christoffer Vilstrup Jensen"
+
+# Python Standard Library
+import pickle
+from unittest import TestCase
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+# Dicomnode packages
+from dicomnode.lib.metrics import InMemoryMetrics, MetricsServer, NullSink, get_metrics, set_metrics
+
+class InMemoryMetricsTestCase(TestCase):
+  def setUp(self) -> None:
+    self.metrics = InMemoryMetrics(buckets=(0.1, 1.0))
+
+  def test_counters_and_gauges(self):
+    self.metrics.increment("images_total")
+    self.metrics.increment("images_total", 2)
+    self.metrics.set_gauge("queue_depth", 4)
+    self.metrics.set_gauge("queue_depth", 3)
+    self.assertEqual(self.metrics.counter("images_total"), 3.0)
+    self.assertEqual(self.metrics.gauge("queue_depth"), 3)
+    self.assertEqual(self.metrics.counter("unknown_total"), 0.0)
+    self.assertIsNone(self.metrics.gauge("unknown"))
+
+  def test_time(self):
+    with self.metrics.time("stage_seconds", {"stage" : "process"}):
+      pass
+    try:
+      with self.metrics.time("stage_seconds", {"stage" : "process"}):
+        raise ValueError
+    except ValueError:
+      pass
+    count, total = self.metrics.histogram("stage_seconds", {"stage" : "process"})
+    self.assertEqual(count, 2)
+    self.assertGreaterEqual(total, 0.0)
+    self.assertEqual(self.metrics.histogram("stage_seconds", {"stage" : "dispatch"}), (0, 0.0))
+
+  def test_render(self):
+    self.metrics.increment("images_total", labels={"ae" : 'A"B'})
+    self.metrics.observe("stage_seconds", 0.05, {"stage" : "process"})
+    self.metrics.observe("stage_seconds", 0.5, {"stage" : "process"})
+    self.metrics.observe("stage_seconds", 5.0, {"stage" : "process"})
+    lines = self.metrics.render().splitlines()
+    self.assertIn("# TYPE images_total counter", lines)
+    self.assertIn('images_total{ae="A\\"B"} 1.0', lines)
+    self.assertIn("# TYPE stage_seconds histogram", lines)
+    self.assertIn('stage_seconds_bucket{stage="process",le="0.1"} 1', lines)
+    self.assertIn('stage_seconds_bucket{stage="process",le="1.0"} 2', lines)
+    self.assertIn('stage_seconds_bucket{stage="process",le="+Inf"} 3', lines)
+    self.assertIn('stage_seconds_sum{stage="process"} 5.55', lines)
+    self.assertIn('stage_seconds_count{stage="process"} 3', lines)
+
+  def test_snapshot_and_merge(self):
+    self.metrics.increment("images_total", 2, {"shard" : "0"})
+    self.metrics.set_gauge("tree_images", 4)
+    self.metrics.observe("stage_seconds", 0.05)
+    other = InMemoryMetrics(buckets=(0.1, 1.0))
+    other.increment("images_total", 3, {"shard" : "0"})
+    other.set_gauge("tree_images", 1)
+    other.observe("stage_seconds", 0.5)
+
+    self.metrics.merge(pickle.loads(pickle.dumps(other.snapshot())))
+    self.assertEqual(self.metrics.counter("images_total", {"shard" : "0"}), 5.0)
+    self.assertEqual(self.metrics.gauge("tree_images"), 5)
+    self.assertEqual(self.metrics.histogram("stage_seconds"), (2, 0.55))
+    self.assertIn('stage_seconds_bucket{le="0.1"} 1', self.metrics.render())
+    self.assertIn('stage_seconds_bucket{le="1.0"} 2', self.metrics.render())
+    self.assertRaises(ValueError, self.metrics.merge, InMemoryMetrics(buckets=(1.0,)).snapshot())
+
+  def test_global_sink(self):
+    self.assertIsInstance(get_metrics(), NullSink)
+    old_sink = set_metrics(self.metrics)
+    try:
+      self.assertIs(get_metrics(), self.metrics)
+    finally:
+      set_metrics(old_sink)
+    self.assertIs(get_metrics(), old_sink)
+
+  def test_null_sink(self):
+    sink = NullSink()
+    with sink.time("stage_seconds"):
+      sink.increment("images_total")
+      sink.set_gauge("queue_depth", 1)
+
+
+class MetricsServerTestCase(TestCase):
+  def test_serves_metrics(self):
+    metrics = InMemoryMetrics()
+    metrics.increment("dicomnode_images_received_total")
+    server = MetricsServer(metrics)
+    server.start()
+    try:
+      with urlopen(f"http://localhost:{server.port}/metrics") as response:
+        body = response.read().decode()
+        self.assertEqual(response.status, 200)
+      self.assertIn("dicomnode_images_received_total 1.0", body)
+      self.assertRaises(HTTPError, urlopen, f"http://localhost:{server.port}/other")
+    finally:
+      server.stop()
@@ -9,6 +9,8 @@ from dicomnode.lib.dicom_factory import SOP_common_blueprint, FillingStrategy, i
 from dicomnode.lib.numpy_factory import image_pixel_blueprint, NumpyFactory
 from dicomnode.lib.exceptions import InvalidDataset
 
+from tests.helpers import benchmark
+
 
 class NumpyFactoryTestCase(TestCase):
   def setUp(self) -> None:
@@ -179,3 +181,23 @@ class NumpyFactoryTestCase(TestCase):
       self.assertEqual(ds.SOPClassUID, SecondaryCaptureImageStorage)
       self.assertIn(0x00080018, ds)
       self.assertEqual(ds.InstanceNumber, i + 1)
+
+  def test_build_from_slabs(self):
+    image = numpy.random.uniform(-10, 10, size=(5, 4, 3))
+    datasets = self.factory.build_from_slabs(self.header, (image[i:i+2] for i in range(0, 5, 2)), 5)
+    self.assertNotIsInstance(datasets, list)
+
+    expected_datasets = self.factory.build_from_header(self.header, image)
+    datasets = list(datasets)
+    self.assertEqual(len(datasets), 5)
+    for dataset, expected_dataset in zip(datasets, expected_datasets):
+      self.assertEqual(dataset.InstanceNumber, expected_dataset.InstanceNumber)
+      self.assertEqual(dataset.ImagesInAcquisition, 5)
+      self.assertEqual(dataset.RescaleSlope, expected_dataset.RescaleSlope)
+      self.assertEqual(dataset.PixelData, expected_dataset.PixelData)
+
+  def performance_build_from_header(self):
+    images = 100
+    image = numpy.random.randint(0, 65536, size=(images, 256, 256), dtype=numpy.uint16)
+    benchmark("numpy_factory_build_from_header",
+              lambda: self.factory.build_from_header(self.header, image), images, "images")
@@ -0,0 +1,61 @@
+__author__ = "Christoffer Vilstrup Jensen"
+
+# Python Standard Library
+from multiprocessing import get_context
+import pickle
+from unittest import TestCase
+
+# Third party Packages
+import numpy
+
+# Dicomnode packages
+from dicomnode.lib.shared_memory import SharedArray
+
+def _double_in_place(shared: SharedArray) -> float:
+  array = shared.attach()
+  array *= 2
+  total = float(array.sum())
+  shared.release()
+  return total
+
+
+class SharedArrayTestCase(TestCase):
+  def setUp(self) -> None:
+    self.array = numpy.arange(4096, dtype=numpy.float32).reshape(16,16,16)
+    self.shared = SharedArray.from_array(self.array)
+    self.addCleanup(self._release)
+
+  def _release(self):
+    if self.shared._shared_memory is not None:
+      self.shared.release()
+
+  def test_from_array(self):
+    attached = self.shared.attach()
+    self.assertEqual(attached.shape, (16,16,16))
+    self.assertEqual(attached.dtype, numpy.float32)
+    self.assertTrue((attached == self.array).all())
+    self.assertEqual(self.shared.nbytes, self.array.nbytes)
+
+  def test_pickle_sends_the_name(self):
+    pickled = pickle.dumps(self.shared)
+    self.assertLess(len(pickled), self.array.nbytes)
+    unpickled: SharedArray = pickle.loads(pickled)
+    self.assertEqual(unpickled.name, self.shared.name)
+    unpickled.attach()[0,0,0] = 100
+    self.assertEqual(self.shared.attach()[0,0,0], 100)
+
+  def test_other_process_shares_the_memory(self):
+    with get_context("spawn").Pool(1) as pool:
+      total = pool.apply(_double_in_place, (self.shared,))
+    self.assertEqual(total, 2 * float(self.array.sum()))
+    self.assertTrue((self.shared.attach() == 2 * self.array).all())
+    self.assertIsNotNone(self.shared._shared_memory) # Released by a non-owner
+
+  def test_reference_counting(self):
+    name = self.shared.name
+    self.shared.acquire()
+    self.shared.release()
+    SharedArray(name, (16,16,16), "<f4", 0).attach() # Still alive
+    self.shared.release()
+    with self.assertRaises(FileNotFoundError):
+      SharedArray(name, (16,16,16), "<f4", 0).attach()
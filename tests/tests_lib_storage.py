@@ -0,0 +1,135 @@
+__author__ = "Christoffer Vilstrup Jensen"
+
+# Python Standard Library
+from pathlib import Path
+import shutil
+from tempfile import mkdtemp
+from unittest import TestCase
+
+# Third party Packages
+from pydicom import Dataset
+from pydicom.uid import SecondaryCaptureImageStorage
+
+# Dicomnode packages
+from dicomnode.lib.dicom import gen_uid, make_meta
+from dicomnode.lib.lazy_dataset import LazyDataset
+from dicomnode.lib.storage import DatasetStore, FileStore, MemoryStore, SegmentStore
+
+def get_dataset(patient_id: str = "1502799995") -> Dataset:
+  dataset = Dataset()
+  dataset.PatientID = patient_id
+  dataset.SOPClassUID = SecondaryCaptureImageStorage
+  dataset.SOPInstanceUID = gen_uid()
+  make_meta(dataset)
+  return dataset
+
+
+class MemoryStoreTestCase(TestCase):
+  """The tests of this case are inherited by the cases of the other stores"""
+  def get_store(self) -> DatasetStore:
+    return MemoryStore()
+
+  def setUp(self) -> None:
+    self.directory = Path(mkdtemp())
+    self.store = self.get_store()
+
+  def tearDown(self) -> None:
+    shutil.rmtree(self.directory, ignore_errors=True)
+
+  def test_put_get(self):
+    dataset = get_dataset()
+    self.store.put("input/image_1.dcm", dataset)
+    self.assertIn("input/image_1.dcm", self.store)
+    self.assertEqual(self.store.get("input/image_1.dcm").SOPInstanceUID, dataset.SOPInstanceUID)
+    with self.assertRaises(KeyError):
+      self.store.get("input/image_2.dcm")
+
+  def test_put_keeps_first_dataset(self):
+    dataset = get_dataset()
+    self.store.put("image.dcm", dataset)
+    self.store.put("image.dcm", get_dataset())
+    self.assertEqual(self.store.get("image.dcm").SOPInstanceUID, dataset.SOPInstanceUID)
+
+  def test_keys_and_scope(self):
+    self.store.put("arg_1/image_1.dcm", get_dataset())
+    self.store.put("arg_1/series/image_2.dcm", get_dataset())
+    self.store.put("arg_2/image_1.dcm", get_dataset())
+    self.assertEqual(self.store.keys("arg_1"), ["image_1.dcm", "series/image_2.dcm"])
+
+    scoped = self.store.scope("arg_1")
+    self.assertEqual(scoped.keys(), ["image_1.dcm", "series/image_2.dcm"])
+    self.assertEqual(scoped.scope("series").keys(), ["image_2.dcm"])
+    scoped.put("image_3.dcm", get_dataset())
+    self.assertIn("arg_1/image_3.dcm", self.store)
+
+    scoped.clear()
+    self.assertEqual(scoped.keys(), [])
+    self.assertEqual(self.store.keys(), ["arg_2/image_1.dcm"])
+
+  def test_remove_and_clear(self):
+    self.store.put("image_1.dcm", get_dataset())
+    self.store.put("image_2.dcm", get_dataset())
+    self.store.remove("image_1.dcm")
+    self.store.remove("image_1.dcm")
+    self.assertNotIn("image_1.dcm", self.store)
+    self.assertEqual(self.store.keys(), ["image_2.dcm"])
+    self.store.clear()
+    self.assertEqual(self.store.keys(), [])
+
+  def test_lazy(self):
+    dataset = get_dataset()
+    self.store.scope("input").put("image.dcm", dataset)
+    lazy = self.store.scope("input").lazy("image.dcm")
+    self.assertIsInstance(lazy, LazyDataset)
+    self.assertEqual(lazy.SOPInstanceUID, dataset.SOPInstanceUID)
+
+  def test_persistent(self):
+    self.assertFalse(self.store.persistent)
+    self.assertFalse(self.store.scope("arg_1").persistent)
+
+
+class FileStoreTestCase(MemoryStoreTestCase):
+  def get_store(self) -> DatasetStore:
+    return FileStore(self.directory)
+
+  def test_persistent(self):
+    self.assertTrue(self.store.persistent)
+
+  def test_file_layout(self):
+    self.store.scope("arg_1").put("image.dcm", get_dataset())
+    self.assertTrue((self.directory / "arg_1" / "image.dcm").is_file())
+    self.assertEqual(self.store.scope("arg_1").directory, self.directory / "arg_1")
+
+
+class SegmentStoreTestCase(MemoryStoreTestCase):
+  def get_store(self) -> DatasetStore:
+    return SegmentStore(self.directory)
+
+  def test_persistent(self):
+    self.assertTrue(self.store.persistent)
+    self.assertTrue(self.store.scope("arg_1").persistent)
+
+  def test_index_is_rebuilt(self):
+    dataset = get_dataset()
+    self.store.put("arg_1/image_1.dcm", dataset)
+    self.store.put("arg_1/image_2.dcm", get_dataset())
+    self.store.remove("arg_1/image_2.dcm")
+    self.assertEqual(list(self.directory.iterdir()), [self.directory / SegmentStore.segment_name])
+
+    reopened = SegmentStore(self.directory)
+    self.assertEqual(reopened.keys(), ["arg_1/image_1.dcm"])
+    self.assertEqual(reopened.get("arg_1/image_1.dcm").SOPInstanceUID, dataset.SOPInstanceUID)
+
+  def test_partial_record_is_truncated(self):
+    self.store.put("image_1.dcm", get_dataset())
+    segment_path = self.directory / SegmentStore.segment_name
+    size = segment_path.stat().st_size
+    with open(segment_path, 'ab') as segment:
+      segment.write(b"\x00\x0b\x00partial")
+
+    with self.assertLogs("dicomnode"):
+      reopened = SegmentStore(self.directory)
+    self.assertEqual(reopened.keys(), ["image_1.dcm"])
+    self.assertEqual(segment_path.stat().st_size, size)
+    reopened.put("image_2.dcm", get_dataset())
+    self.assertEqual(SegmentStore(self.directory).keys(), ["image_1.dcm", "image_2.dcm"])
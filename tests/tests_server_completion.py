@@ -0,0 +1,74 @@
+"""Tests for the debouncing of processing"""
+
+__author__ = "Christoffer Vilstrup Jensen"
+
+# Python Standard Library
+from time import sleep
+from typing import List, Tuple
+from unittest import TestCase
+
+# Third party packages
+
+# Dicomnode packages
+from dicomnode.server.assocation_container import AssociationTypes, ReleasedContainer
+from dicomnode.server.completion import CompletionScheduler
+
+def released_container(assocation_id: int) -> ReleasedContainer:
+  return ReleasedContainer(assocation_id, {AssociationTypes.StoreAssociation}, "SENDER", None)
+
+class CompletionSchedulerTestCase(TestCase):
+  def setUp(self) -> None:
+    self.completed: List[Tuple[str, int]] = []
+    self.scheduler = CompletionScheduler(5.0, self.complete)
+
+  def complete(self, patient_id: str, released_container: ReleasedContainer) -> None:
+    self.completed.append((patient_id, released_container.assocation_id))
+
+  def test_waits_for_quiet_period(self):
+    self.scheduler.schedule("1502799995", released_container(1), now=100.0)
+    self.assertEqual(self.scheduler.next_due(), 105.0)
+    self.assertEqual(self.scheduler.run_due(104.9), 0)
+    self.assertEqual(self.scheduler.run_due(105.0), 1)
+    self.assertEqual(self.completed, [("1502799995", 1)])
+    self.assertEqual(len(self.scheduler), 0)
+    self.assertIsNone(self.scheduler.next_due())
+
+  def test_releases_are_coalesced(self):
+    self.scheduler.schedule("1502799995", released_container(1), now=100.0)
+    self.scheduler.schedule("1502799995", released_container(2), now=103.0)
+    self.scheduler.schedule("1210131111", released_container(2), now=103.0)
+    self.assertEqual(len(self.scheduler), 2)
+    self.assertEqual(self.scheduler.run_due(105.0), 0)
+    self.assertEqual(self.scheduler.run_due(108.0), 2)
+    self.assertEqual(sorted(self.completed), [("1210131111", 2), ("1502799995", 2)])
+
+  def test_arrivals_cancel(self):
+    self.scheduler.schedule("1502799995", released_container(1), now=100.0)
+    self.assertIn("1502799995", self.scheduler)
+    self.assertTrue(self.scheduler.cancel("1502799995"))
+    self.assertFalse(self.scheduler.cancel("1502799995"))
+    self.assertEqual(self.scheduler.run_due(200.0), 0)
+    self.assertEqual(self.completed, [])
+
+  def test_failing_processing_is_logged(self):
+    def fail(patient_id: str, released_container: ReleasedContainer):
+      raise ValueError
+    scheduler = CompletionScheduler(0.0, fail)
+    scheduler.schedule("1502799995", released_container(1), now=100.0)
+    with self.assertLogs("dicomnode") as cm:
+      self.assertEqual(scheduler.run_due(100.0), 1)
+    self.assertEqual(len(scheduler), 0)
+
+  def test_background_thread(self):
+    scheduler = CompletionScheduler(0.05, self.complete)
+    scheduler.start()
+    try:
+      scheduler.schedule("1502799995", released_container(1))
+      self.assertEqual(self.completed, [])
+      for _ in range(100):
+        if self.completed:
+          break
+        sleep(0.01)
+      self.assertEqual(self.completed, [("1502799995", 1)])
+    finally:
+      scheduler.stop()
@@ -3,6 +3,7 @@
 __author__ = "Christoffer Vilstrup Jensen"
 
 # Python Standard Library
+from concurrent.futures import ThreadPoolExecutor
 import logging
 from logging import StreamHandler
 import os
@@ -10,6 +11,8 @@ from pathlib import Path
 from typing import List, Dict, Any, Callable, Iterator
 import shutil
 from sys import stdout
+from random import randint
+from threading import Event, current_thread
 from unittest import TestCase
 
 
@@ -18,14 +21,17 @@ from unittest import TestCase
 import numpy
 from pydicom import Dataset
 from pydicom.uid import UID, SecondaryCaptureImageStorage
+from pynetdicom import evt
+from pynetdicom.ae import ApplicationEntity
+from pynetdicom.sop_class import PatientRootQueryRetrieveInformationModelMove, StudyRootQueryRetrieveInformationModelFind # type: ignore
 
 
 # Dicomnode packages
 from tests.helpers import generate_numpy_datasets, TESTING_TEMPORARY_DIRECTORY
 
-from dicomnode.lib.dimse import Address
+from dicomnode.lib.dimse import Address, MoveCoordinator
 from dicomnode.lib.dicom import gen_uid, make_meta
-from dicomnode.lib.dicom_factory import Blueprint
+from dicomnode.lib.dicom_factory import Blueprint, CopyElement
 from dicomnode.lib.numpy_factory import NumpyFactory
 from dicomnode.server.grinders import NumpyGrinder
 from dicomnode.lib.io import load_dicom, save_dicom
@@ -146,7 +152,51 @@ class InputTestCase(TestCase):
     dataset.Modality = 'CT'
     self.assertEqual(self.test_input.get_path(dataset).name, f'CT_image_{SOPInstanceUID.name}.dcm') # type: ignore
     dataset.InstanceNumber = 431
-    self.assertEqual(self.test_input.get_path(dataset).name, f'CT_image_431.dcm') # type: ignore
+    self.assertEqual(self.test_input.get_path(dataset).name, f'CT_image_431_{SOPInstanceUID.name}.dcm') # type: ignore
+
+  def test_instance_numbers_of_different_series(self):
+    for _ in range(2):
+      dataset = Dataset()
+      dataset.SOPInstanceUID = gen_uid()
+      dataset.SeriesInstanceUID = gen_uid()
+      dataset.SeriesDescription = SERIES_DESCRIPTION
+      dataset.SOPClassUID = SecondaryCaptureImageStorage
+      dataset.InstanceNumber = 1
+      make_meta(dataset)
+      self.test_input.add_image(dataset)
+    self.assertEqual(len(list(self.path.iterdir())), 2)
+    reloaded_input = TestInput(None, self.options)
+    self.assertEqual(reloaded_input.images, 2)
+
+  def test_files_of_earlier_versions_are_renamed(self):
+    dataset = Dataset()
+    dataset.SOPInstanceUID = gen_uid()
+    dataset.SeriesDescription = SERIES_DESCRIPTION
+    dataset.SOPClassUID = SecondaryCaptureImageStorage
+    dataset.Modality = 'CT'
+    dataset.InstanceNumber = 3
+    make_meta(dataset)
+    save_dicom(self.path / "CT_image_3.dcm", dataset)
+
+    reloaded_input = TestInput(None, self.options)
+    self.assertEqual(reloaded_input.images, 1)
+    self.assertEqual([path.name for path in self.path.iterdir()],
+                     [f"CT_image_3_{dataset.SOPInstanceUID.name}.dcm"])
+
+  def test_resent_image_replaces_file_of_earlier_version(self):
+    dataset = Dataset()
+    dataset.SOPInstanceUID = gen_uid()
+    dataset.SeriesDescription = SERIES_DESCRIPTION
+    dataset.SOPClassUID = SecondaryCaptureImageStorage
+    dataset.InstanceNumber = 3
+    make_meta(dataset)
+    self.test_input.add_image(dataset)
+    # As if it was stored by an earlier version
+    self.test_input.get_path(dataset).rename(self.path / "image_3.dcm")
+
+    self.test_input.add_image(dataset)
+    self.assertEqual([path.name for path in self.path.iterdir()],
+                     [f"image_3_{dataset.SOPInstanceUID.name}.dcm"])
 
   def test_cleanup(self):
     dataset = Dataset()
@@ -253,6 +303,57 @@ class InputTestCase(TestCase):
       self.assertRaises(IncorrectlyConfigured, HistoricInput, Dataset(), HistoricInput.Options(factory=NumpyFactory()))
     self.assertIn("CRITICAL:dicomnode:Historic Inputs needs a AE Title of the SCU", cm.output)
 
+  def test_historic_inputs_share_move_coordinator(self):
+    coordinator = MoveCoordinator()
+    options = HistoricInput.Options(factory=NumpyFactory(), ae_title="TEST", move_coordinator=coordinator)
+    HistoricInput(Dataset(), options)
+    HistoricInput(Dataset(), options)
+    self.assertEqual(len(coordinator), 1)
+
+  def test_is_ready_validates_only_after_images_are_added(self):
+    validations = []
+    class CountingInput(TestInput):
+      def validate(self) -> bool:
+        validations.append(self.images)
+        return self.images >= 2
+
+    counting_input = CountingInput()
+    self.assertFalse(counting_input.is_ready())
+    self.assertFalse(counting_input.is_ready())
+    self.assertEqual(validations, [0])
+    for _ in range(2):
+      dataset = Dataset()
+      dataset.SOPInstanceUID = gen_uid()
+      dataset.SeriesDescription = SERIES_DESCRIPTION
+      counting_input.add_image(dataset)
+    self.assertTrue(counting_input.is_ready())
+    self.assertTrue(counting_input.is_ready())
+    self.assertEqual(validations, [0, 2])
+
+  def test_dynamic_on_image_added(self):
+    added = []
+    class IncrementalDynamicInput(TestDynamicInput):
+      def __init__(self, *args, **kwargs):
+        self.series = set()
+        super().__init__(*args, **kwargs)
+
+      def on_image_added(self, dicom: Dataset) -> None:
+        added.append(dicom)
+        self.series.add(dicom.SeriesInstanceUID)
+
+      def is_ready(self) -> bool:
+        return len(self.series) >= 2
+
+    dynamic_input = IncrementalDynamicInput()
+    datasets = list(generate_numpy_datasets(2, SeriesUID=gen_uid(), Cols=10, Rows=10, PatientID="2002112161"))
+    datasets += list(generate_numpy_datasets(1, SeriesUID=gen_uid(), Cols=10, Rows=10, PatientID="2002112161"))
+    dynamic_input.add_image(datasets[0])
+    dynamic_input.add_image(datasets[1])
+    self.assertFalse(dynamic_input.is_ready())
+    dynamic_input.add_image(datasets[2])
+    self.assertTrue(dynamic_input.is_ready())
+    self.assertEqual(added, datasets)
+
   def test_dynamic_output(self):
     patient_ID = "2002112161"
     studyUID = gen_uid()
@@ -399,3 +500,73 @@ class InputTestCase(TestCase):
 
     self.assertRaises(IncorrectlyConfigured, dynamic_leaf.get_path, dataset)  #type: ignore
 
+
+
+class SeriesFilterHistoricTestCase(TestCase):
+  def setUp(self) -> None:
+    self.study_uid = gen_uid()
+    self.series = {"CT" : gen_uid(), "PT" : gen_uid()}
+    self.moved = []
+    self.move_received = Event()
+
+    def handle_find(event):
+      identifier = event.identifier
+      if identifier.QueryRetrieveLevel == "STUDY":
+        match = Dataset()
+        match.PatientID = identifier.PatientID
+        match.StudyInstanceUID = self.study_uid
+        match.QueryRetrieveLevel = "STUDY"
+        yield 0xFF00, match
+      else:
+        for modality, series_uid in self.series.items():
+          match = Dataset()
+          match.StudyInstanceUID = self.study_uid
+          match.SeriesInstanceUID = series_uid
+          match.Modality = modality
+          match.QueryRetrieveLevel = "SERIES"
+          yield 0xFF00, match
+
+    def handle_move(event):
+      self.moved.append((event.identifier.QueryRetrieveLevel, event.identifier.SeriesInstanceUID))
+      self.move_received.set()
+      yield ('127.0.0.1', self.port)
+      yield 0
+
+    self.port = randint(1025,65535)
+    self.endpoint = ApplicationEntity()
+    self.endpoint.add_supported_context(StudyRootQueryRetrieveInformationModelFind)
+    self.endpoint.add_supported_context(PatientRootQueryRetrieveInformationModelMove)
+    self.endpoint.start_server(('127.0.0.1', self.port),
+                               evt_handlers=[(evt.EVT_C_FIND, handle_find),
+                                             (evt.EVT_C_MOVE, handle_move)],
+                               block=False)
+
+  def tearDown(self) -> None:
+    self.endpoint.shutdown()
+
+  def test_only_filtered_series_are_moved(self):
+    filtering_threads = []
+    class PETHistoricInput(HistoricAbstractInput):
+      required_tags: List[int] = []
+      address = Address('localhost', self.port, "PYNETDICOM")
+      c_move_blueprint = Blueprint([CopyElement(0x00100020)])
+
+      def series_filter(self, series: Dataset) -> bool:
+        filtering_threads.append(current_thread().name)
+        return series.Modality == "PT"
+
+      def validate(self) -> bool:
+        return True
+
+    pivot = Dataset()
+    pivot.PatientID = "1502799995"
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="historic_retrieval")
+    self.addCleanup(executor.shutdown)
+    PETHistoricInput(pivot, HistoricInput.Options(factory=NumpyFactory(),
+                                                  ae_title="TEST",
+                                                  retrieval_executor=executor))
+
+    self.assertTrue(self.move_received.wait(10))
+    self.assertEqual(self.moved, [("SERIES", self.series["PT"])])
+    # The series are retrieved by the executor of the options
+    self.assertTrue(filtering_threads[0].startswith("historic_retrieval"))
@@ -0,0 +1,121 @@
+__author__ = "Christoffer Vilstrup Jensen"
+
+# Python Standard Library
+from datetime import datetime, timedelta
+from time import sleep
+from typing import List
+from unittest import TestCase
+
+# Third party Packages
+from pydicom import Dataset
+from pydicom.uid import SecondaryCaptureImageStorage
+
+# Dicomnode packages
+from dicomnode.lib.dicom import gen_uid, make_meta
+from dicomnode.server.input import AbstractInput
+from dicomnode.server.maintenance import MaintenanceThread
+from dicomnode.server.pipeline_tree import PipelineTree, PatientNode
+
+
+class TestInput(AbstractInput):
+  required_tags: List[int] = []
+
+  def validate(self) -> bool:
+    return False
+
+class ShortLivedInput(TestInput):
+  expiration_time = timedelta(minutes=5)
+
+def get_dataset(patient_id: str) -> Dataset:
+  dataset = Dataset()
+  dataset.PatientID = patient_id
+  dataset.SOPClassUID = SecondaryCaptureImageStorage
+  dataset.SOPInstanceUID = gen_uid()
+  make_meta(dataset)
+  return dataset
+
+
+class MaintenanceThreadTestCase(TestCase):
+  def setUp(self) -> None:
+    self.pipeline_tree = PipelineTree(0x00100020, {'arg' : TestInput})
+    self.thread = MaintenanceThread(self.pipeline_tree, 14, daemon=True, removal_interval=0)
+
+  def patient_node(self, patient_id: str) -> PatientNode:
+    patient_node = self.pipeline_tree[patient_id]
+    if not isinstance(patient_node, PatientNode):
+      raise AssertionError
+    return patient_node
+
+  def test_deadline_uses_shortest_expiration(self):
+    pipeline_tree = PipelineTree(0x00100020, {'arg' : TestInput, 'short' : ShortLivedInput})
+    pipeline_tree.set_study_expiration(timedelta(days=14))
+    pipeline_tree.add_image(get_dataset("1502799995"))
+    patient_node = pipeline_tree["1502799995"]
+    if not isinstance(patient_node, PatientNode):
+      raise AssertionError
+    self.assertEqual(pipeline_tree.next_expiry(), patient_node.creationTime + timedelta(minutes=5))
+    self.assertEqual(patient_node.get_deadline(None), patient_node.creationTime + timedelta(minutes=5))
+
+  def test_no_expiration(self):
+    pipeline_tree = PipelineTree(0x00100020, {'arg' : TestInput})
+    pipeline_tree.add_image(get_dataset("1502799995"))
+    self.assertIsNone(pipeline_tree.next_expiry())
+    self.assertIsNone(pipeline_tree.remove_next_expired(datetime.now() + timedelta(days=1000)))
+
+  def test_maintenance_removes_expired_patients_in_deadline_order(self):
+    self.pipeline_tree.add_image(get_dataset("1502799995"))
+    self.pipeline_tree.add_image(get_dataset("1210131111"))
+    self.pipeline_tree.add_image(get_dataset("1111550641"))
+    now = datetime.now()
+    self.patient_node("1502799995").creationTime = now - timedelta(days=20)
+    self.patient_node("1210131111").creationTime = now - timedelta(days=15)
+    self.pipeline_tree.set_study_expiration(timedelta(days=14)) # Reschedules with the new creation times
+
+    self.assertEqual(self.pipeline_tree.next_expiry(), now - timedelta(days=6))
+    self.assertEqual(self.thread.maintenance(now), 2)
+    self.assertNotIn("1502799995", self.pipeline_tree)
+    self.assertNotIn("1210131111", self.pipeline_tree)
+    self.assertIn("1111550641", self.pipeline_tree)
+    self.assertEqual(self.pipeline_tree.images, 1)
+    self.assertEqual(self.thread.maintenance(now), 0)
+
+  def test_removed_patients_are_not_expired(self):
+    self.pipeline_tree.add_image(get_dataset("1502799995"))
+    self.pipeline_tree.remove_patient("1502799995")
+    self.pipeline_tree.add_image(get_dataset("1502799995")) # New node, new deadline
+    new_node = self.patient_node("1502799995")
+
+    self.assertEqual(self.pipeline_tree.next_expiry(), new_node.creationTime + timedelta(days=14))
+    self.assertEqual(self.thread.maintenance(new_node.creationTime + timedelta(days=13)), 0)
+    self.assertIn("1502799995", self.pipeline_tree)
+
+  def test_calculate_seconds_to_next_maintenance(self):
+    self.assertEqual(self.thread.calculate_seconds_to_next_maintenance(), self.thread.maximum_sleep)
+    self.pipeline_tree.add_image(get_dataset("1502799995"))
+    creation = self.patient_node("1502799995").creationTime
+    self.assertEqual(self.thread.calculate_seconds_to_next_maintenance(
+      creation + timedelta(days=14) - timedelta(seconds=30)), 30.0)
+    self.assertEqual(self.thread.calculate_seconds_to_next_maintenance(
+      creation + timedelta(days=15)), 0.0)
+    self.assertEqual(self.thread.calculate_seconds_to_next_maintenance(creation), self.thread.maximum_sleep)
+
+  def test_running_thread_removes_patients_as_they_expire(self):
+    class VeryShortLivedInput(TestInput):
+      expiration_time = timedelta(seconds=0.2)
+
+    pipeline_tree = PipelineTree(0x00100020, {'arg' : VeryShortLivedInput})
+    thread = MaintenanceThread(pipeline_tree, 14, daemon=True, removal_interval=0.01, maximum_sleep=0.05)
+    thread.start()
+    try:
+      pipeline_tree.add_image(get_dataset("1502799995"))
+      pipeline_tree.add_image(get_dataset("1210131111"))
+      self.assertIn("1502799995", pipeline_tree)
+      for _ in range(100):
+        if len(pipeline_tree.data) == 0:
+          break
+        sleep(0.02)
+      self.assertEqual(len(pipeline_tree.data), 0)
+    finally:
+      thread.stop()
+      thread.join()
+    self.assertFalse(thread.is_alive())
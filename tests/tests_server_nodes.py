@@ -6,6 +6,7 @@ __author__ = "Christoffer Vilstrup Jensen"
 from copy import deepcopy
 import logging
 import os
+import shutil
 from random import randint
 from pathlib import Path
 from pprint import pprint
@@ -14,25 +15,30 @@ from time import sleep
 from typing import List, Dict, Any, Iterable
 import threading
 from unittest import skip, TestCase
+from urllib.request import urlopen
 
 # Third Party packages #
-from pynetdicom import debug_logger
+import numpy
+from pynetdicom import AE, debug_logger
 from pydicom import Dataset
-from pydicom.uid import RawDataStorage, ImplicitVRLittleEndian
+from pydicom.uid import RawDataStorage, ExplicitVRLittleEndian, ImplicitVRLittleEndian
 
 from dicomnode.lib.dicom import gen_uid, make_meta
-from dicomnode.lib.dimse import Address, send_image, send_images_thread
+from dicomnode.lib.dimse import Address, send_image, send_images, send_images_thread
 from dicomnode.lib.dicom_factory import Blueprint, CopyElement, StaticElement
 from dicomnode.lib.numpy_factory import NumpyFactory
 from dicomnode.lib.exceptions import CouldNotCompleteDIMSEMessage
+from dicomnode.lib.metrics import InMemoryMetrics, get_metrics, set_metrics
 from dicomnode.lib.image_tree import DicomTree
+from dicomnode.lib.shared_memory import SharedArray
+from dicomnode.server.assocation_container import AssociationTypes, ReleasedContainer
 from dicomnode.server.input import AbstractInput, HistoricAbstractInput
 from dicomnode.server.nodes import AbstractPipeline, AbstractThreadedPipeline, AbstractQueuedPipeline
 from dicomnode.server.output import NoOutput, PipelineOutput
 from dicomnode.server.pipeline_tree import InputContainer
 
 # Test Helpers #
-from tests.helpers import generate_numpy_datasets, personify, bench, get_test_ae, TESTING_TEMPORARY_DIRECTORY, testing_logs
+from tests.helpers import benchmark, generate_numpy_datasets, personify, bench, get_test_ae, TESTING_TEMPORARY_DIRECTORY, testing_logs
 
 # Constants declarations #
 TEST_AE_TITLE = "TEST_AE"
@@ -85,6 +91,13 @@ class FaultyPipelineOutput(PipelineOutput):
   def send(self) -> bool:
     raise Exception
 
+class UndeliverableOutput(PipelineOutput):
+  def __init__(self) -> None:
+    super().__init__([])
+
+  def send(self) -> bool:
+    return False
+
 ##### Test Pipeline Implementations #####
 
 
@@ -100,7 +113,9 @@ class FileStorageNode(AbstractPipeline):
   processing_directory = PROCESSING_DIRECTORY
 
   def process(self, input_data: InputContainer) -> PipelineOutput:
-    log_message =  f"process is called at cwd: {os.getcwd()}"
+    if input_data.working_directory is None or not input_data.working_directory.is_dir():
+      raise AssertionError
+    log_message =  f"process is called at working directory: {input_data.working_directory}"
     self.logger.info(log_message)
     return NoOutput()
 
@@ -239,6 +254,14 @@ class PipelineTestCase(TestCase):
     # See the advanced docs guide for details
     self.assertEqual(self.node.data_state.images, 0)
 
+  def test_inputs_get_the_retrieval_executor_of_the_node(self):
+    self.assertIs(self.node.data_state.options.retrieval_executor,
+                  self.node._retrieval_executor)
+    self.node.data_state.add_image(DEFAULT_DATASET)
+    patient_node = self.node.data_state[DEFAULT_DATASET.PatientID]
+    self.assertIs(patient_node[INPUT_KW].options.retrieval_executor,
+                  self.node._retrieval_executor)
+
   def test_reject_connection(self):
     address = Address('localhost', self.test_port, TEST_AE_TITLE)
     self.assertRaises(
@@ -293,6 +316,59 @@ class NeverValidatingTestNode(TestCase):
     disable_pynetdicom_logger: bool = True
     processing_directory = None
 
+  def setUp(self):
+    self.node = self.NeverValidateNode()
+    self.test_port = randint(1025,65535)
+    self.node.port = self.test_port
+    self.node.open(blocking=False)
+
+  def tearDown(self) -> None:
+    self.node.close()
+
+  def performance_c_store_ingest(self):
+    address = Address('localhost', self.test_port, TEST_AE_TITLE)
+    images = 200
+    datasets = []
+    def setup():
+      datasets.clear()
+      datasets.extend(generate_numpy_datasets(images, Cols=128, Rows=128, PatientID=TEST_CPR))
+
+    benchmark("c_store_ingest", lambda: send_images(SENDER_AE, address, datasets),
+              images, "images", setup=setup)
+
+class MemoryBudgetNodeTestCase(TestCase):
+  class MemoryBudgetNode(AbstractPipeline):
+    ae_title = TEST_AE_TITLE
+    input = {INPUT_KW : TestNeverValidatingInput }
+    require_calling_aet = [SENDER_AE]
+    log_output = None
+    log_level: int = logging.DEBUG
+    disable_pynetdicom_logger: bool = True
+    processing_directory = None
+    memory_budget = 30000
+
+  def setUp(self):
+    self.node = self.MemoryBudgetNode()
+    self.test_port = randint(1025,65535)
+    self.node.port = self.test_port
+    self.node.open(blocking=False)
+
+  def tearDown(self) -> None:
+    self.node.close()
+
+  def test_refuses_datasets_when_over_budget(self):
+    address = Address('localhost', self.test_port, TEST_AE_TITLE)
+    dataset_1, dataset_2 = generate_numpy_datasets(2, Cols=128, Rows=128, PatientID=TEST_CPR)
+    with self.assertLogs("dicomnode", logging.WARNING) as cm:
+      self.assertEqual(send_image(SENDER_AE, address, dataset_1).Status, 0x0000)
+      self.assertEqual(send_image(SENDER_AE, address, dataset_2).Status, 0xA700)
+    self.assertIn("WARNING:dicomnode:Memory budget exceeded, refusing dataset", cm.output)
+    self.assertEqual(self.node.data_state.images, 1)
+
+    self.node.data_state.remove_patient(TEST_CPR)
+    self.assertEqual(send_image(SENDER_AE, address, dataset_2).Status, 0x0000)
+
+
 class FaultyNodeTestCase(TestCase):
   class FaultyNode(AbstractPipeline):
     ae_title = TEST_AE_TITLE
@@ -325,6 +401,378 @@ class FaultyNodeTestCase(TestCase):
     self.assertIn("CRITICAL:dicomnode:Encountered exception: Exception", cm.output)
 
 
+class OutboxNodeTestCase(TestCase):
+  class OutboxNode(AbstractPipeline):
+    ae_title = TEST_AE_TITLE
+    input = {INPUT_KW : TestInput }
+    require_calling_aet = [SENDER_AE]
+    log_output = None
+    log_level: int = logging.DEBUG
+    disable_pynetdicom_logger: bool = True
+    processing_directory = None
+    outbox_directory = Path(f"{TESTING_TEMPORARY_DIRECTORY}/outbox")
+    outbox_retry_delay = 3600.0
+
+    def process(self, InputData: InputContainer) -> PipelineOutput:
+      return UndeliverableOutput()
+
+  def setUp(self):
+    self.node = self.OutboxNode()
+    self.test_port = randint(1025,65535)
+    self.node.port = self.test_port
+    self.node.open(blocking=False)
+
+  def tearDown(self) -> None:
+    self.node.close()
+    shutil.rmtree(self.OutboxNode.outbox_directory, ignore_errors=True)
+
+  def test_undelivered_output_is_kept_and_input_released(self):
+    with self.assertLogs("dicomnode", logging.DEBUG) as cm:
+      address = Address('localhost', self.test_port, TEST_AE_TITLE)
+      response = send_image(SENDER_AE, address, DEFAULT_DATASET)
+      self.assertEqual(response.Status, 0x0000)
+      for _ in range(100): # The association is released in another thread
+        if list(self.OutboxNode.outbox_directory.glob("*.output")):
+          break
+        sleep(0.01)
+      sleep(0.05)
+    self.assertIn(f"WARNING:dicomnode:Unable to dispatch output of {TEST_CPR}, it will be retried", cm.output)
+    self.assertNotIn(TEST_CPR, self.node.data_state)
+    self.assertEqual(len(list(self.OutboxNode.outbox_directory.glob("*.output"))), 1)
+
+
+class ProcessOnReadyNodeTestCase(TestCase):
+  class ThreeImagesInput(AbstractInput):
+    required_tags: List[int] = [0x00080018]
+
+    def validate(self) -> bool:
+      return self.images >= 3
+
+  class ProcessOnReadyNode(AbstractPipeline):
+    ae_title = TEST_AE_TITLE
+    require_calling_aet = [SENDER_AE]
+    log_output = None
+    log_level: int = logging.DEBUG
+    disable_pynetdicom_logger: bool = True
+    processing_directory = None
+    process_on_ready = True
+
+    def process(self, InputData: InputContainer) -> PipelineOutput:
+      self.processed.append(len(list(InputData[INPUT_KW])))
+      return NoOutput()
+
+  def setUp(self):
+    self.ProcessOnReadyNode.input = {INPUT_KW : self.ThreeImagesInput}
+    self.node = self.ProcessOnReadyNode()
+    self.node.processed = []
+    self.test_port = randint(1025,65535)
+    self.node.port = self.test_port
+    self.node.open(blocking=False)
+
+  def tearDown(self) -> None:
+    self.node.close()
+
+  def test_processes_before_release(self):
+    address = Address('localhost', self.test_port, TEST_AE_TITLE)
+    datasets = list(generate_numpy_datasets(4, Cols=8, Rows=8, PatientID=TEST_CPR))
+    send_images(SENDER_AE, address, datasets)
+    sleep(0.05) # The association is released in another thread
+
+    # Processed the moment the third image arrived, the fourth image starts
+    # a new patient, which isn't ready upon release
+    self.assertEqual(self.node.processed, [3])
+    self.assertEqual(self.node.data_state.images, 1)
+
+
+class CompletionNodeTestCase(TestCase):
+  class CompletionNode(AbstractPipeline):
+    ae_title = TEST_AE_TITLE
+    input = {INPUT_KW : TestInput }
+    require_calling_aet = [SENDER_AE]
+    log_output = None
+    log_level: int = logging.DEBUG
+    disable_pynetdicom_logger: bool = True
+    processing_directory = None
+    completion_quiet_period = 0.3
+
+    def process(self, InputData: InputContainer) -> PipelineOutput:
+      self.processed.append(len(list(InputData[INPUT_KW])))
+      return NoOutput()
+
+  def setUp(self):
+    self.node = self.CompletionNode()
+    self.node.processed = []
+    self.test_port = randint(1025,65535)
+    self.node.port = self.test_port
+    self.node.open(blocking=False)
+
+  def tearDown(self) -> None:
+    self.node.close()
+
+  def test_associations_are_coalesced(self):
+    address = Address('localhost', self.test_port, TEST_AE_TITLE)
+    dataset_1 = deepcopy(DEFAULT_DATASET)
+    dataset_2 = deepcopy(DEFAULT_DATASET)
+    dataset_2.SOPInstanceUID = gen_uid()
+    self.assertEqual(send_image(SENDER_AE, address, dataset_1).Status, 0x0000)
+    self.assertEqual(send_image(SENDER_AE, address, dataset_2).Status, 0x0000)
+    sleep(0.1)
+    self.assertEqual(self.node.processed, [])
+    for _ in range(100):
+      if self.node.processed:
+        break
+      sleep(0.01)
+    sleep(0.05)
+    self.assertEqual(self.node.processed, [2])
+    self.assertNotIn(TEST_CPR, self.node.data_state)
+
+
+class SingleFlightTestCase(TestCase):
+  class SingleFlightNode(AbstractPipeline):
+    ae_title = TEST_AE_TITLE
+    input = {INPUT_KW : TestInput }
+    log_output = None
+    log_level: int = logging.DEBUG
+    disable_pynetdicom_logger: bool = True
+    processing_directory = None
+
+    def process(self, InputData: InputContainer) -> PipelineOutput:
+      self.processed.append(len(list(InputData[INPUT_KW])))
+      self.processing.set()
+      self.proceed.wait()
+      return self.output
+
+  def setUp(self):
+    self.node = self.SingleFlightNode()
+    self.node.processed = []
+    self.node.processing = threading.Event()
+    self.node.proceed = threading.Event()
+    self.node.output = NoOutput()
+    self.released_container = ReleasedContainer(1, {AssociationTypes.StoreAssociation}, SENDER_AE, None)
+    self.node.data_state.add_image(deepcopy(DEFAULT_DATASET))
+
+  def tearDown(self) -> None:
+    self.node.close()
+
+  def trigger_while_processing(self, triggers: int) -> None:
+    thread = threading.Thread(target=self.node._process_patient,
+                              args=[TEST_CPR, self.released_container])
+    thread.start()
+    self.assertTrue(self.node.processing.wait(5))
+    for _ in range(triggers):
+      self.node._process_patient(TEST_CPR, self.released_container) # Returns immediately
+    self.node.proceed.set()
+    thread.join()
+
+  def test_trigger_of_processed_patient_is_dropped(self):
+    self.trigger_while_processing(1)
+    # The patient was removed after processing, so the rerun is skipped
+    self.assertEqual(self.node.processed, [1])
+    self.assertEqual(self.node._in_flight, {})
+
+  def test_triggers_are_folded_into_one_rerun(self):
+    self.node.output = UndeliverableOutput() # The patient is kept
+    self.trigger_while_processing(3)
+    self.assertEqual(self.node.processed, [1, 1])
+    self.assertIn(TEST_CPR, self.node.data_state)
+    self.assertEqual(self.node._in_flight, {})
+
+
+class MetricsNodeTestCase(TestCase):
+  class MetricsNode(AbstractPipeline):
+    ae_title = TEST_AE_TITLE
+    input = {INPUT_KW : TestInput }
+    require_calling_aet = [SENDER_AE]
+    log_output = None
+    log_level: int = logging.DEBUG
+    disable_pynetdicom_logger: bool = True
+    processing_directory = None
+    metrics_port = 0
+
+    def process(self, InputData: InputContainer) -> PipelineOutput:
+      return NoOutput()
+
+  def setUp(self):
+    self.old_sink = get_metrics()
+    self.node = self.MetricsNode()
+    self.test_port = randint(1025,65535)
+    self.node.port = self.test_port
+    self.node.open(blocking=False)
+
+  def tearDown(self) -> None:
+    self.node.close()
+    set_metrics(self.old_sink)
+
+  def test_stages_are_measured(self):
+    address = Address('localhost', self.test_port, TEST_AE_TITLE)
+    with self.assertLogs("dicomnode", logging.DEBUG):
+      send_image(SENDER_AE, address, DEFAULT_DATASET)
+      for _ in range(100): # The association is released in another thread
+        if self.node.metrics_sink.histogram("dicomnode_stage_seconds", {"stage" : "dispatch"})[0]: # type: ignore
+          break
+        sleep(0.01)
+
+    metrics: InMemoryMetrics = self.node.metrics_sink # type: ignore
+    self.assertEqual(metrics.counter("dicomnode_images_received_total"), 1)
+    self.assertGreater(metrics.counter("dicomnode_bytes_received_total"), 0)
+    for stage in ["c_store", "filter", "add_image", "validate", "process", "dispatch"]:
+      self.assertEqual(metrics.histogram("dicomnode_stage_seconds", {"stage" : stage})[0], 1, stage)
+    self.assertEqual(metrics.histogram("dicomnode_grind_seconds", {"input" : "TestInput"})[0], 1)
+    self.assertEqual(metrics.gauge("dicomnode_tree_patients"), 0)
+
+    with urlopen(f"http://localhost:{self.node._metrics_server.port}/metrics") as response: # type: ignore
+      self.assertIn('dicomnode_stage_seconds_count{stage="process"} 1', response.read().decode())
+
+
+class DuplicateNodeTestCase(TestCase):
+  class DuplicateNode(AbstractPipeline):
+    ae_title = TEST_AE_TITLE
+    input = {INPUT_KW : TestNeverValidatingInput }
+    require_calling_aet = [SENDER_AE]
+    log_output = None
+    log_level: int = logging.DEBUG
+    disable_pynetdicom_logger: bool = True
+    processing_directory = None
+
+    def process(self, InputData: InputContainer) -> PipelineOutput:
+      return NoOutput() # pragma: no cover
+
+  def setUp(self):
+    self.old_sink = get_metrics()
+    self.metrics = InMemoryMetrics()
+    set_metrics(self.metrics)
+    self.node = self.DuplicateNode()
+    self.test_port = randint(1025,65535)
+    self.node.port = self.test_port
+    self.node.open(blocking=False)
+
+  def tearDown(self) -> None:
+    self.node.close()
+    set_metrics(self.old_sink)
+
+  def test_resent_images_are_skipped_before_decoding(self):
+    address = Address('localhost', self.test_port, TEST_AE_TITLE)
+    with self.assertLogs("dicomnode", logging.DEBUG):
+      send_images(SENDER_AE, address, [DEFAULT_DATASET, DEFAULT_DATASET])
+      send_image(SENDER_AE, address, DEFAULT_DATASET)
+
+    self.assertEqual(self.metrics.counter("dicomnode_images_received_total"), 3)
+    self.assertEqual(self.metrics.counter("dicomnode_duplicate_images_total"), 2)
+    # Only the first image reached the filter and the PipelineTree
+    self.assertEqual(self.metrics.histogram("dicomnode_stage_seconds", {"stage" : "filter"})[0], 1)
+    self.assertEqual(self.node.data_state.images, 1)
+
+  def send_explicit(self, dataset: Dataset) -> None:
+    ae = AE(ae_title=SENDER_AE)
+    ae.add_requested_context(dataset.SOPClassUID, ExplicitVRLittleEndian)
+    assoc = ae.associate('localhost', self.test_port, ae_title=TEST_AE_TITLE)
+    self.assertTrue(assoc.is_established)
+    try:
+      status = assoc.send_c_store(dataset)
+      self.assertEqual(status.Status, 0x0000)
+    finally:
+      assoc.release()
+
+  def test_added_image_is_duplicate_of_stored_image(self):
+    self.assertEqual(self.node.data_state.add_image(DEFAULT_DATASET), 1)
+    with self.assertLogs("dicomnode", logging.DEBUG):
+      self.send_explicit(DEFAULT_DATASET)
+
+    self.assertEqual(self.metrics.counter("dicomnode_duplicate_images_total"), 1)
+    self.assertEqual(self.node.data_state.images, 1)
+
+  def test_stored_image_is_duplicate_of_added_image(self):
+    address = Address('localhost', self.test_port, TEST_AE_TITLE)
+    with self.assertLogs("dicomnode", logging.DEBUG):
+      send_image(SENDER_AE, address, DEFAULT_DATASET)
+      self.send_explicit(DEFAULT_DATASET)
+
+    self.assertEqual(self.metrics.counter("dicomnode_duplicate_images_total"), 1)
+    self.assertEqual(self.node.data_state.add_image(DEFAULT_DATASET), 0)
+    self.assertEqual(self.node.data_state.images, 1)
+
+
+class RetriedDuplicateNodeTestCase(TestCase):
+  class FailingOnceNode(AbstractPipeline):
+    ae_title = TEST_AE_TITLE
+    input = {INPUT_KW : TestInput }
+    require_calling_aet = [SENDER_AE]
+    log_output = None
+    log_level: int = logging.DEBUG
+    disable_pynetdicom_logger: bool = True
+    processing_directory = None
+
+    def process(self, InputData: InputContainer) -> PipelineOutput:
+      self.attempts += 1
+      if self.attempts == 1:
+        raise Exception("First attempt fails")
+      return NoOutput()
+
+  def setUp(self):
+    self.node = self.FailingOnceNode()
+    self.node.attempts = 0
+    self.test_port = randint(1025,65535)
+    self.node.port = self.test_port
+    self.node.open(blocking=False)
+
+  def tearDown(self) -> None:
+    self.node.close()
+
+  def wait_for_attempts(self, attempts: int) -> None:
+    for _ in range(200):
+      if self.node.attempts == attempts:
+        return
+      sleep(0.01)
+
+  def test_resent_study_is_processed_again(self):
+    address = Address('localhost', self.test_port, TEST_AE_TITLE)
+    with self.assertLogs("dicomnode", logging.DEBUG):
+      send_image(SENDER_AE, address, DEFAULT_DATASET)
+      self.wait_for_attempts(1)
+    self.assertIn(TEST_CPR, self.node.data_state)
+
+    # The re-sent image is a duplicate, but the patient is processed again
+    with self.assertLogs("dicomnode", logging.DEBUG):
+      send_image(SENDER_AE, address, DEFAULT_DATASET)
+      self.wait_for_attempts(2)
+    self.assertEqual(self.node.attempts, 2)
+    self.assertNotIn(TEST_CPR, self.node.data_state)
+
+
+class SharedMemoryNodeTestCase(TestCase):
+  class VolumeInput(TestInput):
+    image_grinder = lambda self, images: numpy.full((8,8,8), len(list(images)), dtype=numpy.int32) # type: ignore
+
+  class SharedMemoryNode(AbstractPipeline):
+    ae_title = TEST_AE_TITLE
+    log_output = None
+    log_level: int = logging.DEBUG
+    disable_pynetdicom_logger: bool = True
+    processing_directory = None
+    shared_memory_threshold = 1024
+
+    def process(self, InputData: InputContainer) -> PipelineOutput:
+      self.shared = InputData.get_shared(INPUT_KW)
+      self.total = int(InputData[INPUT_KW].sum())
+      return NoOutput()
+
+  def setUp(self):
+    self.SharedMemoryNode.input = {INPUT_KW : self.VolumeInput}
+    self.node = self.SharedMemoryNode()
+    self.node.data_state.add_image(deepcopy(DEFAULT_DATASET))
+
+  def tearDown(self) -> None:
+    self.node.close()
+
+  def test_shared_arrays_are_released_after_the_job(self):
+    released_container = ReleasedContainer(1, {AssociationTypes.StoreAssociation}, SENDER_AE, None)
+    with self.assertLogs("dicomnode", logging.DEBUG):
+      self.assertTrue(self.node._pipeline_processing(TEST_CPR, released_container))
+    self.assertEqual(self.node.total, 8 * 8 * 8)
+    with self.assertRaises(FileNotFoundError):
+      SharedArray(self.node.shared.name, (8,8,8), "<i4", 0).attach()
+
+
 class FileStorageTestCase(TestCase):
   def setUp(self):
     DICOM_STORAGE_PATH.mkdir(parents=True, exist_ok=True)
@@ -387,8 +835,8 @@ class FileStorageTestCase(TestCase):
       ret_1 = thread_1.join()
       ret_2 = thread_2.join()
 
-    log_entry_1 = f"INFO:dicomnode:process is called at cwd: {str(self.node.processing_directory)}/{CPR_1}"
-    log_entry_2 = f"INFO:dicomnode:process is called at cwd: {str(self.node.processing_directory)}/{CPR_2}"
+    log_entry_1 = f"INFO:dicomnode:process is called at working directory: {str(self.node.processing_directory)}/{CPR_1}"
+    log_entry_2 = f"INFO:dicomnode:process is called at working directory: {str(self.node.processing_directory)}/{CPR_2}"
 
     self.assertIn(log_entry_1, cm.output)
     self.assertIn(log_entry_2, cm.output)
@@ -398,8 +846,8 @@ class FileStorageTestCase(TestCase):
     self.assertEqual(self.node.data_state.images, 0)
 
 class SetupLessFileStorageTestCase(TestCase):
-  """This test case is for testing the various current working directory changes
-  done by the node.
+  """This test case is for testing the setup and teardown of the processing
+  directory, which must not change the current working directory.
 
   Args:
       TestCase (_type_): _description_
@@ -411,7 +859,8 @@ class SetupLessFileStorageTestCase(TestCase):
     node.port = randint(1025,65535)
     self.assertEqual(os.getcwd(), TESTING_TEMPORARY_DIRECTORY)
     node.open(blocking=False)
-    self.assertEqual(os.getcwd(), str(node.processing_directory))
+    self.assertEqual(os.getcwd(), TESTING_TEMPORARY_DIRECTORY)
+    self.assertTrue(node.processing_directory.exists()) #type: ignore
     node.close()
     self.assertEqual(os.getcwd(), TESTING_TEMPORARY_DIRECTORY)
     self.assertFalse(node.processing_directory.exists()) #type: ignore
@@ -0,0 +1,172 @@
+"""Tests for the durable export queue"""
+
+__author__ = "Christoffer Vilstrup Jensen"
+
+# Python Standard Library
+import logging
+from pathlib import Path
+import shutil
+from time import sleep
+from unittest import TestCase
+
+# Third party packages
+from pydicom import Dataset
+from pydicom.uid import SecondaryCaptureImageStorage
+
+# Dicomnode packages
+from dicomnode.lib.dicom import gen_uid, make_meta
+from dicomnode.lib.storage import SegmentStore
+from dicomnode.server.outbox import Outbox
+from dicomnode.server.output import DispatchResult, MultiOutput, PipelineOutput
+
+class RecordedOutput(PipelineOutput):
+  def __init__(self, name: str) -> None:
+    super().__init__([])
+    self.name = name
+
+  def send(self) -> bool:
+    return True # pragma: no cover
+
+class UnpicklableOutput(PipelineOutput):
+  def __init__(self) -> None:
+    super().__init__([])
+    self.generator = (i for i in range(3))
+
+  def send(self) -> bool:
+    return True # pragma: no cover
+
+
+class OutboxTestCase(TestCase):
+  def setUp(self) -> None:
+    self.path = Path(self._testMethodName)
+    self.sent = []
+    self.sent_outputs = []
+    self.failures = 0
+
+  def tearDown(self) -> None:
+    shutil.rmtree(self.path, ignore_errors=True)
+
+  def dispatch(self, output: RecordedOutput) -> bool:
+    if self.failures:
+      self.failures -= 1
+      return False
+    self.sent.append(output.name)
+    self.sent_outputs.append(output)
+    return True
+
+  def test_put_successful(self):
+    outbox = Outbox(self.path, self.dispatch)
+    self.assertTrue(outbox.put(RecordedOutput("output")))
+    self.assertEqual(self.sent, ["output"])
+    self.assertEqual(len(outbox), 0)
+    self.assertEqual(list(self.path.glob(f"*{Outbox.suffix}")), [])
+
+  def test_put_failure_is_persisted_and_retried(self):
+    self.failures = 2
+    outbox = Outbox(self.path, self.dispatch, base_delay=10.0)
+    with self.assertLogs("dicomnode", logging.INFO) as recorded_logs:
+      self.assertFalse(outbox.put(RecordedOutput("output")))
+    self.assertEqual(len(outbox), 1)
+    self.assertEqual(len(list(self.path.glob(f"*{Outbox.suffix}"))), 1)
+    self.assertIn("retrying in 10.0 seconds", recorded_logs.output[0])
+
+    self.assertEqual(outbox.retry_due(), 0) # Not due yet
+    with self.assertLogs("dicomnode", logging.INFO) as recorded_logs:
+      self.assertEqual(outbox.retry_due(float('inf')), 0)
+    self.assertIn("retrying in 20.0 seconds", recorded_logs.output[0])
+
+    self.assertEqual(outbox.retry_due(float('inf')), 1)
+    self.assertEqual(self.sent, ["output"])
+    self.assertEqual(list(self.path.glob(f"*{Outbox.suffix}")), [])
+
+  def test_max_delay(self):
+    self.failures = 10
+    outbox = Outbox(self.path, self.dispatch, base_delay=1.0, max_delay=4.0)
+    outbox.put(RecordedOutput("output"))
+    for _ in range(3):
+      outbox.retry_due(float('inf'))
+    with self.assertLogs("dicomnode", logging.INFO) as recorded_logs:
+      outbox.retry_due(float('inf'))
+    self.assertIn("retrying in 4.0 seconds", recorded_logs.output[0])
+
+  def test_max_attempts_moves_to_failed(self):
+    self.failures = 10
+    outbox = Outbox(self.path, self.dispatch, max_attempts=2)
+    outbox.put(RecordedOutput("output"))
+    with self.assertLogs("dicomnode", logging.ERROR) as recorded_logs:
+      outbox.retry_due(float('inf'))
+    self.assertIn("after 2 attempts", recorded_logs.output[0])
+    self.assertEqual(len(outbox), 0)
+    self.assertEqual(len(list((self.path / Outbox.failed_directory_name).iterdir())), 1)
+
+  def test_unpicklable_output_raises(self):
+    outbox = Outbox(self.path, self.dispatch)
+    self.assertRaises(Exception, outbox.put, UnpicklableOutput())
+    self.assertEqual(list(self.path.iterdir()), [])
+    self.assertEqual(self.sent, [])
+
+  def test_recovers_pending_outputs(self):
+    self.failures = 1
+    Outbox(self.path, self.dispatch).put(RecordedOutput("crashed"))
+
+    outbox = Outbox(self.path, self.dispatch, base_delay=0.01)
+    self.assertEqual(len(outbox), 1)
+    outbox.start()
+    for _ in range(100):
+      if self.sent:
+        break
+      sleep(0.01)
+    outbox.stop()
+    self.assertEqual(self.sent, ["crashed"])
+
+  def test_background_retry(self):
+    self.failures = 1
+    outbox = Outbox(self.path, self.dispatch, base_delay=0.01)
+    outbox.start()
+    self.assertFalse(outbox.put(RecordedOutput("output")))
+    for _ in range(100):
+      if self.sent:
+        break
+      sleep(0.01)
+    outbox.stop()
+    self.assertEqual(self.sent, ["output"])
+    self.assertEqual(len(outbox), 0)
+
+  def test_lazy_datasets_of_segment_store(self):
+    store = SegmentStore(self.path / "store")
+    dataset = Dataset()
+    dataset.SOPClassUID = SecondaryCaptureImageStorage
+    dataset.SOPInstanceUID = gen_uid()
+    make_meta(dataset)
+    store.put("input/image.dcm", dataset)
+    output = RecordedOutput("output")
+    output.output = [("destination", [store.lazy("input/image.dcm")])]
+
+    self.failures = 1
+    outbox = Outbox(self.path / "outbox", self.dispatch)
+    with self.assertLogs("dicomnode", logging.INFO):
+      self.assertFalse(outbox.put(output))
+    store.clear() # The patient is removed once the output is in the outbox
+
+    recovered_outbox = Outbox(self.path / "outbox", self.dispatch)
+    self.assertEqual(recovered_outbox.retry_due(float('inf')), 1)
+    self.assertEqual(self.sent, ["output"])
+    _, (sent_dataset,) = self.sent_outputs[0].output[0]
+    self.assertEqual(sent_dataset.SOPInstanceUID, dataset.SOPInstanceUID)
+
+  def test_retry_skips_delivered_outputs(self):
+    def dispatch(output: MultiOutput) -> bool:
+      if not self.sent:
+        self.sent.append([sub_output.name for sub_output in output.outputs])
+        output.results = [DispatchResult(output.outputs[0], True),
+                          DispatchResult(output.outputs[1], False)]
+        return False
+      self.sent.append([sub_output.name for sub_output in output.outputs])
+      return True
+
+    outbox = Outbox(self.path, dispatch)
+    with self.assertLogs("dicomnode", logging.INFO):
+      self.assertFalse(outbox.put(MultiOutput([RecordedOutput("first"), RecordedOutput("second")])))
+    recovered_outbox = Outbox(self.path, dispatch)
+    self.assertEqual(recovered_outbox.retry_due(float('inf')), 1)
+    self.assertEqual(self.sent, [["first", "second"], ["second"]])
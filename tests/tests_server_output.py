@@ -1,16 +1,33 @@
 import logging
 import shutil
+from time import perf_counter, sleep
 from random import randint
 from pathlib import Path
 from pydicom import Dataset
 from pydicom.uid import SecondaryCaptureImageStorage
 from unittest import TestCase
 
-from dicomnode.lib.dimse import Address
+from dicomnode.lib.dimse import Address, AssociationPool
 from dicomnode.lib.dicom import gen_uid, make_meta
-from dicomnode.server.output import DicomOutput, FileOutput
+from dicomnode.lib.exceptions import IncorrectlyConfigured
+from dicomnode.server.output import DicomOutput, DispatchResult, FileOutput, MultiOutput, NoOutput, PipelineOutput, dispatch_concurrently
 from tests.helpers import get_test_ae
 
+class SleepyOutput(PipelineOutput):
+  def __init__(self, seconds: float) -> None:
+    self.seconds = seconds
+
+  def send(self) -> bool:
+    sleep(self.seconds)
+    return True
+
+class FaultyOutput(PipelineOutput):
+  def __init__(self) -> None:
+    pass
+
+  def send(self) -> bool:
+    raise Exception
+
 
 class OutputTests(TestCase):
   def setUp(self) -> None:
@@ -54,9 +71,146 @@ class OutputTests(TestCase):
       self.assertTrue(output.send())
     self.assertIn('INFO:dicomnode:Received C Store',cm.output)
 
+  def test_dicom_output_send_with_pool(self):
+    pool = AssociationPool()
+    with self.assertLogs("dicomnode", logging.DEBUG) as cm:
+      self.assertTrue(DicomOutput([(self.endpointAddress, self.datasets)], "PIPELINE_AE", pool).send())
+      self.assertTrue(DicomOutput([(self.endpointAddress, self.datasets)], "PIPELINE_AE", pool).send())
+    self.assertEqual(cm.output.count('INFO:dicomnode:Received C Store'), 2)
+    self.assertIn(f'DEBUG:dicomnode:Reusing association to {self.endpoint.ae_title}', cm.output)
+    pool.close()
+
+  def test_dicom_output_send_sharded(self):
+    datasets = []
+    for _ in range(4):
+      dataset = Dataset()
+      dataset.SOPClassUID = SecondaryCaptureImageStorage
+      dataset.PatientID = "1623910515"
+      make_meta(dataset)
+      datasets.append(dataset)
+    with self.assertLogs("dicomnode", logging.DEBUG) as cm:
+      output = DicomOutput([(self.endpointAddress, datasets)], "PIPELINE_AE", shards=2)
+      self.assertTrue(output.send())
+    self.assertEqual(cm.output.count('INFO:dicomnode:Received C Store'), 4)
+
   def test_dicom_output_send_failure(self):
     address = Address('localhost', 150, "WrongAE")
     with self.assertLogs("dicomnode", logging.DEBUG) as cm:
       output = DicomOutput([(address, self.datasets)], "PIPELINE_AE")
       self.assertFalse(output.send())
     self.assertIn("ERROR:dicomnode:Could not send to images to WrongAE", cm.output)
+
+  def test_dicom_output_aggregates_results(self):
+    address = Address('localhost', 150, "WrongAE")
+    with self.assertLogs("dicomnode", logging.DEBUG) as cm:
+      output = DicomOutput([(self.endpointAddress, self.datasets), (address, self.datasets)], "PIPELINE_AE")
+      self.assertFalse(output.send())
+    self.assertEqual([(result.destination, result.success) for result in output.results],
+                     [(self.endpointAddress, True), (address, False)])
+    self.assertIn('INFO:dicomnode:Received C Store',cm.output)
+
+  def test_dicom_output_timeout_aborts_sending(self):
+    def slow_datasets():
+      for _ in range(3):
+        sleep(0.1)
+        yield self.dataset_1
+
+    pool = AssociationPool()
+    with self.assertLogs("dicomnode", logging.DEBUG) as cm:
+      output = DicomOutput([(self.endpointAddress, slow_datasets())], "PIPELINE_AE", pool, timeout=0.05)
+      self.assertFalse(output.send())
+      self.assertTrue(output.results[0].timed_out)
+      sleep(0.5) # The abandoned send reaches its first C-STORE
+    self.assertNotIn('INFO:dicomnode:Received C Store', cm.output)
+    self.assertIn(f'ERROR:dicomnode:Sending to {self.endpoint.ae_title} was aborted', cm.output)
+    self.assertEqual(len(pool), 0)
+    self.assertEqual(pool._in_use, {})
+    pool.close()
+
+  def test_multi_output_timeout_cancels(self):
+    class CancellableOutput(SleepyOutput):
+      cancelled = False
+      def cancel(self) -> None:
+        self.cancelled = True
+
+    slow_output = CancellableOutput(0.2)
+    fast_output = CancellableOutput(0.0)
+    with self.assertLogs("dicomnode", logging.ERROR):
+      self.assertFalse(MultiOutput([slow_output, fast_output], timeout=0.05).send())
+    self.assertTrue(slow_output.cancelled)
+    self.assertFalse(fast_output.cancelled)
+
+  def test_dicom_output_makes_shared_meta_once(self):
+    dataset = Dataset()
+    dataset.SOPClassUID = SecondaryCaptureImageStorage
+    dataset.PatientID = "1623910515"
+    with self.assertLogs("dicomnode", logging.DEBUG) as cm:
+      output = DicomOutput([(self.endpointAddress, [dataset]), (self.endpointAddress, [dataset])], "PIPELINE_AE")
+      self.assertTrue(output.send())
+    self.assertEqual(cm.output.count('INFO:dicomnode:Received C Store'), 2)
+    self.assertIn(0x00080018, dataset)
+    self.assertEqual(dataset.file_meta.MediaStorageSOPInstanceUID, dataset.SOPInstanceUID)
+
+  def test_dicom_output_streams_are_sent_once(self):
+    address = Address('localhost', 150, "WrongAE")
+    stream = (dataset for dataset in self.datasets)
+    self.assertRaises(IncorrectlyConfigured, DicomOutput,
+                      [(self.endpointAddress, stream), (address, stream)], "PIPELINE_AE")
+
+    with self.assertLogs("dicomnode", logging.DEBUG) as cm:
+      output = DicomOutput([(self.endpointAddress, stream)], "PIPELINE_AE")
+      self.assertTrue(output.send())
+    self.assertIn('INFO:dicomnode:Received C Store', cm.output)
+    self.assertRaises(IncorrectlyConfigured, output.send)
+
+  def test_dicom_output_undelivered(self):
+    address = Address('localhost', 150, "WrongAE")
+    output = DicomOutput([(self.endpointAddress, self.datasets), (address, self.datasets)], "PIPELINE_AE")
+    self.assertIs(output.undelivered(), output) # Not sent yet
+    output.results = [DispatchResult(self.endpointAddress, True), DispatchResult(address, False)]
+    undelivered = output.undelivered()
+    self.assertEqual(undelivered.output, [(address, self.datasets)])
+    self.assertEqual(undelivered.results, [])
+    self.assertEqual(len(output.output), 2)
+
+  def test_multi_output_undelivered(self):
+    address = Address('localhost', 150, "WrongAE")
+    dicom_output = DicomOutput([(self.endpointAddress, self.datasets), (address, self.datasets)], "PIPELINE_AE")
+    dicom_output.results = [DispatchResult(self.endpointAddress, True), DispatchResult(address, False)]
+    delivered_output = NoOutput()
+    output = MultiOutput([delivered_output, dicom_output])
+    output.results = [DispatchResult(delivered_output, True), DispatchResult(dicom_output, False)]
+    undelivered = output.undelivered()
+    self.assertEqual(len(undelivered.outputs), 1)
+    self.assertEqual(undelivered.outputs[0].output, [(address, self.datasets)])
+
+  def test_multi_output_sends_concurrently(self):
+    output = MultiOutput([SleepyOutput(0.2), SleepyOutput(0.2), NoOutput()])
+    start = perf_counter()
+    self.assertTrue(output.send())
+    self.assertLess(perf_counter() - start, 0.35)
+    self.assertEqual(len(output.results), 3)
+
+  def test_multi_output_serial(self):
+    output = MultiOutput([SleepyOutput(0.1), SleepyOutput(0.1)], parallel=False)
+    start = perf_counter()
+    self.assertTrue(output.send())
+    self.assertGreaterEqual(perf_counter() - start, 0.2)
+
+  def test_multi_output_failure(self):
+    file_output = FileOutput([(self.path, self.datasets)])
+    faulty_output = FaultyOutput()
+    with self.assertLogs("dicomnode", logging.CRITICAL):
+      output = MultiOutput([file_output, faulty_output])
+      self.assertFalse(output.send())
+    self.assertTrue(output.results[0].success)
+    self.assertFalse(output.results[1].success)
+
+  def test_dispatch_timeout(self):
+    with self.assertLogs("dicomnode", logging.ERROR) as cm:
+      results = dispatch_concurrently([("slow", lambda: sleep(1) or True),
+                                       ("fast", lambda: True)], timeout=0.05)
+    self.assertTrue(results[0].timed_out)
+    self.assertFalse(results[0].success)
+    self.assertTrue(results[1].success)
+    self.assertIn("ERROR:dicomnode:Sending to slow timed out after 0.05 seconds", cm.output)
@@ -2,25 +2,33 @@
 __author__ = "Christoffer Vilstrup Jensen"
 
 # Python Standard Library
+from copy import deepcopy
 import logging
 from logging import StreamHandler
 from pathlib import Path
 import shutil
 from sys import stdout
+from threading import Event, Thread
 from typing import List, Dict, Any, Iterator, Callable
 from unittest import TestCase
 import datetime
 
 
 # Third party Packages
+import numpy
 from pydicom import Dataset
 from pydicom.uid import SecondaryCaptureImageStorage
 
 # Dicomnode packages
-from dicomnode.lib.dicom import gen_uid, make_meta
+from dicomnode.lib.dicom import dataset_digest, estimate_dataset_size, gen_uid, make_meta
+from dicomnode.lib.dimse import Address, MoveCoordinator, PendingMove, QueryLevels, _query_key
+from dicomnode.lib.lazy_dataset import LazyDataset
+from dicomnode.lib.metrics import InMemoryMetrics, get_metrics, set_metrics
 from dicomnode.lib.exceptions import InvalidDataset, InvalidRootDataDirectory
 from dicomnode.lib.dicom_factory import Blueprint, StaticElement, InstanceCopyElement, CopyElement
 from dicomnode.lib.numpy_factory import NumpyFactory
+from dicomnode.lib.shared_memory import SharedArray
+from dicomnode.lib.storage import MemoryStore, SegmentStore
 from dicomnode.server.grinders import Grinder
 from dicomnode.server.input import AbstractInput, DynamicInput
 from dicomnode.server.pipeline_tree import PipelineTree, InputContainer, PatientNode
@@ -45,6 +53,10 @@ class TestGrinder(Grinder):
   def __call__(self, datasets: Iterator[Dataset]) -> str:
     return "GrinderString"
 
+class ArrayGrinder(Grinder):
+  def __call__(self, image_generator) -> numpy.ndarray:
+    return numpy.array([len(dataset.PixelData) for dataset in image_generator])
+
 class TestInput1(AbstractInput):
   required_tags: List[int] = []
   required_values: Dict[int, Any] = {
@@ -206,6 +218,406 @@ class PipelineTestCase(TestCase):
     self.assertIn(CPR_3, self.pipeline_tree.data)
     self.assertEqual(self.pipeline_tree.images, 1)
 
+class ConcurrentPipelineTreeTestCase(TestCase):
+  def setUp(self) -> None:
+    self.path = Path(self._testMethodName)
+    self.pipeline_tree = PipelineTree(
+      0x00100020, {
+        'arg_1' : TestInput1,
+      }, PipelineTree.Options(data_directory=self.path))
+
+  def tearDown(self) -> None:
+    shutil.rmtree(self.path, ignore_errors=True)
+
+  def get_dataset(self, patient_id: str) -> Dataset:
+    dataset = Dataset()
+    dataset.PatientID = patient_id
+    dataset.SOPClassUID = SecondaryCaptureImageStorage
+    dataset.SeriesDescription = SERIES_DESCRIPTION
+    dataset.SOPInstanceUID = gen_uid()
+    make_meta(dataset)
+    return dataset
+
+  def test_concurrent_inserts(self):
+    patient_ids = [f"patient_{i}" for i in range(4)]
+    datasets = [self.get_dataset(patient_id) for patient_id in patient_ids for _ in range(25)]
+
+    def insert(thread_datasets: List[Dataset]):
+      for dataset in thread_datasets:
+        self.pipeline_tree.add_image(dataset)
+
+    threads = [Thread(target=insert, args=(datasets[i::8],)) for i in range(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    self.assertEqual(self.pipeline_tree.images, 100)
+    self.assertEqual(len(self.pipeline_tree.data), 4)
+    for _, patient_node in self.pipeline_tree.get_patient_nodes():
+      self.assertEqual(patient_node.images, 25)
+      self.assertEqual(patient_node['arg_1'].images, 25)
+
+  def test_concurrent_inserts_and_removals(self):
+    datasets = [self.get_dataset("1502799995") for _ in range(50)]
+    inserted = []
+
+    def insert():
+      for dataset in datasets:
+        inserted.append(self.pipeline_tree.add_image(dataset))
+
+    def remove():
+      for _ in range(20):
+        self.pipeline_tree.remove_patient("1502799995")
+
+    threads = [Thread(target=insert), Thread(target=remove)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    # No image is lost, it's either removed or in the current node
+    self.assertEqual(sum(inserted), 50)
+    self.assertEqual(self.pipeline_tree.images,
+                     sum(node.images for _, node in self.pipeline_tree.get_patient_nodes()))
+    self.pipeline_tree.remove_patient("1502799995")
+    self.assertEqual(self.pipeline_tree.images, 0)
+    self.assertEqual(self.pipeline_tree.nbytes, 0)
+
+  def test_stale_removal_keeps_new_patient(self):
+    self.pipeline_tree.add_image(self.get_dataset("1502799995"))
+    old_node = self.pipeline_tree["1502799995"]
+    if not isinstance(old_node, PatientNode):
+      raise AssertionError
+    self.pipeline_tree.remove_patient("1502799995")
+    self.pipeline_tree.add_image(self.get_dataset("1502799995"))
+
+    self.assertEqual(self.pipeline_tree._remove_patient_node("1502799995", old_node), 0)
+    self.assertIn("1502799995", self.pipeline_tree)
+    self.assertEqual(self.pipeline_tree.images, 1)
+    self.assertTrue((self.path / "1502799995").exists())
+
+  def test_slow_creation_does_not_block_other_patients(self):
+    creating = Event()
+    resume = Event()
+    created = []
+
+    class SlowInput(TestInput1):
+      def __init__(self, pivot = None, options = AbstractInput.Options()) -> None:
+        if pivot is not None and pivot.PatientID == "1502799995":
+          created.append(pivot.PatientID)
+          creating.set()
+          resume.wait(10)
+        super().__init__(pivot, options)
+
+    pipeline_tree = PipelineTree(0x00100020, {'arg_1' : SlowInput},
+                                 PipelineTree.Options(data_directory=self.path))
+    threads = [Thread(target=pipeline_tree.add_image, args=(self.get_dataset("1502799995"),))
+               for _ in range(2)]
+    for thread in threads:
+      thread.start()
+    self.assertTrue(creating.wait(10))
+
+    # Another patient is added, while the first is being created
+    other_thread = Thread(target=pipeline_tree.add_image, args=(self.get_dataset("1210131111"),))
+    other_thread.start()
+    other_thread.join(5)
+    self.assertFalse(other_thread.is_alive())
+    self.assertIn("1210131111", pipeline_tree)
+
+    resume.set()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(created, ["1502799995"]) # Created once
+    self.assertEqual(pipeline_tree["1502799995"].images, 2) # type: ignore
+    self.assertEqual(pipeline_tree._creation_locks, {})
+
+  def test_contains_node(self):
+    self.pipeline_tree.add_image(self.get_dataset("1502799995"))
+    patient_node = self.pipeline_tree["1502799995"]
+    if not isinstance(patient_node, PatientNode):
+      raise AssertionError
+    self.assertEqual(patient_node.key, "1502799995")
+    self.assertTrue(self.pipeline_tree._contains_node(patient_node))
+    self.pipeline_tree.remove_patient("1502799995")
+    self.assertFalse(self.pipeline_tree._contains_node(patient_node))
+
+def get_pixel_dataset(patient_id: str, pixel_bytes: int = 10000) -> Dataset:
+  dataset = Dataset()
+  dataset.PatientID = patient_id
+  dataset.SOPClassUID = SecondaryCaptureImageStorage
+  dataset.SeriesDescription = SERIES_DESCRIPTION
+  dataset.SOPInstanceUID = gen_uid()
+  dataset.PixelData = bytes(pixel_bytes)
+  make_meta(dataset)
+  return dataset
+
+class MemoryBudgetTestCase(TestCase):
+  def setUp(self) -> None:
+    self.path = Path(self._testMethodName)
+    self.pipeline_tree = PipelineTree(
+      0x00100020, {
+        'arg_1' : TestInput1,
+      }, PipelineTree.Options(data_directory=self.path, memory_budget=25000))
+
+  def tearDown(self) -> None:
+    shutil.rmtree(self.path, ignore_errors=True)
+
+  def test_accounting(self):
+    self.pipeline_tree.options.memory_budget = None
+    self.pipeline_tree.add_image(get_pixel_dataset("1502799995"))
+    self.pipeline_tree.add_image(get_pixel_dataset("1502799995"))
+    self.pipeline_tree.add_image(get_pixel_dataset("1210131111"))
+    patient_node = self.pipeline_tree["1502799995"]
+    if not isinstance(patient_node, PatientNode):
+      raise AssertionError
+    self.assertGreaterEqual(patient_node.nbytes, 20000)
+    self.assertGreaterEqual(self.pipeline_tree.nbytes, 30000)
+    self.assertEqual(self.pipeline_tree.nbytes, patient_node.nbytes + self.pipeline_tree["1210131111"].nbytes) # type: ignore
+
+    self.pipeline_tree.remove_patients(["1502799995", "1210131111"])
+    self.assertEqual(self.pipeline_tree.nbytes, 0)
+
+  def test_spills_least_recently_updated(self):
+    self.pipeline_tree.add_image(get_pixel_dataset("1502799995"))
+    self.pipeline_tree.add_image(get_pixel_dataset("1210131111"))
+    self.assertFalse(self.pipeline_tree.exceeds_memory_budget())
+    self.pipeline_tree.add_image(get_pixel_dataset("1111550641"))
+    self.assertFalse(self.pipeline_tree.exceeds_memory_budget())
+
+    spilled_node = self.pipeline_tree["1502799995"]
+    kept_node = self.pipeline_tree["1210131111"]
+    if not isinstance(spilled_node, PatientNode) or not isinstance(kept_node, PatientNode):
+      raise AssertionError
+    self.assertEqual(spilled_node.nbytes, 0)
+    self.assertGreater(kept_node.nbytes, 10000)
+    for dataset in spilled_node['arg_1']:
+      self.assertIsInstance(dataset, LazyDataset)
+    for dataset in kept_node['arg_1']:
+      self.assertNotIsInstance(dataset, LazyDataset)
+
+    # Spilled datasets are loaded again on demand
+    input_container = self.pipeline_tree.get_patient_input_container("1502799995")
+    for dataset in input_container['arg_1']:
+      self.assertEqual(len(dataset.PixelData), 10000)
+
+  def test_no_spilling_without_file_storage(self):
+    pipeline_tree = PipelineTree(0x00100020, {'arg_1' : TestInput1},
+                                 PipelineTree.Options(memory_budget=15000))
+    pipeline_tree.add_image(get_pixel_dataset("1502799995"))
+    self.assertFalse(pipeline_tree.exceeds_memory_budget())
+    pipeline_tree.add_image(get_pixel_dataset("1210131111"))
+    self.assertTrue(pipeline_tree.exceeds_memory_budget())
+    self.assertEqual(pipeline_tree.enforce_memory_budget(), 0)
+    pipeline_tree.remove_patient("1502799995")
+    self.assertFalse(pipeline_tree.exceeds_memory_budget())
+
+
+class ArrayInput(TestInput1):
+  image_grinder: Grinder = ArrayGrinder()
+
+
+class LazyGrindingTestCase(TestCase):
+  def setUp(self) -> None:
+    self.path = Path(self._testMethodName)
+    self.old_sink = get_metrics()
+    self.metrics = InMemoryMetrics()
+    set_metrics(self.metrics)
+
+  def tearDown(self) -> None:
+    set_metrics(self.old_sink)
+    shutil.rmtree(self.path, ignore_errors=True)
+
+  def grinds(self, input_name: str) -> int:
+    return self.metrics.histogram("dicomnode_grind_seconds", {"input" : input_name})[0]
+
+  def test_inputs_are_ground_on_first_access(self):
+    pipeline_tree = PipelineTree(0x00100020, {'arg_1' : TestInput1, 'arg_2' : TestInput2},
+                                 PipelineTree.Options(lazy_grinding=True))
+    pipeline_tree.add_image(get_pixel_dataset("1502799995"))
+    input_container = pipeline_tree.get_patient_input_container("1502799995")
+    self.assertEqual(self.grinds("TestInput1"), 0)
+    self.assertFalse(input_container.is_ground('arg_1'))
+
+    self.assertEqual(len(list(input_container['arg_1'])), 1)
+    self.assertEqual(len(list(input_container['arg_1'])), 1)
+    self.assertTrue(input_container.is_ground('arg_1'))
+    self.assertEqual(self.grinds("TestInput1"), 1)
+    self.assertEqual(self.grinds("TestInput2"), 0)
+    self.assertRaises(KeyError, input_container.__getitem__, 'arg_3')
+
+  def test_ground_inputs_are_released(self):
+    pipeline_tree = PipelineTree(0x00100020, {'arg_1' : ArrayInput, 'arg_2' : TestInput2},
+                                 PipelineTree.Options(data_directory=self.path,
+                                                      release_ground_inputs=True))
+    dataset = get_pixel_dataset("1502799995")
+    dataset.PatientName = "Test^Patient"
+    pipeline_tree.add_image(dataset)
+    self.assertGreater(pipeline_tree.nbytes, 10000)
+
+    input_container = pipeline_tree.get_patient_input_container("1502799995")
+    self.assertEqual(input_container['arg_2'], "GrinderString")
+    patient_node = pipeline_tree["1502799995"]
+    if not isinstance(patient_node, PatientNode):
+      raise AssertionError
+    for arg_name in ['arg_1', 'arg_2']:
+      for released_dataset in patient_node[arg_name]:
+        self.assertIsInstance(released_dataset, LazyDataset)
+    self.assertEqual(patient_node.nbytes, 0)
+    self.assertEqual(pipeline_tree.nbytes, 0)
+
+    # The released datasets are loaded again, if the patient is processed again
+    self.assertEqual(list(pipeline_tree.get_patient_input_container("1502799995")['arg_1']), [10000])
+    pipeline_tree.remove_patient("1502799995")
+    self.assertEqual(pipeline_tree.nbytes, 0)
+
+  def test_aliased_inputs_are_kept(self):
+    pipeline_tree = PipelineTree(0x00100020, {'arg_1' : TestInput1, 'arg_2' : TestInput2},
+                                 PipelineTree.Options(data_directory=self.path,
+                                                      release_ground_inputs=True))
+    dataset = get_pixel_dataset("1502799995")
+    dataset.PatientName = "Test^Patient"
+    pipeline_tree.add_image(dataset)
+    nbytes = pipeline_tree.nbytes
+
+    input_container = pipeline_tree.get_patient_input_container("1502799995")
+    self.assertIs(list(input_container['arg_1'])[0], dataset)
+    patient_node = pipeline_tree["1502799995"]
+    if not isinstance(patient_node, PatientNode):
+      raise AssertionError
+    # The list of arg_1 holds the dataset, so it's neither released by arg_1 or arg_2
+    self.assertIs(list(patient_node['arg_1'])[0], dataset)
+    self.assertIsInstance(list(patient_node['arg_2'])[0], LazyDataset)
+    self.assertEqual(patient_node.nbytes, nbytes)
+    self.assertEqual(pipeline_tree.nbytes, nbytes)
+
+
+class DuplicateTestCase(TestCase):
+  def setUp(self) -> None:
+    self.old_sink = get_metrics()
+    self.metrics = InMemoryMetrics()
+    set_metrics(self.metrics)
+    self.pipeline_tree = PipelineTree(0x00100020, {'arg_1' : TestInput1})
+
+  def tearDown(self) -> None:
+    set_metrics(self.old_sink)
+
+  def test_exact_duplicates_are_skipped(self):
+    dataset = get_pixel_dataset("1502799995")
+    self.assertEqual(self.pipeline_tree.add_image(dataset), 1)
+    self.assertEqual(self.pipeline_tree.add_image(deepcopy(dataset)), 0)
+    self.assertEqual(self.pipeline_tree.images, 1)
+    self.assertEqual(self.metrics.counter("dicomnode_duplicate_images_total"), 1)
+    self.assertTrue(self.pipeline_tree.is_duplicate(dataset.SOPInstanceUID, dataset_digest(dataset)))
+
+  def test_changed_images_are_added(self):
+    dataset = get_pixel_dataset("1502799995")
+    self.pipeline_tree.add_image(dataset, b"digest")
+    self.assertFalse(self.pipeline_tree.is_duplicate(dataset.SOPInstanceUID, b"changed digest"))
+    changed_dataset = deepcopy(dataset)
+    changed_dataset.PixelData = bytes(10)
+    self.assertEqual(self.pipeline_tree.add_image(changed_dataset, b"changed digest"), 1)
+    self.assertIs(self.pipeline_tree["1502799995"]['arg_1'][dataset.SOPInstanceUID], changed_dataset) # type: ignore
+    self.assertEqual(self.metrics.counter("dicomnode_duplicate_images_total"), 0)
+
+  def test_changed_images_replace_their_size(self):
+    dataset = get_pixel_dataset("1502799995")
+    self.pipeline_tree.add_image(dataset, b"digest")
+    changed_dataset = deepcopy(dataset)
+    changed_dataset.PixelData = bytes(10)
+    self.pipeline_tree.add_image(changed_dataset, b"changed digest")
+    self.assertEqual(self.pipeline_tree["1502799995"].nbytes, estimate_dataset_size(changed_dataset)) # type: ignore
+    self.assertEqual(self.pipeline_tree.nbytes, estimate_dataset_size(changed_dataset))
+
+  def test_removed_patients_are_forgotten(self):
+    dataset = get_pixel_dataset("1502799995")
+    self.pipeline_tree.add_image(dataset, b"digest")
+    self.pipeline_tree.remove_patient("1502799995")
+    self.assertFalse(self.pipeline_tree.is_duplicate(dataset.SOPInstanceUID, b"digest"))
+    self.assertEqual(self.pipeline_tree.add_image(dataset, b"digest"), 1)
+
+
+class MoveCoordinatorTreeTestCase(TestCase):
+  def test_moves_of_removed_patients_are_forgotten(self):
+    coordinator = MoveCoordinator(ttl=60)
+    for patient_id in ["1502799995", "1210131111"]:
+      query = Dataset()
+      query.PatientID = patient_id
+      move = PendingMove()
+      move._finish(True)
+      coordinator._moves[_query_key("SCU", Address('localhost', 104, "PACS"), query, QueryLevels.PATIENT)] = move
+    pipeline_tree = PipelineTree(0x00100020, {'arg_1' : TestInput1},
+                                 PipelineTree.Options(move_coordinator=coordinator))
+    pipeline_tree.add_image(get_pixel_dataset("1502799995"))
+    pipeline_tree.remove_patient("1502799995")
+    self.assertEqual(len(coordinator), 1)
+
+
+class StorageTypeTestCase(TestCase):
+  def setUp(self) -> None:
+    self.path = Path(self._testMethodName)
+
+  def tearDown(self) -> None:
+    shutil.rmtree(self.path, ignore_errors=True)
+
+  def test_segment_store(self):
+    options = PipelineTree.Options(data_directory=self.path, storage_type=SegmentStore,
+                                   memory_budget=15000)
+    pipeline_tree = PipelineTree(0x00100020, {'arg_1' : TestInput1}, options)
+    pipeline_tree.add_image(get_pixel_dataset("1502799995"))
+    pipeline_tree.add_image(get_pixel_dataset("1502799995"))
+    self.assertEqual(list((self.path / "1502799995").iterdir()),
+                     [self.path / "1502799995" / SegmentStore.segment_name])
+    # The patient was spilled into its segment
+    for dataset in pipeline_tree["1502799995"]['arg_1']: # type: ignore
+      self.assertIsInstance(dataset, LazyDataset)
+      self.assertEqual(len(dataset.PixelData), 10000)
+
+    reloaded_tree = PipelineTree(0x00100020, {'arg_1' : TestInput1}, options)
+    self.assertEqual(reloaded_tree.images, 2)
+    reloaded_tree.remove_patient("1502799995")
+    self.assertEqual(reloaded_tree.images, 0)
+    self.assertFalse((self.path / "1502799995").exists())
+
+  def test_memory_store(self):
+    options = PipelineTree.Options(data_directory=self.path, storage_type=MemoryStore,
+                                   memory_budget=15000)
+    pipeline_tree = PipelineTree(0x00100020, {'arg_1' : TestInput1}, options)
+    pipeline_tree.add_image(get_pixel_dataset("1502799995"))
+    pipeline_tree.add_image(get_pixel_dataset("1502799995"))
+    self.assertTrue(pipeline_tree.exceeds_memory_budget())
+    self.assertEqual(pipeline_tree.enforce_memory_budget(), 0)
+    self.assertEqual(PipelineTree(0x00100020, {'arg_1' : TestInput1}, options).images, 0)
+
+
+class SharedInputContainerTestCase(TestCase):
+  def test_share_arrays(self):
+    volume = numpy.ones((4,4,4), dtype=numpy.int16)
+    container = InputContainer({"volume" : volume, "small" : numpy.ones(2), "header" : "text"})
+    self.assertEqual(container.share_arrays(threshold=100), volume.nbytes)
+    shared = container.get_shared("volume")
+    self.assertTrue((container["volume"] == volume).all())
+    self.assertEqual(container["header"], "text")
+    self.assertRaises(ValueError, container.get_shared, "small")
+
+    container.release()
+    with self.assertRaises(FileNotFoundError):
+      SharedArray(shared.name, shared.shape, shared.dtype, 0).attach()
+
+  def test_release_is_idempotent(self):
+    volume = numpy.ones((4,4,4), dtype=numpy.int16)
+    container = InputContainer({"volume" : volume})
+    container.share_arrays()
+    shared = container.get_shared("volume").acquire() # Held beyond the job
+    container.release()
+    container.release()
+    self.assertTrue((shared.attach() == volume).all()) # Still referenced
+    self.assertFalse(container.is_ground("volume"))
+    shared.release()
+    with self.assertRaises(FileNotFoundError):
+      SharedArray(shared.name, shared.shape, shared.dtype, 0).attach()
+
+
 class PatientNodeTestCase(TestCase):
   def setUp(self) -> None:
     self.path = Path(self._testMethodName)
@@ -0,0 +1,197 @@
+"""Tests for the sharded multi process pipeline"""
+
+__author__ = "Christoffer Vilstrup Jensen"
+
+# Python Standard Library
+import logging
+import os
+from pathlib import Path
+from random import randint
+import shutil
+import signal
+from time import monotonic, sleep
+from typing import List
+from unittest import TestCase
+
+# Third party packages
+from pydicom import Dataset
+from pydicom.uid import RawDataStorage
+
+# Dicomnode packages
+from dicomnode.lib.dicom import gen_uid, make_meta
+from dicomnode.lib.dimse import Address, send_images
+from dicomnode.server.input import AbstractInput
+from dicomnode.server.assocation_container import CStoreContainer
+from dicomnode.server.output import NoOutput, PipelineOutput
+from dicomnode.server.pipeline_tree import InputContainer
+from dicomnode.server.sharding import ShardedMetrics, ShardedPipeline, shard_index
+
+TEST_AE_TITLE = "TEST_AE"
+SENDER_AE = "SENDER_AE"
+PATIENT_IDS = ["1502799995", "1210131111", "1111550641", "0201919996", "2302880911"]
+
+class WaitingInput(AbstractInput):
+  required_tags: List[int] = [0x00080018]
+
+  def validate(self) -> bool:
+    return False
+
+class ReadyInput(AbstractInput):
+  required_tags: List[int] = [0x00080018]
+
+  def validate(self) -> bool:
+    return True
+
+# The pipelines are at module level, such that the worker processes can import them
+class WaitingShardedNode(ShardedPipeline):
+  ae_title = TEST_AE_TITLE
+  input = {"arg" : WaitingInput}
+  require_calling_aet = [SENDER_AE]
+  log_output = None
+  disable_pynetdicom_logger: bool = True
+
+  def process(self, input_data: InputContainer) -> PipelineOutput:
+    return NoOutput() # pragma: no cover
+
+class ProcessingShardedNode(WaitingShardedNode):
+  input = {"arg" : ReadyInput}
+
+  def process(self, input_data: InputContainer) -> PipelineOutput:
+    return NoOutput()
+
+class ProcessGate:
+  """Gate, that the test opens, to hold processing in a worker process. The
+  workers are spawned, so it's shared through files in the working directory"""
+  directory = Path("sharding_process_gate")
+
+  @classmethod
+  def reset(cls) -> None:
+    shutil.rmtree(cls.directory, ignore_errors=True)
+    cls.directory.mkdir()
+
+  @classmethod
+  def wait_for(cls, name: str, timeout: float = 30.0) -> bool:
+    deadline = monotonic() + timeout
+    while not (cls.directory / name).exists():
+      if deadline < monotonic():
+        return False
+      sleep(0.01)
+    return True
+
+  @classmethod
+  def signal(cls, name: str) -> None:
+    (cls.directory / name).touch()
+
+class GatedProcessOnReadyShardedNode(WaitingShardedNode):
+  input = {"arg" : ReadyInput}
+  process_on_ready = True
+  shards = 1
+  shard_timeout = 10.0
+
+  def process(self, input_data: InputContainer) -> PipelineOutput:
+    ProcessGate.signal("processing")
+    ProcessGate.wait_for("open")
+    return NoOutput()
+
+class UnresponsiveShardedNode(WaitingShardedNode):
+  shards = 1
+  shard_timeout = 1.0
+
+def get_dataset(patient_id: str) -> Dataset:
+  dataset = Dataset()
+  dataset.PatientID = patient_id
+  dataset.SOPClassUID = RawDataStorage
+  dataset.SOPInstanceUID = gen_uid()
+  make_meta(dataset)
+  return dataset
+
+
+class ShardIndexTestCase(TestCase):
+  def test_shard_index_is_stable(self):
+    self.assertEqual(shard_index("1502799995", 4), shard_index("1502799995", 4))
+    for patient_id in PATIENT_IDS:
+      self.assertIn(shard_index(patient_id, 3), range(3))
+    self.assertEqual(shard_index("1502799995", 1), 0)
+
+
+class ShardedPipelineTestCase(TestCase):
+  def open(self, node_type) -> ShardedPipeline:
+    node = node_type()
+    self.port = randint(1025,65535)
+    node.port = self.port
+    node.open(blocking=False)
+    self.addCleanup(node.close)
+    return node
+
+  def test_patients_are_routed_to_their_shard(self):
+    node = self.open(WaitingShardedNode)
+    address = Address('localhost', self.port, TEST_AE_TITLE)
+    datasets = [get_dataset(patient_id) for patient_id in PATIENT_IDS for _ in range(2)]
+    with self.assertLogs("dicomnode", logging.DEBUG):
+      send_images(SENDER_AE, address, datasets)
+
+    statuses = node.status()
+    self.assertEqual([status.shard for status in statuses], [0, 1])
+    for status in statuses:
+      self.assertTrue(status.alive)
+      patients = [patient_id for patient_id in PATIENT_IDS
+                  if shard_index(patient_id, node.shards) == status.shard]
+      self.assertEqual(status.patients, len(patients))
+      self.assertEqual(status.images, 2 * len(patients))
+    self.assertEqual(node.data_state.images, 0) # The front end stores nothing
+
+  def test_shards_process_and_metrics_are_aggregated(self):
+    node = self.open(ProcessingShardedNode)
+    address = Address('localhost', self.port, TEST_AE_TITLE)
+    with self.assertLogs("dicomnode", logging.DEBUG):
+      send_images(SENDER_AE, address, [get_dataset(patient_id) for patient_id in PATIENT_IDS])
+
+    metrics = node.metrics_sink
+    if not isinstance(metrics, ShardedMetrics):
+      raise AssertionError
+    for _ in range(200): # Releases are processed in the background
+      if metrics.aggregate().histogram("dicomnode_stage_seconds", {"stage" : "process"})[0] == len(PATIENT_IDS):
+        break
+      sleep(0.02)
+
+    aggregate = metrics.aggregate()
+    self.assertEqual(aggregate.histogram("dicomnode_stage_seconds", {"stage" : "process"})[0], len(PATIENT_IDS))
+    self.assertEqual(aggregate.histogram("dicomnode_stage_seconds", {"stage" : "add_image"})[0], len(PATIENT_IDS))
+    self.assertEqual(aggregate.counter("dicomnode_images_received_total"), len(PATIENT_IDS))
+    self.assertEqual(sum(status.patients for status in node.status()), 0)
+    self.assertIn("dicomnode_images_received_total", metrics.render())
+
+  def test_ready_patients_do_not_block_storing(self):
+    ProcessGate.reset()
+    self.addCleanup(shutil.rmtree, ProcessGate.directory, ignore_errors=True)
+    self.open(GatedProcessOnReadyShardedNode)
+    self.addCleanup(ProcessGate.signal, "open") # Before the node is closed
+    address = Address('localhost', self.port, TEST_AE_TITLE)
+    with self.assertLogs("dicomnode", logging.DEBUG):
+      # The image makes the patient ready, and it's processed until the gate opens
+      send_images(SENDER_AE, address, [get_dataset(PATIENT_IDS[0])])
+      self.assertTrue(ProcessGate.wait_for("processing"))
+      # A blocked shard would refuse the image after the shard_timeout, making send_images raise
+      send_images(SENDER_AE, address, [get_dataset(PATIENT_IDS[1])])
+
+  def test_unresponsive_shard_times_out(self):
+    node = self.open(UnresponsiveShardedNode)
+    pid = node._processes[0].pid
+    if pid is None:
+      raise AssertionError
+    os.kill(pid, signal.SIGSTOP)
+    self.addCleanup(os.kill, pid, signal.SIGCONT)
+    container = CStoreContainer(1, get_dataset(PATIENT_IDS[0]), SENDER_AE, "localhost")
+    with self.assertLogs("dicomnode", logging.ERROR):
+      self.assertEqual(node._consume_c_store_container(container), 0xA700)
+    self.assertEqual(node._pending, {})
+
+  def test_dead_shard_refuses_immediately(self):
+    node = self.open(WaitingShardedNode)
+    node._processes[0].terminate()
+    node._processes[0].join()
+    patient_id = [patient_id for patient_id in PATIENT_IDS if shard_index(patient_id, node.shards) == 0][0]
+    container = CStoreContainer(1, get_dataset(patient_id), SENDER_AE, "localhost")
+    with self.assertLogs("dicomnode", logging.ERROR):
+      self.assertEqual(node._consume_c_store_container(container), 0xA700)
+    self.assertEqual(node._pending, {})
@@ -0,0 +1,107 @@
+from random import randint
+from unittest import TestCase
+
+from pydicom import Dataset
+from pynetdicom import evt
+from pynetdicom.ae import ApplicationEntity
+from pynetdicom.presentation import AllStoragePresentationContexts
+
+from dicomnode.lib.dimse import Address, send_image
+from dicomnode.tools.loadgen import LoadGenerator, LoadReport, percentile
+
+
+class LoadGeneratorTestCase(TestCase):
+  def setUp(self) -> None:
+    self.received = []
+    self.forward_port = None
+    def handle_store(event):
+      dataset: Dataset = event.dataset
+      dataset.file_meta = event.file_meta
+      self.received.append(dataset)
+      if self.forward_port is not None and len(self.received) % 4 == 0:
+        send_image("ENDPOINT", Address('localhost', self.forward_port, "LOADGEN"), dataset)
+      return 0x0000
+
+    self.endpoint_port = randint(1025,65535)
+    self.endpoint = ApplicationEntity()
+    self.endpoint.supported_contexts = AllStoragePresentationContexts
+    self.endpoint.start_server(('127.0.0.1', self.endpoint_port),
+                               evt_handlers=[(evt.EVT_C_STORE, handle_store)],
+                               block=False)
+    self.address = Address('localhost', self.endpoint_port, "PYNETDICOM")
+
+  def tearDown(self) -> None:
+    self.endpoint.shutdown()
+
+  def test_load_generator(self):
+    load_generator = LoadGenerator("LOADGEN", self.address, patients=2,
+                                   series_per_patient=2, images_per_series=3,
+                                   rows=8, columns=8, associations=3)
+    report = load_generator.run()
+
+    self.assertEqual(report.images_sent, 12)
+    self.assertEqual(report.images_failed, 0)
+    self.assertEqual(len(report.latencies), 12)
+    self.assertEqual(report.bytes_sent, 12 * 8 * 8 * 2)
+    self.assertEqual(len(self.received), 12)
+    self.assertEqual({dataset.PatientID for dataset in self.received},
+                     {load_generator.patient_id(0), load_generator.patient_id(1)})
+    self.assertEqual(len({dataset.SeriesInstanceUID for dataset in self.received}), 4)
+    self.assertGreater(report.images_per_second, 0)
+
+  def test_load_generator_deflate_and_rate(self):
+    load_generator = LoadGenerator("LOADGEN", self.address, images_per_series=5,
+                                   rows=8, columns=8, associations=2,
+                                   rate=50, compression="deflate")
+    report = load_generator.run()
+
+    self.assertEqual(report.images_sent, 5)
+    self.assertGreaterEqual(report.seconds, 4 / 50)
+    for dataset in self.received:
+      self.assertEqual(dataset.file_meta.TransferSyntaxUID, "1.2.840.10008.1.2.1.99")
+
+  def test_time_to_output(self):
+    self.forward_port = randint(1025,65535)
+    load_generator = LoadGenerator("LOADGEN", self.address, patients=2,
+                                   images_per_series=4, rows=8, columns=8,
+                                   associations=1, output_port=self.forward_port,
+                                   output_timeout=5.0)
+    report = load_generator.run()
+
+    self.assertEqual(report.images_sent, 8)
+    self.assertEqual(set(report.time_to_output),
+                     {load_generator.patient_id(0), load_generator.patient_id(1)})
+    self.assertEqual(report.patients_without_output, 0)
+    self.assertIn("Time to output", report.render())
+
+  def test_unreachable_node(self):
+    load_generator = LoadGenerator("LOADGEN", Address('localhost', randint(1025,65535), "NOBODY"),
+                                   images_per_series=5, rows=8, columns=8,
+                                   associations=2)
+    report = load_generator.run()
+
+    self.assertEqual(report.images_sent, 0)
+    self.assertEqual(report.images_failed, 5)
+    self.assertIn("1 of 1 patients got no output", report.render())
+
+  def test_invalid_arguments(self):
+    self.assertRaises(ValueError, LoadGenerator, "LOADGEN", self.address, associations=0)
+    self.assertRaises(ValueError, LoadGenerator, "LOADGEN", self.address, compression="zip")
+    self.assertRaises(ValueError, LoadGenerator, "LOADGEN", self.address, rate=0)
+
+  def test_percentile(self):
+    values = [float(value) for value in range(1, 101)]
+    self.assertEqual(percentile(values, 50), 50.0)
+    self.assertEqual(percentile(values, 99), 99.0)
+    self.assertEqual(percentile(values, 100), 100.0)
+    self.assertEqual(percentile([3.0], 90), 3.0)
+    self.assertIsNone(percentile([], 50))
+
+  def test_report_json(self):
+    report = LoadReport(images_sent=4, seconds=2.0, latencies=[0.1, 0.2, 0.3, 0.4], patients=1)
+    json = report.to_json()
+    self.assertEqual(json['images_per_second'], 2.0)
+    self.assertEqual(json['latency_seconds']['p50'], 0.2)
+    self.assertEqual(json['latency_seconds']['max'], 0.4)
+    self.assertIsNone(json['time_to_output_seconds']['p50'])
+    self.assertEqual(json['patients_without_output'], 1)